@@ -1,16 +1,41 @@
 import os
 import sys
 import json
+import re
+import hashlib
 import uuid
 import time
 import shutil
+import atexit
+import tempfile
+import tarfile
+import zipfile
+import signal
+import struct
 import logging
+import queue
+import threading
+import io
+import zlib
+import mimetypes
+import difflib
+import itertools
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, quote
+from contextlib import contextmanager
 from datetime import datetime
 import subprocess
 import requests
-from flask import Flask, request, jsonify, send_from_directory, send_file, g
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, jsonify, send_from_directory, send_file, g, has_app_context
+from werkzeug.exceptions import HTTPException
 import sqlite3
 from dotenv import load_dotenv
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装Pillow时不生成缩略图，始终返回原图
+    Image = None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -28,6 +53,9 @@ DATA_FOLDER = "./data"
 USER_FOLDER = os.path.join(DATA_FOLDER, 'userdb')
 PIC_FOLDER = os.path.join(DATA_FOLDER, 'pic')
 WEBSITES_FOLDER = os.path.join(DATA_FOLDER, 'websites')
+PLUGIN_STORE_FOLDER = os.path.join(DATA_FOLDER, 'plugin-store')
+IMAGE_CACHE_FOLDER = os.path.join(DATA_FOLDER, 'pic-cache')
+UPLOAD_STAGING_FOLDER = os.path.join(DATA_FOLDER, 'upload-staging')
 
 # 确保data和pic文件夹存在
 if not os.path.exists(DATA_FOLDER):
@@ -38,261 +66,2074 @@ if not os.path.exists(USER_FOLDER):
     os.makedirs(USER_FOLDER, exist_ok=True)
 if not os.path.exists(WEBSITES_FOLDER):
     os.makedirs(WEBSITES_FOLDER, exist_ok=True)
+if not os.path.exists(PLUGIN_STORE_FOLDER):
+    os.makedirs(PLUGIN_STORE_FOLDER, exist_ok=True)
+if not os.path.exists(IMAGE_CACHE_FOLDER):
+    os.makedirs(IMAGE_CACHE_FOLDER, exist_ok=True)
+if not os.path.exists(UPLOAD_STAGING_FOLDER):
+    os.makedirs(UPLOAD_STAGING_FOLDER, exist_ok=True)
 
 # 转为绝对路径
 DATA_FOLDER = os.path.abspath(DATA_FOLDER)
 USER_FOLDER = os.path.abspath(USER_FOLDER)
 PIC_FOLDER = os.path.abspath(PIC_FOLDER)
 WEBSITES_FOLDER = os.path.abspath(WEBSITES_FOLDER)
+PLUGIN_STORE_FOLDER = os.path.abspath(PLUGIN_STORE_FOLDER)
+IMAGE_CACHE_FOLDER = os.path.abspath(IMAGE_CACHE_FOLDER)
+UPLOAD_STAGING_FOLDER = os.path.abspath(UPLOAD_STAGING_FOLDER)
 
 gitbook_db_path = os.path.join(DATA_FOLDER, 'gitbook.db')
-conn = sqlite3.connect(gitbook_db_path, check_same_thread=False)
-cursor = conn.cursor()
-
-# 创建sessions表（如果不存在）
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS sessions (
-        session_id TEXT PRIMARY KEY,
-        folder_name TEXT NOT NULL,
-        folder_path TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+
+# 数据库连接配置
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+
+# 文件夹导入配置
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', '4'))
+IMPORT_PROGRESS_INTERVAL = int(os.getenv('IMPORT_PROGRESS_INTERVAL', '500'))
+IMPORT_SKIP_DIRS = ('_book', 'node_modules')
+
+# 后台任务配置
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '32'))
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+GITBOOK_TIMEOUT = int(os.getenv('GITBOOK_TIMEOUT', '300'))
+
+# 文件内容ETag缓存的最大条目数
+FILE_ETAG_CACHE_SIZE = int(os.getenv('FILE_ETAG_CACHE_SIZE', '4096'))
+
+# 延迟写入（自动保存合并）配置，默认关闭
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', '0') == '1'
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '5'))
+WRITE_BEHIND_IDLE = float(os.getenv('WRITE_BEHIND_IDLE', '1'))
+
+# 批量修改文件树接口一次最多执行的操作数
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', '500'))
+
+# 批量读取文件内容的限制：一次最多返回的文件数和内容总字节数
+BULK_READ_MAX_FILES = int(os.getenv('BULK_READ_MAX_FILES', '2000'))
+BULK_READ_MAX_BYTES = int(os.getenv('BULK_READ_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# 上传压缩包的限制：最多条目数和解压后的总字节数
+UPLOAD_MAX_ENTRIES = int(os.getenv('UPLOAD_MAX_ENTRIES', '5000'))
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(512 * 1024 * 1024)))
+UPLOAD_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg')
+UPLOAD_ARCHIVE_EXTENSIONS = ('.zip', '.tar.gz', '.tgz')
+
+# 修订历史配置：同一文件在REVISION_MIN_INTERVAL秒内的多次保存合并为一个修订；
+# 每个文件最多保留REVISION_MAX_PER_FILE个修订，超过REVISION_KEEP_DAYS天的删除，超过一天的每天只保留最后一个；
+# 连续的差量超过REVISION_MAX_CHAIN个时保留完整内容，恢复旧版本时最多应用这么多次差量
+REVISION_MIN_INTERVAL = float(os.getenv('REVISION_MIN_INTERVAL', '120'))
+REVISION_MAX_PER_FILE = int(os.getenv('REVISION_MAX_PER_FILE', '100'))
+REVISION_KEEP_DAYS = int(os.getenv('REVISION_KEEP_DAYS', '30'))
+REVISION_MAX_CHAIN = int(os.getenv('REVISION_MAX_CHAIN', '20'))
+
+# 图片缩略图配置：上传后在后台生成这些宽度的缩略图，/api/get-image/<filename>?w= 返回不小于w的最近宽度；
+# 缩略图缓存在IMAGE_CACHE_FOLDER中，总大小超过IMAGE_CACHE_MAX_BYTES时删除最久未使用的
+IMAGE_VARIANT_WIDTHS = sorted(int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '320,800,1600').split(',') if w.strip())
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', '2'))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+
+# 上传图片的优化（默认关闭，需要Pillow）：去除元数据、无损或近无损重新压缩，
+# BMP和超过IMAGE_OPTIMIZE_PNG_WEBP_BYTES的PNG转为无损WebP；原来的图片地址保持可用
+IMAGE_OPTIMIZE_ENABLED = os.getenv('IMAGE_OPTIMIZE_ENABLED', '0') == '1'
+IMAGE_OPTIMIZE_PNG_WEBP_BYTES = int(os.getenv('IMAGE_OPTIMIZE_PNG_WEBP_BYTES', str(512 * 1024)))
+IMAGE_OPTIMIZE_JPEG_QUALITY = int(os.getenv('IMAGE_OPTIMIZE_JPEG_QUALITY', '90'))
+
+# 图片回收：不再被任何文件引用的图片在IMAGE_GC_GRACE_DAYS天后才删除，
+# 默认与修订保留天数相同，恢复保留期内的修订时引用的图片仍然存在
+IMAGE_GC_GRACE_DAYS = float(os.getenv('IMAGE_GC_GRACE_DAYS', str(REVISION_KEEP_DAYS)))
+
+# 从站外地址下载图片的配置：单张图片的大小上限、超时、并发下载数和批量接口一次最多的地址数
+REMOTE_IMAGE_MAX_BYTES = int(os.getenv('REMOTE_IMAGE_MAX_BYTES', str(20 * 1024 * 1024)))
+REMOTE_IMAGE_TIMEOUT = float(os.getenv('REMOTE_IMAGE_TIMEOUT', '10'))
+REMOTE_IMAGE_WORKERS = int(os.getenv('REMOTE_IMAGE_WORKERS', '8'))
+REMOTE_IMAGE_BATCH_MAX = int(os.getenv('REMOTE_IMAGE_BATCH_MAX', '100'))
+
+# 图片响应的缓存时间（图片文件名唯一且不会被改写，浏览器可以长期缓存）
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+# 由前端代理发送图片内容：''（默认，由Flask发送）、'x-sendfile'（Apache/lighttpd）或'x-accel'（nginx）
+# x-accel模式下代理需要把IMAGE_ACCEL_PREFIX配置为指向DATA_FOLDER的internal位置
+IMAGE_OFFLOAD = os.getenv('IMAGE_OFFLOAD', '').lower()
+IMAGE_ACCEL_PREFIX = os.getenv('IMAGE_ACCEL_PREFIX', '/protected-data/')
+
+# 文件树缓存配置：所有会话缓存的节点总数上限
+TREE_CACHE_MAX_NODES = int(os.getenv('TREE_CACHE_MAX_NODES', '200000'))
+
+def _open_db_connection():
+    """
+    打开一个新的数据库连接
+    isolation_level=None表示由代码显式控制事务（见transaction()）
+    """
+    db = sqlite3.connect(
+        gitbook_db_path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        check_same_thread=False
     )
-''')
-conn.commit()
-
-# 创建file_mapping表（如果不存在）
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS file_mapping (
-        id TEXT PRIMARY KEY,
-        real_name TEXT NOT NULL,
-        display_name TEXT NOT NULL,
-        file_path TEXT NOT NULL,
-        parent_path TEXT NOT NULL,
-        position INTEGER NOT NULL DEFAULT 0,
-        child_count INTEGER NOT NULL DEFAULT 0,
-        item_type TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    # WAL模式下NORMAL已能保证崩溃后数据库一致
+    db.execute("PRAGMA synchronous = NORMAL")
+    db.execute("PRAGMA foreign_keys = ON")
+    db.execute("PRAGMA temp_store = MEMORY")
+    db.execute("PRAGMA cache_size = -16000")
+    db.execute("PRAGMA mmap_size = 268435456")
+    return db
+
+class ConnectionPool:
+    """
+    简单的SQLite连接池，连接在请求之间复用，避免每个请求重新打开数据库
+    """
+    def __init__(self, size):
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _open_db_connection()
+
+    def release(self, db):
+        # 归还前回滚未结束的事务，保证下一个使用者拿到干净的连接
+        if db.in_transaction:
+            db.rollback()
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+_thread_local = threading.local()
+
+def get_db():
+    """
+    获取当前请求专用的数据库连接
+    请求内的连接来自连接池，请求结束时归还；请求之外（后台线程、启动脚本）每个线程使用自己的连接
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = db_pool.acquire()
+        return g.db
+    db = getattr(_thread_local, 'db', None)
+    if db is None:
+        db = _thread_local.db = _open_db_connection()
+    return db
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        db_pool.release(db)
+
+@contextmanager
+def transaction(immediate=True):
+    """
+    在当前连接上执行一个显式事务，正常结束时提交，出现异常时回滚
+    :param immediate: 写事务使用BEGIN IMMEDIATE，在开始时就获取写锁，避免读锁升级写锁时的死锁；
+                      只读事务传False，在WAL模式下不会阻塞其他请求
+    已经处于事务中时直接加入外层事务
+    """
+    db = get_db()
+    if db.in_transaction:
+        yield db
+        return
+    db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _thread_local.after_commit = []
+    _thread_local.after_rollback = []
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        _thread_local.after_commit = []
+        callbacks, _thread_local.after_rollback = _thread_local.after_rollback, []
+        for callback in callbacks:
+            callback()
+        raise
+    else:
+        db.commit()
+        _thread_local.after_rollback = []
+        callbacks, _thread_local.after_commit = _thread_local.after_commit, []
+        for callback in callbacks:
+            callback()
+
+def after_commit(callback):
+    """
+    在当前事务提交后执行回调（回滚时丢弃），用于更新进程内缓存
+    不在事务中时立即执行
+    """
+    if get_db().in_transaction:
+        _thread_local.after_commit.append(callback)
+    else:
+        callback()
+
+def after_rollback(callback):
+    """
+    在当前事务回滚后执行回调（提交时丢弃），用于撤销事务期间设置的进程内状态
+    不在事务中时不执行
+    """
+    if get_db().in_transaction:
+        _thread_local.after_rollback.append(callback)
+
+# 会话内文件树的存储方式
+# file_mapping只保存每个节点的会话ID、父节点ID（会话根目录下的节点为ROOT_PARENT_ID）和真实名称，
+# 磁盘路径由会话文件夹加上各级祖先的真实名称拼接得到，重命名会话或文件夹时不需要改写后代记录。
+# file_closure保存所有(祖先, 后代, 距离)关系，子树的查询、删除、移动都只涉及该子树的索引范围。
+ROOT_PARENT_ID = ''
+
+# 同级节点的排序键使用带间隔的整数，拖动排序时取相邻两项的中点，只需改写被拖动的一行；
+# 间隔用完时才用一条语句把该文件夹重新按POSITION_GAP编号
+POSITION_GAP = 1024
+
+# 按(位置, rowid)为一个文件夹的子项重新编号，rowid保证位置相同的旧数据顺序不变
+RENUMBER_POSITIONS_SQL = '''
+    UPDATE file_mapping SET position = ranked.new_position
+    FROM (
+        SELECT id, ROW_NUMBER() OVER (ORDER BY position, rowid) * ? AS new_position
+        FROM file_mapping WHERE session_id = ? AND parent_id = ?
+    ) AS ranked
+    WHERE file_mapping.id = ranked.id
+'''
+
+def _migration_add_file_mapping_indexes(cur):
+    """
+    为file_mapping的常用查询添加索引
+    """
+    # 唯一索引建立前，先为同一文件夹下重复的显示名称追加序号
+    cur.execute('''
+        SELECT parent_path, display_name FROM file_mapping
+        GROUP BY parent_path, display_name HAVING COUNT(*) > 1
+    ''')
+    for parent_path, display_name in cur.fetchall():
+        cur.execute(
+            "SELECT id FROM file_mapping WHERE parent_path = ? AND display_name = ? ORDER BY position, created_at",
+            (parent_path, display_name)
+        )
+        duplicate_ids = [row[0] for row in cur.fetchall()][1:]
+        base_name, ext = os.path.splitext(display_name)
+        suffix = 2
+        for item_id in duplicate_ids:
+            while True:
+                new_display_name = f"{base_name} ({suffix}){ext}"
+                suffix += 1
+                cur.execute(
+                    "SELECT COUNT(*) FROM file_mapping WHERE parent_path = ? AND display_name = ?",
+                    (parent_path, new_display_name)
+                )
+                if cur.fetchone()[0] == 0:
+                    break
+            logger.warning(f"显示名称重复，已重命名: {parent_path} / {display_name} -> {new_display_name}")
+            cur.execute("UPDATE file_mapping SET display_name = ? WHERE id = ?", (new_display_name, item_id))
+
+    # 树读取、子项位置统计：覆盖索引，按父路径取子项时无需回表
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_file_mapping_parent_position
+        ON file_mapping (parent_path, position, id, display_name, file_path, item_type)
+    ''')
+    # child_count更新、删除、按路径查找
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_file_mapping_file_path ON file_mapping (file_path)")
+    # 同一文件夹下显示名称唯一（check_display_name_duplicate）
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_file_mapping_parent_display_name
+        ON file_mapping (parent_path, display_name)
+    ''')
+    # 重命名时按真实文件名查找
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_file_mapping_real_name ON file_mapping (real_name)")
+    # 按文件夹路径查找会话
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sessions_folder_path ON sessions (folder_path)")
+
+def _migration_session_scoped_tree(cur):
+    """
+    file_mapping改为按会话和父节点ID存储，并建立闭包表
+    原来的file_path/parent_path绝对路径列被移除，路径改为由祖先节点的真实名称拼接得到
+    """
+    cur.execute('''
+        CREATE TABLE file_mapping_v2 (
+            id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            parent_id TEXT NOT NULL,
+            real_name TEXT NOT NULL,
+            display_name TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            child_count INTEGER NOT NULL DEFAULT 0,
+            item_type TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE file_closure (
+            ancestor_id TEXT NOT NULL,
+            descendant_id TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+    ''')
+
+    cur.execute("SELECT session_id, folder_path FROM sessions")
+    session_folders = cur.fetchall()
+    cur.execute('''
+        SELECT id, display_name, file_path, parent_path, position, child_count, item_type, created_at
+        FROM file_mapping ORDER BY rowid
+    ''')
+    rows = cur.fetchall()
+    id_by_path = {row[2]: row[0] for row in rows}
+
+    def owning_session(file_path):
+        best = None
+        for session_id, folder_path in session_folders:
+            if file_path.startswith(folder_path + os.sep) and (best is None or len(folder_path) > len(best[1])):
+                best = (session_id, folder_path)
+        return best
+
+    # 旧数据中找不到会话或父节点的记录直接丢弃（例如会话已删除但映射残留）
+    migrated = {}
+    for item_id, display_name, file_path, parent_path, position, child_count, item_type, created_at in rows:
+        session = owning_session(file_path)
+        if not session:
+            continue
+        session_id, folder_path = session
+        if parent_path == folder_path:
+            parent_id = ROOT_PARENT_ID
+        else:
+            parent_id = id_by_path.get(parent_path)
+            if parent_id is None:
+                continue
+        migrated[item_id] = (item_id, session_id, parent_id, os.path.basename(file_path), display_name,
+                             position, child_count, item_type, created_at)
+
+    # 父节点被丢弃的记录也一并丢弃
+    def is_reachable(item_id, seen=()):
+        parent_id = migrated[item_id][2]
+        if parent_id == ROOT_PARENT_ID:
+            return True
+        if parent_id not in migrated or parent_id in seen:
+            return False
+        return is_reachable(parent_id, seen + (item_id,))
+
+    kept = [row for item_id, row in migrated.items() if is_reachable(item_id)]
+    dropped = len(rows) - len(kept)
+    if dropped:
+        logger.warning(f"迁移file_mapping时丢弃了 {dropped} 条不属于任何会话的记录")
+
+    cur.executemany(
+        "INSERT INTO file_mapping_v2 (id, session_id, parent_id, real_name, display_name, position, child_count, item_type, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        kept
+    )
+
+    parent_of = {row[0]: row[2] for row in kept}
+    closure_rows = []
+    for item_id in parent_of:
+        ancestor_id, depth = item_id, 0
+        while ancestor_id != ROOT_PARENT_ID:
+            closure_rows.append((ancestor_id, item_id, depth))
+            ancestor_id, depth = parent_of[ancestor_id], depth + 1
+    cur.executemany(
+        "INSERT INTO file_closure (ancestor_id, descendant_id, depth) VALUES (?, ?, ?)",
+        closure_rows
     )
-''')
-conn.commit()
+
+    cur.execute("DROP TABLE file_mapping")
+    cur.execute("ALTER TABLE file_mapping_v2 RENAME TO file_mapping")
+
+    # 树读取：按(会话, 父节点)取子项并按position排序，覆盖索引无需回表
+    cur.execute('''
+        CREATE INDEX idx_file_mapping_children
+        ON file_mapping (session_id, parent_id, position, id, real_name, display_name, item_type)
+    ''')
+    # 同一文件夹下显示名称唯一
+    cur.execute('''
+        CREATE UNIQUE INDEX ux_file_mapping_sibling_display_name
+        ON file_mapping (session_id, parent_id, display_name)
+    ''')
+    # 路径解析：按(会话, 父节点, 真实名称)逐级查找
+    cur.execute('''
+        CREATE INDEX idx_file_mapping_sibling_real_name
+        ON file_mapping (session_id, parent_id, real_name)
+    ''')
+    # 查找某个节点的所有祖先
+    cur.execute("CREATE INDEX idx_file_closure_descendant ON file_closure (descendant_id, depth)")
+
+def _migration_gapped_positions(cur):
+    """
+    把所有文件夹的连续位置改为间隔为POSITION_GAP的位置
+    """
+    cur.execute('''
+        UPDATE file_mapping SET position = ranked.new_position
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY session_id, parent_id ORDER BY position, rowid) * ? AS new_position
+            FROM file_mapping
+        ) AS ranked
+        WHERE file_mapping.id = ranked.id
+    ''', (POSITION_GAP,))
+
+def _migration_add_jobs(cur):
+    """
+    新增后台任务表
+    """
+    cur.execute('''
+        CREATE TABLE jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            session_id TEXT,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL DEFAULT '{}',
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cur.execute("CREATE INDEX idx_jobs_status ON jobs (status, created_at)")
+
+def _migration_add_search_index(cur):
+    """
+    新增全文搜索索引：search_docs记录每个文件对应的索引行及其内容版本，file_search保存标题和正文
+    优先使用FTS5的trigram分词（中文也能按任意子串搜索），SQLite不支持时依次退回unicode61分词和普通表
+    """
+    cur.execute('''
+        CREATE TABLE search_docs (
+            id INTEGER PRIMARY KEY,
+            item_id TEXT NOT NULL UNIQUE,
+            session_id TEXT NOT NULL,
+            etag TEXT
+        )
+    ''')
+    cur.execute("CREATE INDEX idx_search_docs_session ON search_docs (session_id)")
+    for tokenize in ('trigram', 'unicode61'):
+        try:
+            cur.execute(f"CREATE VIRTUAL TABLE file_search USING fts5(title, content, tokenize='{tokenize}')")
+            return
+        except sqlite3.OperationalError:
+            continue
+    cur.execute("CREATE TABLE file_search (id INTEGER PRIMARY KEY, title TEXT, content TEXT)")
+
+def _migration_add_revisions(cur):
+    """
+    新增修订历史：revisions记录每个文件的各个版本，revision_blobs按内容哈希保存版本内容
+    """
+    cur.execute('''
+        CREATE TABLE revision_blobs (
+            hash TEXT PRIMARY KEY,
+            base_hash TEXT,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    ''')
+    cur.execute("CREATE INDEX idx_revision_blobs_base ON revision_blobs (base_hash)")
+    cur.execute('''
+        CREATE TABLE revisions (
+            id INTEGER PRIMARY KEY,
+            item_id TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            blob_hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cur.execute("CREATE INDEX idx_revisions_item ON revisions (item_id, created_at)")
+    cur.execute("CREATE INDEX idx_revisions_blob ON revisions (blob_hash)")
+
+def _migration_add_image_refs(cur):
+    """
+    新增图片去重和引用表：images按内容哈希记录PIC_FOLDER中的图片，image_refs记录每个文件引用了哪些图片
+    已有文件的引用在下一次重建全文索引时补齐，因此清空索引中的内容版本
+    """
+    cur.execute('''
+        CREATE TABLE images (
+            hash TEXT PRIMARY KEY,
+            filename TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE image_refs (
+            filename TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            PRIMARY KEY (item_id, filename)
+        )
+    ''')
+    cur.execute("CREATE INDEX idx_image_refs_filename ON image_refs (filename)")
+    cur.execute("CREATE INDEX idx_image_refs_session ON image_refs (session_id)")
+    cur.execute("UPDATE search_docs SET etag = NULL")
+
+def _migration_add_image_urls(cur):
+    """
+    新增站外图片地址缓存：同一地址再次粘贴时直接返回已下载的图片
+    """
+    cur.execute('''
+        CREATE TABLE image_urls (
+            url TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        )
+    ''')
+
+def _migration_add_image_optimization(cur):
+    """
+    images新增优化结果：stored_filename为优化后实际保存的文件（为空时即filename），
+    optimized_size为优化后的字节数，optimized_at为处理时间（未处理为空）
+    """
+    cur.execute("ALTER TABLE images ADD COLUMN stored_filename TEXT")
+    cur.execute("ALTER TABLE images ADD COLUMN optimized_size INTEGER")
+    cur.execute("ALTER TABLE images ADD COLUMN optimized_at REAL")
+
+def _migration_add_image_orphans(cur):
+    """
+    新增未被引用的图片表：since为第一次发现未被引用的时间，checked_at为最近一次回收扫描的时间
+    """
+    cur.execute('''
+        CREATE TABLE image_orphans (
+            filename TEXT PRIMARY KEY,
+            since REAL NOT NULL,
+            checked_at REAL NOT NULL
+        )
+    ''')
+    cur.execute("CREATE INDEX idx_image_orphans_since ON image_orphans (since)")
+
+def _migration_add_image_refs_complete(cur):
+    """
+    sessions新增image_refs_complete：重建索引确认会话中每个文件的图片引用都已按当前规则建立后置为1，
+    存在未完成的会话时不回收图片；已有的引用只记录了图片语法中的地址，清空内容版本以便重新提取
+    """
+    cur.execute("ALTER TABLE sessions ADD COLUMN image_refs_complete INTEGER NOT NULL DEFAULT 0")
+    cur.execute("UPDATE search_docs SET etag = NULL")
+
+# (版本号, 说明, 迁移函数)，版本号必须递增
+SCHEMA_MIGRATIONS = [
+    (1, '为file_mapping和sessions添加索引', _migration_add_file_mapping_indexes),
+    (2, 'file_mapping按会话和父节点存储，新增闭包表file_closure', _migration_session_scoped_tree),
+    (3, 'file_mapping的同级位置改为带间隔的整数', _migration_gapped_positions),
+    (4, '新增后台任务表jobs', _migration_add_jobs),
+    (5, '新增全文搜索索引search_docs和file_search', _migration_add_search_index),
+    (6, '新增修订历史revisions和revision_blobs', _migration_add_revisions),
+    (7, '新增图片去重表images和图片引用表image_refs', _migration_add_image_refs),
+    (8, '新增站外图片地址缓存image_urls', _migration_add_image_urls),
+    (9, 'images新增优化后的文件和大小', _migration_add_image_optimization),
+    (10, '新增未被引用的图片表image_orphans', _migration_add_image_orphans),
+    (11, 'sessions新增图片引用是否完整的标记', _migration_add_image_refs_complete),
+]
+
+def run_schema_migrations(db):
+    """
+    执行所有尚未执行的数据库迁移，每个迁移在单独的事务中完成
+    """
+    current_version = db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"执行数据库迁移 v{version}: {description}")
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            migrate(db.cursor())
+            db.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception(f"数据库迁移 v{version} 失败")
+            raise
+
+def init_db():
+    """
+    初始化数据库：开启WAL模式、创建基础表并执行迁移
+    """
+    db = _open_db_connection()
+    try:
+        # WAL模式写入数据库文件，只需设置一次；读请求不再被写请求阻塞
+        db.execute("PRAGMA journal_mode = WAL")
+
+        # 创建sessions表（如果不存在）
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                folder_name TEXT NOT NULL,
+                folder_path TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 创建file_mapping表（如果不存在）
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS file_mapping (
+                id TEXT PRIMARY KEY,
+                real_name TEXT NOT NULL,
+                display_name TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                parent_path TEXT NOT NULL,
+                position INTEGER NOT NULL DEFAULT 0,
+                child_count INTEGER NOT NULL DEFAULT 0,
+                item_type TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 数据库结构版本迁移
+        # 每个迁移只执行一次，已执行的版本记录在schema_version表中。
+        # 后续的结构变更只需在SCHEMA_MIGRATIONS末尾追加新版本，服务启动时会自动执行。
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        run_schema_migrations(db)
+    finally:
+        db.close()
+
+init_db()
+
+def _detect_search_mode():
+    """
+    根据file_search的建表语句判断搜索方式：trigram、fts（unicode61分词）或like（普通表）
+    """
+    sql = get_db().execute("SELECT sql FROM sqlite_master WHERE name = 'file_search'").fetchone()[0].lower()
+    if 'trigram' in sql:
+        return 'trigram'
+    return 'fts' if 'fts5' in sql else 'like'
+
+SEARCH_MODE = _detect_search_mode()
 
 # 添加在文件开头的导入部分之后
 
-def import_folder_structure(folder_path):
+ResolvedPath = namedtuple('ResolvedPath', 'session_id folder_path item_id item_type rel_path')
+
+def add_closure_rows(db, item_id, parent_id):
+    """
+    为新插入的节点写入闭包表记录（自身以及所有祖先）
+    """
+    if parent_id != ROOT_PARENT_ID:
+        db.execute(
+            "INSERT INTO file_closure (ancestor_id, descendant_id, depth) SELECT ancestor_id, ?, depth + 1 FROM file_closure WHERE descendant_id = ?",
+            (item_id, parent_id)
+        )
+    db.execute(
+        "INSERT INTO file_closure (ancestor_id, descendant_id, depth) VALUES (?, ?, 0)",
+        (item_id, item_id)
+    )
+
+def insert_item(db, session_id, parent_id, item_id, real_name, display_name, position, item_type, child_count=0):
+    """
+    插入一个文件或文件夹节点，同时维护闭包表
+    """
+    db.execute(
+        "INSERT INTO file_mapping (id, session_id, parent_id, real_name, display_name, position, child_count, item_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (item_id, session_id, parent_id, real_name, display_name, position, child_count, item_type)
+    )
+    add_closure_rows(db, item_id, parent_id)
+
+def adjust_child_count(db, parent_id, delta):
+    """
+    更新父文件夹的子节点数量（会话根目录没有对应记录）
+    """
+    if parent_id != ROOT_PARENT_ID:
+        db.execute("UPDATE file_mapping SET child_count = child_count + ? WHERE id = ?", (delta, parent_id))
+
+def next_child_position(db, session_id, parent_id):
+    """
+    返回追加到文件夹末尾时使用的位置
+    """
+    return db.execute(
+        "SELECT COALESCE(MAX(position), 0) + ? FROM file_mapping WHERE session_id = ? AND parent_id = ?",
+        (POSITION_GAP, session_id, parent_id)
+    ).fetchone()[0]
+
+def renumber_positions(db, session_id, parent_id):
+    """
+    间隔用完时把一个文件夹的子项重新按POSITION_GAP编号
+    """
+    db.execute(RENUMBER_POSITIONS_SQL, (POSITION_GAP, session_id, parent_id))
+
+def position_next_to(db, session_id, parent_id, target_id, exclude_id, after):
+    """
+    计算紧挨在目标项目之后（after=True）或之前的位置，只读取目标及其一个相邻项目
+    :param exclude_id: 被移动的项目本身，不作为相邻项目
+    :return: 新位置，目标不存在时返回None
+    """
+    for _ in range(2):
+        row = db.execute(
+            "SELECT position FROM file_mapping WHERE id = ? AND session_id = ? AND parent_id = ?",
+            (target_id, session_id, parent_id)
+        ).fetchone()
+        if not row:
+            return None
+        target_position = row[0]
+
+        if after:
+            neighbor = db.execute(
+                "SELECT MIN(position) FROM file_mapping WHERE session_id = ? AND parent_id = ? AND position > ? AND id != ?",
+                (session_id, parent_id, target_position, exclude_id)
+            ).fetchone()[0]
+            if neighbor is None:
+                return target_position + POSITION_GAP
+        else:
+            neighbor = db.execute(
+                "SELECT MAX(position) FROM file_mapping WHERE session_id = ? AND parent_id = ? AND position < ? AND id != ?",
+                (session_id, parent_id, target_position, exclude_id)
+            ).fetchone()[0]
+            if neighbor is None:
+                return target_position - POSITION_GAP
+
+        if abs(neighbor - target_position) > 1:
+            return (neighbor + target_position) // 2
+
+        # 相邻位置之间已没有空隙，重新编号后再计算一次
+        renumber_positions(db, session_id, parent_id)
+    raise RuntimeError('重新编号后仍无法计算位置')
+
+def delete_subtree(db, item_id):
+    """
+    删除一个节点及其所有后代（包括全文索引、图片引用和修订历史）
+    """
+    delete_revisions(db, "item_id IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)", (item_id,))
+    db.execute(
+        "DELETE FROM image_refs WHERE item_id IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)",
+        (item_id,)
+    )
+    db.execute(
+        "DELETE FROM file_search WHERE rowid IN (SELECT d.id FROM search_docs d JOIN file_closure c ON c.descendant_id = d.item_id WHERE c.ancestor_id = ?)",
+        (item_id,)
+    )
+    db.execute(
+        "DELETE FROM search_docs WHERE item_id IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)",
+        (item_id,)
+    )
+    db.execute(
+        "DELETE FROM file_mapping WHERE id IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)",
+        (item_id,)
+    )
+    db.execute(
+        "DELETE FROM file_closure WHERE descendant_id IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)",
+        (item_id,)
+    )
+
+def delete_session_items(db, session_id):
+    """
+    删除一个会话的全部节点（包括全文索引、图片引用和修订历史）
+    """
+    delete_revisions(db, "session_id = ?", (session_id,))
+    db.execute("DELETE FROM image_refs WHERE session_id = ?", (session_id,))
+    # 重新导入时在重建索引完成之前不能回收图片
+    db.execute("UPDATE sessions SET image_refs_complete = 0 WHERE session_id = ?", (session_id,))
+    db.execute(
+        "DELETE FROM file_search WHERE rowid IN (SELECT id FROM search_docs WHERE session_id = ?)",
+        (session_id,)
+    )
+    db.execute("DELETE FROM search_docs WHERE session_id = ?", (session_id,))
+    db.execute(
+        "DELETE FROM file_closure WHERE descendant_id IN (SELECT id FROM file_mapping WHERE session_id = ?)",
+        (session_id,)
+    )
+    db.execute("DELETE FROM file_mapping WHERE session_id = ?", (session_id,))
+
+def index_search_document(db, item_id, session_id, title, content, etag=None):
+    """
+    写入或替换一个文件的全文索引，同时刷新该文件的图片引用
+    :param etag: 被索引内容的版本，重建索引时版本相同的文件跳过
+    """
+    update_image_refs(db, item_id, session_id, content)
+    row = db.execute("SELECT id FROM search_docs WHERE item_id = ?", (item_id,)).fetchone()
+    if row:
+        doc_id = row[0]
+        db.execute("DELETE FROM file_search WHERE rowid = ?", (doc_id,))
+        db.execute("UPDATE search_docs SET session_id = ?, etag = ? WHERE id = ?", (session_id, etag, doc_id))
+    else:
+        doc_id = db.execute(
+            "INSERT INTO search_docs (item_id, session_id, etag) VALUES (?, ?, ?)",
+            (item_id, session_id, etag)
+        ).lastrowid
+    db.execute("INSERT INTO file_search (rowid, title, content) VALUES (?, ?, ?)", (doc_id, title, content))
+
+# 文件内容中出现的每个 /api/get-image/<文件名> 都记为引用，不区分行内图片、引用式图片的定义、普通链接或HTML；
+# 回收图片时宁可多保留（如代码块中的示例地址），也不能删除仍在使用的图片
+IMAGE_URL_REF_PATTERN = re.compile(r'/api/get-image/([^\s/?#()\[\]<>"\'`]+)')
+
+def update_image_refs(db, item_id, session_id, content):
+    """
+    按文件内容重新记录该文件引用的PIC_FOLDER图片
+    """
+    filenames = {unquote(match.group(1)) for match in IMAGE_URL_REF_PATTERN.finditer(content)}
+    db.execute("DELETE FROM image_refs WHERE item_id = ?", (item_id,))
+    db.executemany(
+        "INSERT INTO image_refs (filename, item_id, session_id) VALUES (?, ?, ?)",
+        [(filename, item_id, session_id) for filename in filenames]
+    )
+
+def rename_search_document(db, item_id, title):
+    """
+    文件改名后更新索引中的标题
+    """
+    db.execute(
+        "UPDATE file_search SET title = ? WHERE rowid = (SELECT id FROM search_docs WHERE item_id = ?)",
+        (title, item_id)
+    )
+
+def move_subtree(db, item_id, new_parent_id):
+    """
+    将一个节点（连同其子树）移动到新的父节点下
+    只改写子树与原祖先之间的闭包记录，子树内部的记录保持不变
+    """
+    db.execute(
+        """
+        DELETE FROM file_closure
+        WHERE descendant_id IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)
+          AND ancestor_id NOT IN (SELECT descendant_id FROM file_closure WHERE ancestor_id = ?)
+        """,
+        (item_id, item_id)
+    )
+    if new_parent_id != ROOT_PARENT_ID:
+        db.execute(
+            """
+            INSERT INTO file_closure (ancestor_id, descendant_id, depth)
+            SELECT super.ancestor_id, sub.descendant_id, super.depth + sub.depth + 1
+            FROM file_closure super, file_closure sub
+            WHERE super.descendant_id = ? AND sub.ancestor_id = ?
+            """,
+            (new_parent_id, item_id)
+        )
+    db.execute("UPDATE file_mapping SET parent_id = ? WHERE id = ?", (new_parent_id, item_id))
+
+def find_session_by_path(db, path):
+    """
+    查找包含指定路径的会话
+    :return: (session_id, folder_path)，路径不属于任何会话时返回None
+    """
+    normalized_path = os.path.abspath(path)
+    candidates = []
+    current = normalized_path
+    while True:
+        candidates.append(current)
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    placeholders = ','.join('?' * len(candidates))
+    rows = db.execute(
+        f"SELECT session_id, folder_path FROM sessions WHERE folder_path IN ({placeholders})",
+        candidates
+    ).fetchall()
+    if not rows:
+        return None
+    # 嵌套时取最深的会话文件夹
+    return max(rows, key=lambda row: len(row[1]))
+
+def resolve_item_path(db, path):
+    """
+    将前端传入的磁盘路径解析为会话内的节点
+    :return: ResolvedPath；会话根目录的item_id为ROOT_PARENT_ID、item_type为'folder'；
+             路径不属于任何会话或数据库中没有对应节点时返回None
+    """
+    session = find_session_by_path(db, path)
+    if not session:
+        return None
+    session_id, folder_path = session
+    rel_path = os.path.relpath(os.path.abspath(path), folder_path)
+    if rel_path == '.':
+        return ResolvedPath(session_id, folder_path, ROOT_PARENT_ID, 'folder', '')
+
+    # 逐级按(父节点, 真实名称)查找，每一级都是一次索引查询
+    item_id, item_type = ROOT_PARENT_ID, 'folder'
+    parts = rel_path.split(os.sep)
+    for part in parts:
+        row = db.execute(
+            "SELECT id, item_type FROM file_mapping WHERE session_id = ? AND parent_id = ? AND real_name = ?",
+            (session_id, item_id, part)
+        ).fetchone()
+        if not row:
+            return None
+        item_id, item_type = row
+    return ResolvedPath(session_id, folder_path, item_id, item_type, '/'.join(parts))
+
+def item_disk_path(folder_path, rel_path):
+    """
+    由会话文件夹和相对路径得到磁盘路径
+    """
+    if not rel_path:
+        return folder_path
+    return os.path.join(folder_path, *rel_path.split('/'))
+
+def item_disk_paths(db, ids, item_type=None):
+    """
+    一次查询取回多个节点的祖先链，拼出磁盘路径
+    :param item_type: 只返回该类型的节点
+    :return: {id: (display_name, 磁盘路径)}，不存在的节点不在结果中
+    """
+    if not ids:
+        return {}
+    placeholders = ','.join('?' * len(ids))
+    rows = db.execute(
+        f"SELECT f.id, f.display_name, f.item_type, s.folder_path FROM file_mapping f JOIN sessions s ON s.session_id = f.session_id "
+        f"WHERE f.id IN ({placeholders})",
+        ids
+    ).fetchall()
+    names = {}
+    for descendant_id, real_name in db.execute(
+        f"SELECT c.descendant_id, f.real_name FROM file_closure c JOIN file_mapping f ON f.id = c.ancestor_id "
+        f"WHERE c.descendant_id IN ({placeholders}) ORDER BY c.descendant_id, c.depth DESC",
+        ids
+    ):
+        names.setdefault(descendant_id, []).append(real_name)
+    return {
+        item_id: (display_name, os.path.join(folder_path, *names[item_id]))
+        for item_id, display_name, row_type, folder_path in rows
+        if item_type is None or row_type == item_type
+    }
+
+def get_item_location(db, item_id):
+    """
+    根据节点ID获取其所在会话和相对路径
+    :return: (session_id, folder_path, rel_path, item_type)，节点不存在时返回None
+    """
+    row = db.execute(
+        "SELECT f.session_id, s.folder_path, f.item_type FROM file_mapping f JOIN sessions s ON s.session_id = f.session_id WHERE f.id = ?",
+        (item_id,)
+    ).fetchone()
+    if not row:
+        return None
+    names = db.execute(
+        "SELECT f.real_name FROM file_closure c JOIN file_mapping f ON f.id = c.ancestor_id WHERE c.descendant_id = ? ORDER BY c.depth DESC",
+        (item_id,)
+    ).fetchall()
+    return row[0], row[1], '/'.join(name[0] for name in names), row[2]
+
+def fetch_subtree(db, session_id, parent_id=ROOT_PARENT_ID, base_rel_path=''):
+    """
+    一次查询取回某个文件夹下的整棵子树
+    :return: [(id, parent_id, display_name, rel_path, item_type)]，同级节点按position排序
+    """
+    prefix = base_rel_path + '/' if base_rel_path else ''
+    return db.execute(
+        """
+        WITH RECURSIVE subtree(id, parent_id, display_name, rel_path, item_type, position, seq) AS (
+            SELECT id, parent_id, display_name, ? || real_name, item_type, position, rowid
+            FROM file_mapping WHERE session_id = ? AND parent_id = ?
+            UNION ALL
+            SELECT f.id, f.parent_id, f.display_name, s.rel_path || '/' || f.real_name, f.item_type, f.position, f.rowid
+            FROM subtree s JOIN file_mapping f ON f.session_id = ? AND f.parent_id = s.id
+            WHERE s.item_type = 'folder'
+        )
+        SELECT id, parent_id, display_name, rel_path, item_type FROM subtree ORDER BY position, seq
+        """,
+        (prefix, session_id, parent_id, session_id)
+    ).fetchall()
+
+def make_tree_node(item_id, name, item_type, file_path):
+    """
+    构建文件树中的一个节点，文件夹节点带有children列表
+    """
+    node = {
+        'id': item_id,
+        'name': name,
+        'type': item_type,
+        'filePath': file_path
+    }
+    if item_type == 'folder':
+        node['children'] = []
+    return node
+
+class _CachedTree:
+    """
+    一个会话的缓存文件树
+    nodes: 节点ID -> 节点，parents: 节点ID -> 父节点ID，rendered: 序列化后的响应体（修改后置为None）
+    """
+    def __init__(self, folder_path, structure):
+        self.folder_path = folder_path
+        self.structure = structure
+        self.nodes = {}
+        self.parents = {}
+        self.rendered = None
+        for node in structure:
+            self._index(node, ROOT_PARENT_ID)
+
+    def _index(self, node, parent_id):
+        self.nodes[node['id']] = node
+        self.parents[node['id']] = parent_id
+        for child in node.get('children', ()):
+            self._index(child, node['id'])
+
+    def _unindex(self, node):
+        self.nodes.pop(node['id'], None)
+        self.parents.pop(node['id'], None)
+        for child in node.get('children', ()):
+            self._unindex(child)
+
+    def children_of(self, parent_id):
+        if parent_id == ROOT_PARENT_ID:
+            return self.structure
+        return self.nodes[parent_id]['children']
+
+    def add(self, parent_id, node):
+        self.children_of(parent_id).append(node)
+        self._index(node, parent_id)
+
+    def remove(self, item_id):
+        node = self.nodes[item_id]
+        self.children_of(self.parents[item_id]).remove(node)
+        self._unindex(node)
+        return node
+
+    def place(self, item_id, parent_id, target_id=None, after=True):
+        """
+        把节点移到parent_id下目标节点之前/之后，target_id为None时放到最后
+        """
+        node = self.nodes[item_id]
+        self.children_of(self.parents[item_id]).remove(node)
+        siblings = self.children_of(parent_id)
+        if target_id is None:
+            siblings.append(node)
+        else:
+            index = siblings.index(self.nodes[target_id])
+            siblings.insert(index + 1 if after else index, node)
+        self.parents[item_id] = parent_id
+
+    def set_path(self, item_id, file_path):
+        """
+        修改节点路径，同时替换所有后代路径的前缀
+        """
+        node = self.nodes[item_id]
+        old_prefix = node['filePath']
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            current['filePath'] = file_path + current['filePath'][len(old_prefix):]
+            stack.extend(current.get('children', ()))
+
+class TreeCache:
+    """
+    会话文件树的进程内缓存
+    写操作在事务提交后原地更新缓存并递增会话的修订号，修订号用作ETag；
+    按LRU淘汰不活跃的会话，缓存的节点总数不超过max_nodes
+    """
+    def __init__(self, max_nodes):
+        self.max_nodes = max_nodes
+        # 进程启动标识，保证重启后旧的ETag不会误命中
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._revisions = {}
+        self._next_revision = 1
+        self._node_count = 0
+
+    def revision(self, session_id):
+        with self._lock:
+            return self._revisions.get(session_id, 0)
+
+    def etag(self, session_id, revision):
+        return f"{self.epoch}-{session_id}-{revision}"
+
+    def get(self, session_id):
+        """
+        :return: (修订号, 文件夹路径, 响应体)，未缓存时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(session_id)
+            return self._revisions.get(session_id, 0), entry.folder_path, self._render(entry)
+
+    def store(self, session_id, revision, folder_path, structure):
+        """
+        缓存从数据库构建的文件树；构建期间会话被修改过（修订号变化）时不缓存
+        :return: 响应体
+        """
+        entry = _CachedTree(folder_path, structure)
+        with self._lock:
+            if self._revisions.get(session_id, 0) != revision or len(entry.nodes) > self.max_nodes:
+                return self._render(entry)
+            self._drop(session_id)
+            self._entries[session_id] = entry
+            self._node_count += len(entry.nodes)
+            self._evict()
+            return self._render(entry)
+
+    def update(self, session_id, apply):
+        """
+        递增修订号并对已缓存的文件树执行apply(entry)；更新失败时丢弃该会话的缓存
+        """
+        with self._lock:
+            self._bump(session_id)
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            try:
+                before = len(entry.nodes)
+                apply(entry)
+                entry.rendered = None
+                self._node_count += len(entry.nodes) - before
+                self._evict()
+            except Exception as e:
+                logger.warning(f"更新文件树缓存失败，丢弃会话 {session_id} 的缓存: {e}")
+                self._drop(session_id)
+
+    def invalidate(self, session_id):
+        """
+        会话被整体修改（重新导入、改名、删除）时丢弃缓存
+        """
+        with self._lock:
+            self._bump(session_id)
+            self._drop(session_id)
+
+    def _bump(self, session_id):
+        self._revisions[session_id] = self._next_revision
+        self._next_revision += 1
+
+    def _drop(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._node_count -= len(entry.nodes)
+
+    def _evict(self):
+        while self._node_count > self.max_nodes and self._entries:
+            session_id, entry = self._entries.popitem(last=False)
+            self._node_count -= len(entry.nodes)
+
+    def _render(self, entry):
+        if entry.rendered is None:
+            entry.rendered = app.json.dumps({
+                'structure': entry.structure,
+                'folderPath': entry.folder_path
+            })
+        return entry.rendered
+
+tree_cache = TreeCache(TREE_CACHE_MAX_NODES)
+
+# 导入时收集的一个节点，ancestors为从顶层到父节点的祖先ID
+ImportEntry = namedtuple('ImportEntry', 'item_id parent_id dir_path file_name real_name position item_type ancestors')
+
+def import_folder_structure(folder_path, session_id, parallel=None, progress=None):
     """
     批量导入文件夹结构到file_mapping表
+    分为扫描、重命名、写库三个阶段，所有记录在一个事务中用executemany写入
     :param folder_path: 要导入的文件夹路径
+    :param session_id: 文件夹所属的会话ID
+    :param parallel: 是否并行遍历顶层子文件夹，为None时根据IMPORT_WORKERS决定
+    :param progress: 可选的进度回调 progress(stage, done, total)
     """
+    renamed = []
     try:
         # 标准化路径
         normalized_folder_path = os.path.abspath(folder_path)
-        
-        # 首先删除该文件夹在数据库中的所有映射
-        cursor.execute("DELETE FROM file_mapping WHERE file_path LIKE ?", (normalized_folder_path + '%',))
-        conn.commit()
-        
-        # 递归导入文件夹结构，但不导入根文件夹本身
-        # 将根文件夹路径作为父路径传递，确保一级文件（夹）的父路径不为空
-        _import_folder_recursive(normalized_folder_path, normalized_folder_path)
-        
+        started = time.time()
+
+        # 扫描文件夹结构，不导入根文件夹本身
+        entries, child_counts = scan_folder_tree(normalized_folder_path, parallel, progress)
+
+        # 批量重命名md文件
+        renamed, failed_ids = _apply_import_renames(entries, progress)
+
+        mapping_rows = []
+        closure_rows = []
+        for entry in entries:
+            real_name = entry.file_name if entry.item_id in failed_ids else entry.real_name
+            mapping_rows.append((
+                entry.item_id, session_id, entry.parent_id, real_name, entry.file_name,
+                entry.position, child_counts.get(entry.item_id, 0), entry.item_type
+            ))
+            closure_rows.append((entry.item_id, entry.item_id, 0))
+            closure_rows.extend(
+                (ancestor_id, entry.item_id, depth)
+                for depth, ancestor_id in enumerate(reversed(entry.ancestors), start=1)
+            )
+
+        with transaction() as db:
+            # 首先删除该会话在数据库中的所有映射
+            delete_session_items(db, session_id)
+            after_commit(lambda: tree_cache.invalidate(session_id))
+            db.executemany(
+                "INSERT INTO file_mapping (id, session_id, parent_id, real_name, display_name, position, child_count, item_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                mapping_rows
+            )
+            db.executemany(
+                "INSERT INTO file_closure (ancestor_id, descendant_id, depth) VALUES (?, ?, ?)",
+                closure_rows
+            )
+
+        logger.info(f"导入文件夹结构完成: {normalized_folder_path}，共 {len(entries)} 项，重命名 {len(renamed)} 个文件，耗时 {time.time() - started:.2f}s")
+
+        # 导入通常在open_website_session的写事务中执行，提交后再在后台任务中为导入的文件建立全文索引，
+        # 不在写锁内读取所有文件（失败时不影响导入，会话的图片引用保持未完成，之后可以重建）
+        def submit_rebuild():
+            try:
+                job_manager.submit(SEARCH_REBUILD_COMMAND, session_id, {'session_id': session_id})
+            except Exception:
+                logger.exception(f"提交全文索引任务失败: {normalized_folder_path}")
+        after_commit(submit_rebuild)
         return True, "文件夹结构导入成功"
     except Exception as e:
         print(f"导入文件夹结构时出错: {e}")
+        # 写库失败时把已重命名的文件改回原名
+        _undo_import_renames(renamed)
         return False, str(e)
 
-def _import_folder_recursive(folder_path, parent_path):
+def scan_folder_tree(folder_path, parallel=None, progress=None):
     """
-    递归导入文件夹内容
+    使用os.scandir扫描整个文件夹，返回(节点列表, {文件夹ID: 子节点数量})
+    并行模式下每个顶层子文件夹由一个线程遍历，结果按原顺序合并
     """
-    try:
-        items = os.listdir(folder_path)
-        md_files = []
-        folders = []
-        
-        # 分离文件和文件夹
-        for item in items:
-            if item == '_book' or item == 'node_modules':
+    entries, child_counts, subfolders = _scan_import_level(folder_path, ROOT_PARENT_ID, ())
+
+    if parallel is None:
+        parallel = IMPORT_WORKERS > 1 and len(subfolders) > 1
+
+    if parallel:
+        with ThreadPoolExecutor(max_workers=max(IMPORT_WORKERS, 1)) as executor:
+            results = list(executor.map(lambda args: _walk_import_tree(*args), subfolders))
+    else:
+        results = [_walk_import_tree(*args) for args in subfolders]
+
+    for sub_entries, sub_child_counts in results:
+        entries.extend(sub_entries)
+        child_counts.update(sub_child_counts)
+    _report_import_progress(progress, 'scan', len(entries), len(entries))
+
+    return entries, child_counts
+
+def _scan_import_level(dir_path, parent_id, ancestors):
+    """
+    扫描一层目录，文件夹排在md文件之前
+    :return: (本层节点列表, {parent_id: 子节点数量}, 待遍历的子文件夹参数列表)
+    """
+    folders = []
+    md_files = []
+    with os.scandir(dir_path) as it:
+        for item in it:
+            if item.name in IMPORT_SKIP_DIRS:
                 continue
-                
-            item_path = os.path.join(folder_path, item)
-            if os.path.isdir(item_path):
-                folders.append(item)
-            elif os.path.isfile(item_path) and item.endswith('.md'):
-                md_files.append(item)
-        
-        # 首先导入文件夹
-        for i, folder_name in enumerate(folders):
-            folder_path_full = os.path.join(folder_path, folder_name)
-            folder_id = str(uuid.uuid4())
-            
-            # 插入文件夹记录
-            cursor.execute(
-                "INSERT INTO file_mapping (id, real_name, display_name, file_path, parent_path, position, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (folder_id, folder_name, folder_name, folder_path_full, parent_path, i, 'folder')
-            )
-            
-            # 递归导入子文件夹
-            _import_folder_recursive(folder_path_full, folder_path_full)
-        
-        # 然后导入MD文件
-        for i, file_name in enumerate(md_files):
-            file_path_full = os.path.join(folder_path, file_name)
-            file_id = str(uuid.uuid4())
-            
-            # README.md和SUMMARY.md的真实名称和虚拟名称相同
-            if file_name in ['README.md', 'SUMMARY.md']:
-                real_name = file_name
-                display_name = file_name
-            else:
-                # 对于其他文件，使用UUID和时间戳生成真实名称
-                short_uuid = str(uuid.uuid4()).split('-')[0]
-                timestamp_suffix = str(int(time.time()))[-4:]
-                real_name = f"{short_uuid}_{timestamp_suffix}.md"
-                display_name = file_name
-            
-            # 插入文件记录
-            cursor.execute(
-                "INSERT INTO file_mapping (id, real_name, display_name, file_path, parent_path, position, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (file_id, real_name, display_name, file_path_full, folder_path, i, 'file')
-            )
-        
-            if real_name != file_name:
-                try:
-                    new_file_path = os.path.join(folder_path, real_name)
-                    os.rename(file_path_full, new_file_path)
-                    # 更新file_path_full为新的文件路径
-                    file_path_full = new_file_path
-                    # 更新数据库中的file_path
-                    cursor.execute(
-                        "UPDATE file_mapping SET file_path = ? WHERE id = ?",
-                        (file_path_full, file_id)
-                    )
-                except Exception as e:
-                    print(f"重命名文件 {file_path_full} 时出错: {e}")
-        # 更新父文件夹的子节点数量
-        if parent_path:
-            cursor.execute(
-                "UPDATE file_mapping SET child_count = ? WHERE file_path = ?",
-                (len(folders) + len(md_files), folder_path)
-            )
-        
-        conn.commit()
-    except Exception as e:
-        print(f"递归导入文件夹结构时出错: {e}")
-        raise
+            if item.is_dir():
+                folders.append(item.name)
+            elif item.is_file() and item.name.endswith('.md'):
+                md_files.append(item.name)
+
+    entries = []
+    subfolders = []
+    child_ancestors = ancestors + (parent_id,) if parent_id != ROOT_PARENT_ID else ancestors
+    for i, folder_name in enumerate(folders, start=1):
+        folder_id = str(uuid.uuid4())
+        entries.append(ImportEntry(folder_id, parent_id, dir_path, folder_name, folder_name, i * POSITION_GAP, 'folder', child_ancestors))
+        subfolders.append((os.path.join(dir_path, folder_name), folder_id, child_ancestors))
+
+    for i, file_name in enumerate(md_files, start=len(folders) + 1):
+        entries.append(ImportEntry(str(uuid.uuid4()), parent_id, dir_path, file_name, _generate_real_name(file_name), i * POSITION_GAP, 'file', child_ancestors))
+
+    return entries, {parent_id: len(entries)}, subfolders
+
+def _walk_import_tree(dir_path, parent_id, ancestors):
+    """
+    深度优先遍历一个子文件夹（使用显式栈，避免深层目录的递归限制）
+    """
+    entries = []
+    child_counts = {}
+    stack = [(dir_path, parent_id, ancestors)]
+    while stack:
+        level_entries, level_counts, subfolders = _scan_import_level(*stack.pop())
+        entries.extend(level_entries)
+        child_counts.update(level_counts)
+        stack.extend(reversed(subfolders))
+    return entries, child_counts
+
+def _generate_real_name(file_name):
+    """
+    README.md和SUMMARY.md的真实名称和虚拟名称相同，其他文件使用UUID和时间戳生成真实名称
+    """
+    if file_name in ['README.md', 'SUMMARY.md']:
+        return file_name
+    short_uuid = str(uuid.uuid4()).split('-')[0]
+    timestamp_suffix = str(int(time.time()))[-4:]
+    return f"{short_uuid}_{timestamp_suffix}.md"
+
+def _apply_import_renames(entries, progress=None):
+    """
+    批量把md文件重命名为真实名称
+    :return: (已完成的(原路径, 新路径)列表, 重命名失败的节点ID集合)
+    """
+    pending = [entry for entry in entries if entry.real_name != entry.file_name]
+    renamed = []
+    failed_ids = set()
+    for done, entry in enumerate(pending, start=1):
+        src = os.path.join(entry.dir_path, entry.file_name)
+        dst = os.path.join(entry.dir_path, entry.real_name)
+        try:
+            os.rename(src, dst)
+            renamed.append((src, dst))
+        except Exception as e:
+            print(f"重命名文件 {src} 时出错: {e}")
+            failed_ids.add(entry.item_id)
+        _report_import_progress(progress, 'rename', done, len(pending))
+    return renamed, failed_ids
+
+def _undo_import_renames(renamed):
+    """
+    撤销导入过程中的重命名
+    """
+    for src, dst in reversed(renamed):
+        try:
+            os.rename(dst, src)
+        except Exception as e:
+            print(f"恢复文件 {src} 时出错: {e}")
+
+def _report_import_progress(progress, stage, done, total):
+    """
+    按IMPORT_PROGRESS_INTERVAL记录导入进度，并调用进度回调
+    """
+    if done % IMPORT_PROGRESS_INTERVAL == 0 or done == total:
+        logger.info(f"导入文件夹结构 [{stage}]: {done}" + (f"/{total}" if total else ""))
+    if progress:
+        progress(stage, done, total)
 
 # 首先，添加一个辅助函数来检查指定文件夹中是否已有相同的显示文件名
-def check_display_name_duplicate(folder_path, display_name):
+def check_display_name_duplicate(session_id, parent_id, display_name, exclude_id=None):
     """
     检查指定文件夹中是否已有相同的显示文件名
+    :param exclude_id: 重命名时排除节点自身
     """
     try:
-        # 标准化路径
-        normalized_folder_path = os.path.abspath(folder_path)
-        
         # 查询数据库，检查是否有相同的显示文件名
-        cursor.execute(
-            "SELECT COUNT(*) FROM file_mapping WHERE display_name = ? AND parent_path = ?",
-            (display_name, normalized_folder_path)
-        )
-        count = cursor.fetchone()[0]
+        row = get_db().execute(
+            "SELECT id FROM file_mapping WHERE session_id = ? AND parent_id = ? AND display_name = ?",
+            (session_id, parent_id, display_name)
+        ).fetchone()
         
-        return count > 0
+        return row is not None and row[0] != exclude_id
     except Exception as e:
         print(f"检查显示文件名重复时出错: {e}")
         return False
 
-def run_gitbook_command(command, cwd=None):
-    """运行 GitBook 命令的辅助函数"""
+class ApiError(Exception):
+    """
+    文件树操作的业务错误，message直接返回给前端
+    :param status: HTTP状态码
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+class FileSystemPlan:
+    """
+    按顺序执行的一组磁盘操作，每一步都登记撤销方法
+    文件树操作先在事务中修改数据库并登记磁盘操作，提交前统一执行；
+    任意一步失败时按相反顺序撤销已完成的步骤，事务随之回滚
+    删除先把文件改名为同目录下的临时名称，提交后才真正删除，因此也可以撤销
+    同一批操作中后面的操作通过exists/isfile检查磁盘，结果包含前面已登记但尚未执行的修改
+    """
+    def __init__(self):
+        self.actions = []
+        self.cleanups = []
+        self.label = None
+        self.failed_label = None
+        self._undo = []
+        # 尚未执行的磁盘修改：('create', 路径, 'file'/'folder')、('remove', 路径)、('rename', 原路径, 新路径)
+        self._changes = []
+
+    def add(self, do, undo, cleanup=None):
+        self.actions.append((self.label, do, undo, cleanup))
+
+    def _kind(self, path):
+        """
+        返回登记的修改全部执行后path的类型：'file'、'folder'，不存在时返回None
+        """
+        path = os.path.abspath(path)
+        for change in reversed(self._changes):
+            if change[0] == 'create':
+                if path == change[1]:
+                    return change[2]
+            elif change[0] == 'remove':
+                if _path_under(path, change[1]):
+                    return None
+            elif _path_under(path, change[2]):
+                # 改名后的路径在改名前位于原路径下
+                path = change[1] + path[len(change[2]):]
+            elif _path_under(path, change[1]):
+                return None
+        if os.path.isdir(path):
+            return 'folder'
+        return 'file' if os.path.exists(path) else None
+
+    def exists(self, path):
+        return self._kind(path) is not None
+
+    def isfile(self, path):
+        return self._kind(path) == 'file'
+
+    def create_file(self, path):
+        def do():
+            with open(path, 'x', encoding='utf-8'):
+                pass
+        self.add(do, lambda: os.remove(path))
+        self._changes.append(('create', os.path.abspath(path), 'file'))
+
+    def create_folder(self, path, readme_path):
+        def do():
+            os.makedirs(path, exist_ok=True, mode=0o777)
+            os.chmod(path, 0o777)
+            # 自动创建README.md文件
+            with open(readme_path, 'w', encoding='utf-8'):
+                pass
+        self.add(do, lambda: shutil.rmtree(path))
+        self._changes.append(('create', os.path.abspath(path), 'folder'))
+        self._changes.append(('create', os.path.abspath(readme_path), 'file'))
+
+    def rename(self, src, dst):
+        self.add(lambda: os.rename(src, dst), lambda: os.rename(dst, src))
+        self._changes.append(('rename', os.path.abspath(src), os.path.abspath(dst)))
+
+    def remove(self, path):
+        trash_path = os.path.join(os.path.dirname(path), f'.deleted-{uuid.uuid4().hex}')
+        def cleanup():
+            if os.path.isdir(trash_path):
+                shutil.rmtree(trash_path)
+            else:
+                os.remove(trash_path)
+        self.add(lambda: os.rename(path, trash_path), lambda: os.rename(trash_path, path), cleanup)
+        self._changes.append(('remove', os.path.abspath(path)))
+
+    def run(self):
+        for label, do, undo, cleanup in self.actions:
+            try:
+                do()
+            except BaseException:
+                self.failed_label = label
+                self.undo()
+                raise
+            self._undo.append(undo)
+            if cleanup:
+                self.cleanups.append(cleanup)
+        self.actions = []
+        self._changes = []
+
+    def undo(self):
+        while self._undo:
+            undo = self._undo.pop()
+            try:
+                undo()
+            except Exception:
+                logger.exception("撤销磁盘操作失败")
+        self.cleanups = []
+
+    def finish(self):
+        for cleanup in self.cleanups:
+            try:
+                cleanup()
+            except Exception:
+                logger.exception("清理已删除的文件失败")
+        self.cleanups = []
+
+@contextmanager
+def planned_transaction():
+    """
+    在一个写事务中修改数据库，提交前执行登记的磁盘操作
+    磁盘操作或提交失败时撤销磁盘修改并回滚事务
+    :yield: (db, FileSystemPlan)
+    """
+    plan = FileSystemPlan()
+    try:
+        with transaction() as db:
+            yield db, plan
+            plan.run()
+    except BaseException:
+        plan.undo()
+        raise
+    plan.finish()
+
+def run_gitbook_command(command, cwd=None, cancel_event=None):
+    """
+    运行 GitBook 命令的辅助函数
+    :param cancel_event: 可选的threading.Event，被设置时终止命令（用于取消后台任务）
+    """
     env = os.environ.copy()
     env['HOME'] = '/home/appuser'
     env['NODE_PATH'] = '/usr/local/lib/node_modules'
     
     try:
-        process = subprocess.run(
+        process = subprocess.Popen(
             ['gitbook'] + command.split(),
             cwd=cwd,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
             env=env,
-            timeout=300  # 5分钟超时
+            # 独立的进程组，终止时连同gitbook启动的子进程一起结束
+            start_new_session=True
         )
-        return process.returncode, process.stdout, process.stderr
-    except subprocess.TimeoutExpired:
-        return -1, "", "命令执行超时"
+        deadline = time.time() + GITBOOK_TIMEOUT
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=0.5)
+                return process.returncode, stdout, stderr
+            except subprocess.TimeoutExpired:
+                if cancel_event is not None and cancel_event.is_set():
+                    _kill_process_group(process)
+                    return -1, "", "任务已取消"
+                if time.time() > deadline:
+                    _kill_process_group(process)
+                    return -1, "", "命令执行超时"
     except Exception as e:
         return -1, "", str(e)
 
+def _kill_process_group(process):
+    """
+    终止进程及其所在进程组
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.kill()
+    process.communicate()
+
+class JobQueueFull(Exception):
+    """任务队列已满"""
+
+class JobManager:
+    """
+    后台任务管理：gitbook init/install/build/pdf等耗时命令在有界线程池中执行，请求立即返回任务ID
+    任务记录保存在jobs表中，状态依次为queued、running，最终为succeeded、failed或cancelled
+    """
+    def __init__(self, workers, queue_limit):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._queue_limit = queue_limit
+        self._lock = threading.Lock()
+        self._active = 0
+        self._cancel_events = {}
+        self._done_events = {}
+        self._handlers = {}
+
+    def register(self, kind):
+        """
+        注册任务处理函数 handler(params, cancel_event) -> result，出错时抛出异常
+        """
+        def decorator(handler):
+            self._handlers[kind] = handler
+            return handler
+        return decorator
+
+    def submit(self, kind, session_id, params):
+        """
+        创建任务并放入线程池（必须在事务之外调用，保证工作线程能读到任务记录）
+        :return: 任务ID
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if self._active >= self._queue_limit:
+                raise JobQueueFull('任务队列已满，请稍后再试')
+            self._active += 1
+            self._cancel_events[job_id] = threading.Event()
+            self._done_events[job_id] = threading.Event()
+        try:
+            with transaction() as db:
+                db.execute(
+                    "INSERT INTO jobs (id, kind, session_id, status, params) VALUES (?, ?, ?, 'queued', ?)",
+                    (job_id, kind, session_id, json.dumps(params))
+                )
+            self._executor.submit(self._run, job_id, kind, params)
+        except Exception:
+            self._release(job_id)
+            raise
+        logger.info(f"任务已创建: {kind} {job_id}")
+        return job_id
+
+    def get(self, job_id):
+        row = get_db().execute(
+            "SELECT id, kind, session_id, status, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            'jobId': row[0],
+            'kind': row[1],
+            'sessionId': row[2],
+            'status': row[3],
+            'result': json.loads(row[4]) if row[4] else None,
+            'error': row[5],
+            'createdAt': row[6],
+            'startedAt': row[7],
+            'finishedAt': row[8]
+        }
+
+    def wait(self, job_id, timeout=None):
+        """
+        阻塞等待任务结束，返回任务信息
+        """
+        with self._lock:
+            done = self._done_events.get(job_id)
+        if done is not None:
+            done.wait(timeout)
+        return self.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        取消任务：排队中的任务直接标记为cancelled，运行中的任务终止其gitbook进程
+        """
+        with transaction() as db:
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row:
+                return None
+            if row[0] == 'queued':
+                db.execute(
+                    "UPDATE jobs SET status = 'cancelled', error = '任务已取消', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    (job_id,)
+                )
+            elif row[0] == 'running':
+                db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        with self._lock:
+            cancel_event = self._cancel_events.get(job_id)
+        if cancel_event is not None and row[0] in ('queued', 'running'):
+            cancel_event.set()
+        return self.get(job_id)
+
+    def recover(self):
+        """
+        服务启动时处理上次遗留的任务：未完成的标记为失败，并清理过期的任务记录
+        """
+        with transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = '服务重启，任务中断', finished_at = CURRENT_TIMESTAMP WHERE status IN ('queued', 'running')"
+            )
+            db.execute(
+                "DELETE FROM jobs WHERE finished_at < datetime('now', ?)",
+                (f'-{JOB_RETENTION_DAYS} days',)
+            )
+
+    def _run(self, job_id, kind, params):
+        cancel_event = self._cancel_events[job_id]
+        try:
+            with transaction() as db:
+                # 排队期间已被取消的任务不再执行
+                started = db.execute(
+                    "UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'queued'",
+                    (job_id,)
+                ).rowcount
+            if not started:
+                return
+
+            try:
+                result = self._handlers[kind](params, cancel_event)
+            except Exception as e:
+                if cancel_event.is_set():
+                    self._finish(job_id, 'cancelled', error='任务已取消')
+                else:
+                    logger.exception(f"任务执行失败: {kind} {job_id}")
+                    self._finish(job_id, 'failed', error=str(e))
+            else:
+                self._finish(job_id, 'succeeded', result=result)
+        except Exception:
+            logger.exception(f"更新任务状态失败: {job_id}")
+        finally:
+            self._release(job_id)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, job_id)
+            )
+        logger.info(f"任务结束: {job_id} {status}")
+
+    def _release(self, job_id):
+        with self._lock:
+            self._active -= 1
+            self._cancel_events.pop(job_id, None)
+            done = self._done_events.pop(job_id, None)
+        if done is not None:
+            done.set()
+
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_LIMIT)
+
+def job_result_response(job):
+    """
+    返回已完成任务的结果，结果中带有file_path时直接发送文件
+    """
+    result = job['result'] or {}
+    if 'file_path' in result:
+        return send_file(
+            result['file_path'],
+            as_attachment=True,
+            download_name=result.get('download_name'),
+            mimetype=result.get('mimetype')
+        )
+    return jsonify(result)
+
+def wait_for_job_response(job_id):
+    """
+    兼容旧的阻塞调用：等待任务结束后按原来的格式返回结果
+    """
+    job = job_manager.wait(job_id)
+    if job['status'] != 'succeeded':
+        return jsonify({'success': False, 'error': job['error']}), 500
+    return job_result_response(job)
+
+# 查询任务状态API
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job)
+
+# 获取任务结果API
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    if job['status'] != 'succeeded':
+        return jsonify({'error': job['error'] or '任务尚未完成', 'status': job['status']}), 409
+    try:
+        return job_result_response(job)
+    except FileNotFoundError:
+        return jsonify({'error': '任务结果文件不存在'}), 404
+
+# 取消任务API
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job)
+
 # 新增：重新排序文件/文件夹的API
-@app.route('/api/reorder-items', methods=['POST'])
-def reorder_items():
-    data = request.json
-    parent_folder_path = data.get('parentFolderPath')
-    dragged_id = data.get('draggedId')
-    target_id = data.get('targetId')
-    target_index = data.get('targetIndex')
+def reorder_items_op(db, plan, params):
+    """
+    把同一文件夹中的项目拖到另一个项目的位置，只修改数据库
+    :param params: parentFolderPath, draggedId, targetId
+    """
+    parent_folder_path = params.get('parentFolderPath')
+    dragged_id = params.get('draggedId')
+    target_id = params.get('targetId')
 
     if not all([parent_folder_path, dragged_id, target_id]):
-        return jsonify({'error': '缺少必要参数'}), 400
+        raise ApiError('缺少必要参数')
+
+    # 解析父文件夹
+    parent = resolve_item_path(db, parent_folder_path)
+    if not parent or parent.item_type != 'folder':
+        raise ApiError('父文件夹不存在', 404)
+
+    # 如果拖动的是自己，不处理
+    if dragged_id == target_id:
+        return {'success': True}
+
+    rows = db.execute(
+        "SELECT id, position, rowid FROM file_mapping WHERE id IN (?, ?) AND session_id = ? AND parent_id = ?",
+        (dragged_id, target_id, parent.session_id, parent.item_id)
+    ).fetchall()
+    keys = {row[0]: (row[1], row[2]) for row in rows}
+
+    # 检查拖动和目标项目是否存在
+    if dragged_id not in keys or target_id not in keys:
+        raise ApiError('拖动或目标项目不存在', 404)
+
+    # 向下移动时放到目标之后，向上移动时放到目标之前（targetIndex仅为兼容旧前端保留）
+    moving_down = keys[dragged_id] < keys[target_id]
+    new_position = position_next_to(
+        db, parent.session_id, parent.item_id, target_id, dragged_id, after=moving_down
+    )
+
+    # 只更新拖动项目的位置
+    db.execute(
+        "UPDATE file_mapping SET position = ? WHERE id = ?",
+        (new_position, dragged_id)
+    )
+
+    after_commit(lambda: tree_cache.update(
+        parent.session_id,
+        lambda tree: tree.place(dragged_id, parent.item_id, target_id, after=moving_down)
+    ))
+    return {'success': True}
 
+@app.route('/api/reorder-items', methods=['POST'])
+def reorder_items():
     try:
-        # 标准化路径
-        normalized_parent_path = os.path.abspath(parent_folder_path)
-        
-        # 获取当前父文件夹下的所有项目
-        cursor.execute(
-            "SELECT id, position FROM file_mapping WHERE parent_path = ? ORDER BY position",
-            (normalized_parent_path,)
-        )
-        items = cursor.fetchall()
-        
-        # 构建ID到位置的映射
-        id_to_position = {item[0]: item[1] for item in items}
-        
-        # 检查拖动和目标项目是否存在
-        if dragged_id not in id_to_position or target_id not in id_to_position:
-            return jsonify({'error': '拖动或目标项目不存在'}), 404
-        
-        # 如果拖动的是自己，不处理
-        if dragged_id == target_id:
-            return jsonify({'success': True})
-        
-        # 获取拖动项目的当前位置
-        dragged_position = id_to_position[dragged_id]
-        
-        # 计算新的位置
-        new_position = target_index
-        
-        # 调整其他项目的位置
-        if dragged_position < new_position:
-            # 向下移动，中间的项目位置减1
-            for item_id, pos in id_to_position.items():
-                if pos > dragged_position and pos <= new_position and item_id != dragged_id:
-                    cursor.execute(
-                        "UPDATE file_mapping SET position = position - 1 WHERE id = ?",
-                        (item_id,)
-                    )
-        else:
-            # 向上移动，中间的项目位置加1
-            for item_id, pos in id_to_position.items():
-                if pos >= new_position and pos < dragged_position and item_id != dragged_id:
-                    cursor.execute(
-                        "UPDATE file_mapping SET position = position + 1 WHERE id = ?",
-                        (item_id,)
-                    )
-        
-        # 更新拖动项目的位置
-        cursor.execute(
-            "UPDATE file_mapping SET position = ? WHERE id = ?",
-            (new_position, dragged_id)
-        )
-        
-        conn.commit()
-        return jsonify({'success': True})
+        with planned_transaction() as (db, plan):
+            result = reorder_items_op(db, plan, request.json)
+        return jsonify(result)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
     except Exception as e:
         print(f"重新排序项目时出错: {e}")
         return jsonify({'error': str(e)}), 500
 
+class ImageVariantCache:
+    """
+    图片缩略图的磁盘缓存：按宽度生成缩小的副本，总大小超过上限时按最久未使用的顺序删除
+    原图不比目标宽度大、动图或无法识别的图片不生成缩略图，直接使用原图
+    """
+
+    def __init__(self, folder, widths, max_bytes):
+        self.folder = folder
+        self.widths = widths
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # 缓存文件名 -> 字节数，按最近使用排序
+        self._total = 0
+        self._generate_locks = [threading.Lock() for _ in range(32)]
+        self._load()
+
+    def _load(self):
+        """
+        启动时按修改时间恢复缓存索引，删除上次未完成的临时文件
+        """
+        found = []
+        for entry in os.scandir(self.folder):
+            if entry.name.startswith('.'):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+
+    def pick_width(self, requested):
+        """
+        返回不小于requested的最小缩略图宽度，比所有宽度都大时返回None（使用原图）
+        """
+        for width in self.widths:
+            if width >= requested:
+                return width
+        return None
+
+    def _variant_name(self, filename, width):
+        stem, ext = os.path.splitext(filename)
+        return f'{stem}.w{width}{ext}'
+
+    def get(self, source_path, width):
+        """
+        返回缩略图路径，尚未生成时立即生成；不需要缩略图时返回None
+        :param source_path: 原图在磁盘上的路径（优化后的图片按实际保存的文件生成缩略图）
+        """
+        name = self._variant_name(os.path.basename(source_path), width)
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                return os.path.join(self.folder, name)
+        return self._generate(source_path, width)
+
+    def _generate(self, source_path, width):
+        name = self._variant_name(os.path.basename(source_path), width)
+        path = os.path.join(self.folder, name)
+        # 同一个缩略图只生成一次，并发请求等待生成完成
+        with self._generate_locks[hash(name) % len(self._generate_locks)]:
+            with self._lock:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                    return path
+            try:
+                original = Image.open(source_path)
+            except Image.UnidentifiedImageError:
+                return None
+            with original:
+                if original.width <= width or getattr(original, 'is_animated', False):
+                    return None
+                image_format = original.format
+                # 手机照片按EXIF方向旋转后再缩小，缩略图不保留EXIF
+                image = ImageOps.exif_transpose(original)
+                image.thumbnail((width, max(image.height * width // image.width, 1)))
+                fd, temp_path = tempfile.mkstemp(prefix='.', dir=self.folder)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        image.save(f, format=image_format)
+                    os.replace(temp_path, path)
+                except Exception:
+                    os.remove(temp_path)
+                    raise
+            self._add(name, os.path.getsize(path))
+            return path
+
+    def _add(self, name, size):
+        evicted = []
+        with self._lock:
+            self._total += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_name, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.folder, old_name))
+            except FileNotFoundError:
+                pass
+
+    def generate_all(self, source_path):
+        """
+        生成一张图片的全部缩略图
+        """
+        for width in self.widths:
+            try:
+                if self._generate(source_path, width) is None:
+                    # 原图不大于该宽度时，更大的宽度也不需要缩略图
+                    break
+            except Exception:
+                logger.exception(f"生成缩略图失败: {source_path} w={width}")
+                break
+
+    def discard(self, stored_filename):
+        """
+        删除一张图片的全部缩略图
+        :param stored_filename: 图片在PIC_FOLDER中实际保存的文件名
+        """
+        for width in self.widths:
+            name = self._variant_name(stored_filename, width)
+            with self._lock:
+                size = self._entries.pop(name, None)
+                if size is None:
+                    continue
+                self._total -= size
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+
+image_variants = ImageVariantCache(IMAGE_CACHE_FOLDER, IMAGE_VARIANT_WIDTHS, IMAGE_CACHE_MAX_BYTES)
+
+# 新图片的后台处理（优化、生成缩略图）在该线程池中执行
+image_executor = ThreadPoolExecutor(max_workers=max(IMAGE_VARIANT_WORKERS, 1), thread_name_prefix='image')
+
+def image_disk_path(filename, db=None):
+    """
+    返回图片地址中的文件名对应的磁盘路径：优化后改为其他格式保存的图片返回实际保存的文件
+    """
+    db = db or get_db()
+    row = db.execute("SELECT stored_filename FROM images WHERE filename = ?", (filename,)).fetchone()
+    return os.path.join(PIC_FOLDER, (row and row[0]) or filename)
+
+def _save_optimized(image, source_format, source_size, jpeg_keep):
+    """
+    按优化规则重新编码图片（不写入EXIF，保留ICC颜色配置），返回(新扩展名, 字节内容)；不需要处理的格式返回None
+    """
+    buffer = io.BytesIO()
+    icc_profile = image.info.get('icc_profile')
+    if source_format == 'BMP' or (source_format == 'PNG' and source_size > IMAGE_OPTIMIZE_PNG_WEBP_BYTES):
+        image.save(buffer, format='WEBP', lossless=True, method=4, icc_profile=icc_profile)
+        return '.webp', buffer.getvalue()
+    if source_format == 'PNG':
+        image.save(buffer, format='PNG', optimize=True, icc_profile=icc_profile)
+        return '.png', buffer.getvalue()
+    if source_format == 'JPEG':
+        # 没有旋转时沿用原图的量化表，避免再次有损压缩
+        quality = 'keep' if jpeg_keep else IMAGE_OPTIMIZE_JPEG_QUALITY
+        image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True, icc_profile=icc_profile)
+        return '.jpg', buffer.getvalue()
+    return None
+
+def optimize_image(filename):
+    """
+    优化一张已保存的图片：去除EXIF等元数据（方向先应用到像素上），重新压缩或转为WebP；
+    结果比原图小时保存为<哈希>.opt<扩展名>并删除原图，原来的地址通过images.stored_filename继续访问
+    :return: 节省的字节数
+    """
+    with transaction(immediate=False) as db:
+        row = db.execute(
+            "SELECT size, optimized_at FROM images WHERE filename = ?", (filename,)
+        ).fetchone()
+    if not row or row[1] is not None:
+        return 0
+    size = row[0]
+    source_path = os.path.join(PIC_FOLDER, filename)
+
+    result = None
+    try:
+        with Image.open(source_path) as original:
+            if not getattr(original, 'is_animated', False):
+                # 去除EXIF前先把方向应用到像素上
+                orientation = original.getexif().get(0x0112, 1)
+                image = ImageOps.exif_transpose(original) if orientation != 1 else original
+                result = _save_optimized(image, original.format, size, jpeg_keep=orientation == 1)
+    except (Image.UnidentifiedImageError, OSError, ValueError) as e:
+        logger.warning(f"无法优化图片 {filename}: {e}")
+
+    stored_filename = None
+    optimized_size = size
+    if result and len(result[1]) < size:
+        ext, data = result
+        stored_filename = f'{os.path.splitext(filename)[0]}.opt{ext}'
+        atomic_write_bytes(os.path.join(PIC_FOLDER, stored_filename), data)
+        optimized_size = len(data)
+
+    with transaction() as db:
+        db.execute(
+            "UPDATE images SET stored_filename = ?, optimized_size = ?, optimized_at = ? WHERE filename = ?",
+            (stored_filename, optimized_size, time.time(), filename)
+        )
+    if stored_filename:
+        os.remove(source_path)
+        logger.info(f"图片优化完成: {filename} -> {stored_filename}, {size} -> {optimized_size} 字节")
+    return size - optimized_size
+
+def process_new_image(filename):
+    """
+    新图片的后台处理：按配置优化，然后生成缩略图
+    """
+    try:
+        if IMAGE_OPTIMIZE_ENABLED:
+            optimize_image(filename)
+        image_variants.generate_all(image_disk_path(filename))
+    except Exception:
+        logger.exception(f"处理图片失败: {filename}")
+
+# 编辑器上传的图片按内容的SHA-256命名，相同的图片只保存一份，重复上传直接返回已有的地址
+EDITOR_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+def store_image(chunks, ext, max_bytes=None):
+    """
+    边写入临时文件边计算哈希，按内容保存图片
+    :param chunks: 图片内容的字节块迭代器
+    :param ext: 新图片使用的扩展名（内容已存在时沿用已有文件名）
+    :param max_bytes: 大小上限，超过时抛出ApiError
+    :return: PIC_FOLDER中的文件名
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(prefix='.upload-', suffix='.tmp', dir=PIC_FOLDER)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                if chunk:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise ApiError('图片超过大小限制', 413)
+                    digest.update(chunk)
+                    f.write(chunk)
+        image_hash = digest.hexdigest()
+
+        with transaction() as db:
+            row = db.execute("SELECT filename FROM images WHERE hash = ?", (image_hash,)).fetchone()
+            if row and os.path.exists(image_disk_path(row[0], db)):
+                # 重新上传的图片即将被引用，不能在保存引用它的文件之前被回收
+                db.execute("DELETE FROM image_orphans WHERE filename = ?", (row[0],))
+                return row[0]
+            filename = f'{image_hash}{ext}'
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, os.path.join(PIC_FOLDER, filename))
+            db.execute(
+                "INSERT OR REPLACE INTO images (hash, filename, size, created_at) VALUES (?, ?, ?, ?)",
+                (image_hash, filename, size, time.time())
+            )
+        if Image is not None:
+            # 新图片提交后在后台优化并生成缩略图
+            image_executor.submit(process_new_image, filename)
+        return filename
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _iter_file_chunks(file):
+    while True:
+        chunk = file.read(IMAGE_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
 # 新增：上传图片文件API (用于处理编辑器内粘贴或拖入的图片)
 @app.route('/api/upload-image', methods=['POST'])
 def upload_image():
@@ -314,31 +2155,17 @@ def upload_image():
             continue
 
         try:
-            # 生成唯一文件名
             ext = os.path.splitext(file.filename)[1].lower()
-            print(f'文件扩展名: {ext}')  # 调试信息
-            if ext not in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
+            if ext not in EDITOR_IMAGE_EXTENSIONS:
                 err_files.append(file.filename)
                 print(f'文件格式不支持: {file.filename}, 扩展名: {ext}')  # 调试信息
                 continue
 
-            unique_filename = f'{str(uuid.uuid4())[:8]}{ext}'  # 修复UUID使用问题
-            save_path = os.path.join(PIC_FOLDER, unique_filename)
-            print(f'保存路径: {save_path}')  # 调试信息
-
-            # 检查目录是否存在且可写
-            if not os.path.exists(os.path.dirname(save_path)):
-                print(f'目录不存在: {os.path.dirname(save_path)}')
-                os.makedirs(os.path.dirname(save_path), exist_ok=True,mode=0o777)
-                os.chmod(os.path.dirname(save_path), 0o777)
-                print(f'已创建目录: {os.path.dirname(save_path)}')
-
-            # 保存文件
-            file.save(save_path)
-            print(f'文件保存成功: {save_path}')  # 调试信息
+            # 按内容哈希保存，相同内容返回已有的文件
+            filename = store_image(_iter_file_chunks(file.stream), ext)
 
             # 生成访问URL，使用与前端相同的IP地址
-            image_url = f'{base_url}/api/get-image/{unique_filename}'
+            image_url = f'{base_url}/api/get-image/{filename}'
             succ_map[file.filename] = image_url
         except Exception as e:
             print(f'上传图片失败: {str(e)}')
@@ -353,6 +2180,72 @@ def upload_image():
         }
     })
 
+# 站外图片：所有下载共用一个连接池，同一站点的多张图片复用TCP/TLS连接
+remote_image_session = requests.Session()
+remote_image_session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=REMOTE_IMAGE_WORKERS))
+remote_image_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=REMOTE_IMAGE_WORKERS))
+remote_image_executor = ThreadPoolExecutor(max_workers=max(REMOTE_IMAGE_WORKERS, 1), thread_name_prefix='remote-image')
+
+# 按文件头识别图片格式，不信任地址的扩展名和Content-Type
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'BM', '.bmp'),
+)
+
+def sniff_image_ext(head):
+    """
+    根据文件开头的字节返回图片扩展名，不是支持的图片格式时返回None
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+def fetch_remote_image(url):
+    """
+    下载站外图片并按内容保存；同一地址下载过且图片仍存在时直接返回
+    :return: PIC_FOLDER中的文件名
+    """
+    if not url.lower().startswith(('http://', 'https://')):
+        raise ApiError('只支持http和https地址')
+
+    with transaction() as db:
+        row = db.execute("SELECT filename FROM image_urls WHERE url = ?", (url,)).fetchone()
+        if row and os.path.exists(image_disk_path(row[0], db)):
+            # 与重复上传一样，重新使用的图片移出image_orphans
+            db.execute("DELETE FROM image_orphans WHERE filename = ?", (row[0],))
+            return row[0]
+
+    with remote_image_session.get(url, timeout=REMOTE_IMAGE_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > REMOTE_IMAGE_MAX_BYTES:
+            raise ApiError('图片超过大小限制', 413)
+
+        # 读到足够识别格式的文件头后再开始写入
+        chunks = response.iter_content(IMAGE_CHUNK_SIZE)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 16:
+                break
+        ext = sniff_image_ext(head)
+        if ext is None:
+            raise ApiError('地址返回的内容不是支持的图片格式', 415)
+        filename = store_image(itertools.chain([head], chunks), ext, REMOTE_IMAGE_MAX_BYTES)
+
+    with transaction() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO image_urls (url, filename, fetched_at) VALUES (?, ?, ?)",
+            (url, filename, time.time())
+        )
+    return filename
+
 # 新增：从URL上传图片API (用于处理站外图片地址)
 @app.route('/api/upload-image-from-url', methods=['POST'])
 def upload_image_from_url():
@@ -367,25 +2260,10 @@ def upload_image_from_url():
         }), 400
 
     try:
-        # 下载图片
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-
-        # 获取文件扩展名
-        ext = os.path.splitext(url.split('?')[0])[1].lower()
-        if not ext or ext not in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-            ext = '.png'  # 默认使用png格式
-
-        # 生成唯一文件名
-        unique_filename = f'{str(uuid.uuid4())[:8]}{ext}'  # 修复UUID使用问题
-        save_path = os.path.join(PIC_FOLDER, unique_filename)
-
-        # 保存图片
-        with open(save_path, 'wb') as f:
-            f.write(response.content)
+        filename = fetch_remote_image(url)
 
         # 生成访问URL
-        image_url = f'{base_url}/api/get-image/{unique_filename}'
+        image_url = f'{base_url}/api/get-image/{filename}'
 
         return jsonify({
             'msg': '',
@@ -395,6 +2273,12 @@ def upload_image_from_url():
                 'url': image_url
             }
         })
+    except ApiError as e:
+        return jsonify({
+            'msg': e.message,
+            'code': 1,
+            'data': {}
+        }), e.status
     except Exception as e:
         print(f'从URL上传图片失败: {str(e)}')
         return jsonify({
@@ -403,11 +2287,326 @@ def upload_image_from_url():
             'data': {}
         }), 500
 
+# 批量从URL上传图片：粘贴包含多张站外图片的文档时一次提交，在有限的线程池中并发下载
+@app.route('/api/upload-images-from-urls', methods=['POST'])
+def upload_images_from_urls():
+    urls = (request.json or {}).get('urls')
+    if not isinstance(urls, list) or not urls:
+        return jsonify({
+            'msg': '图片URL列表不能为空',
+            'code': 1,
+            'data': {}
+        }), 400
+    if len(urls) > REMOTE_IMAGE_BATCH_MAX:
+        return jsonify({
+            'msg': f'一次最多上传{REMOTE_IMAGE_BATCH_MAX}个图片地址',
+            'code': 1,
+            'data': {}
+        }), 400
+
+    # 重复的地址只下载一次
+    futures = OrderedDict()
+    for url in urls:
+        if isinstance(url, str) and url not in futures:
+            futures[url] = remote_image_executor.submit(fetch_remote_image, url)
+
+    succ_map = {}
+    err_map = {}
+    for url, future in futures.items():
+        try:
+            succ_map[url] = f'{base_url}/api/get-image/{future.result()}'
+        except ApiError as e:
+            err_map[url] = e.message
+        except Exception as e:
+            print(f'从URL上传图片失败: {url} {str(e)}')
+            err_map[url] = str(e)
+
+    return jsonify({
+        'msg': '',
+        'code': 0,
+        'data': {
+            'succMap': succ_map,
+            'errMap': err_map
+        }
+    })
+
+# 图片回收：扫描PIC_FOLDER，把image_refs中没有引用的图片记入image_orphans，
+# 超过宽限期仍未被引用的删除；按批处理，不会把整个目录或引用表读入内存
+IMAGE_GC_COMMAND = 'gc-images'
+IMAGE_GC_BATCH_SIZE = 500
+
+def _mark_orphan_images(db, names, now):
+    """
+    检查一批磁盘上的图片文件是否被引用，未被引用的记入image_orphans
+    :return: 未被引用的图片数
+    """
+    placeholders = ','.join('?' * len(names))
+    # 优化后的文件按原来的地址文件名检查引用
+    stored = dict(db.execute(
+        f"SELECT stored_filename, filename FROM images WHERE stored_filename IN ({placeholders})", names
+    ).fetchall())
+    filenames = [stored.get(name, name) for name in names]
+    referenced = {row[0] for row in db.execute(
+        f"SELECT DISTINCT filename FROM image_refs WHERE filename IN ({placeholders})", filenames
+    )}
+    orphans = [filename for filename in filenames if filename not in referenced]
+    db.executemany(
+        """
+        INSERT INTO image_orphans (filename, since, checked_at) VALUES (?, ?, ?)
+        ON CONFLICT(filename) DO UPDATE SET checked_at = excluded.checked_at
+        """,
+        [(filename, now, now) for filename in orphans]
+    )
+    return len(orphans)
+
+def _purge_orphan_image(db, filename):
+    """
+    删除一张仍未被引用的图片及其记录，返回释放的字节数；已重新被引用时只移出image_orphans
+    在写事务中删除文件，同一内容的图片不会在删除期间被重新上传
+    """
+    db.execute("DELETE FROM image_orphans WHERE filename = ?", (filename,))
+    if db.execute("SELECT 1 FROM image_refs WHERE filename = ? LIMIT 1", (filename,)).fetchone():
+        return 0
+    path = image_disk_path(filename, db)
+    db.execute("DELETE FROM images WHERE filename = ?", (filename,))
+    db.execute("DELETE FROM image_urls WHERE filename = ?", (filename,))
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    stored_filename = os.path.basename(path)
+    after_commit(lambda: image_variants.discard(stored_filename))
+    return size
+
+def _image_refs_incomplete(db):
+    """
+    是否有会话的图片引用还没有完整建立（新导入、迁移后或上次重建索引未完成）
+    """
+    return db.execute("SELECT 1 FROM sessions WHERE image_refs_complete = 0 LIMIT 1").fetchone() is not None
+
+def collect_orphan_images(purge=True, now=None, cancel_event=None):
+    """
+    回收不再被引用的图片
+    :param purge: 为False时只扫描并记录未被引用的图片，不删除
+    :return: {'scanned': 扫描的文件数, 'orphans': 未被引用的图片数, 'purged': 删除的图片数, 'freedBytes': 释放的字节数}
+    """
+    now = now or time.time()
+    with transaction(immediate=False) as db:
+        if _image_refs_incomplete(db):
+            # 引用表与全文索引一起建立，索引未完成时无法判断图片是否被引用
+            raise ApiError('图片引用索引尚未建立完成，请重建全文索引后再回收', 409)
+
+    stats = {'scanned': 0, 'orphans': 0, 'purged': 0, 'freedBytes': 0}
+
+    def mark(names):
+        with transaction() as db:
+            stats['orphans'] += _mark_orphan_images(db, names, now)
+        stats['scanned'] += len(names)
+
+    names = []
+    with os.scandir(PIC_FOLDER) as entries:
+        for entry in entries:
+            # 以.开头的是正在上传的临时文件
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            names.append(entry.name)
+            if len(names) >= IMAGE_GC_BATCH_SIZE:
+                mark(names)
+                names = []
+                if cancel_event is not None and cancel_event.is_set():
+                    return dict(stats, cancelled=True)
+    if names:
+        mark(names)
+
+    # 本次扫描中已被引用或已不存在的图片移出image_orphans
+    with transaction() as db:
+        db.execute("DELETE FROM image_orphans WHERE checked_at < ?", (now,))
+
+    if purge:
+        deadline = now - IMAGE_GC_GRACE_DAYS * 86400
+        while not (cancel_event is not None and cancel_event.is_set()):
+            with transaction() as db:
+                if _image_refs_incomplete(db):
+                    # 扫描期间有会话被重新导入
+                    raise ApiError('图片引用索引尚未建立完成，请重建全文索引后再回收', 409)
+                due = [row[0] for row in db.execute(
+                    "SELECT filename FROM image_orphans WHERE since <= ? LIMIT ?", (deadline, IMAGE_GC_BATCH_SIZE)
+                )]
+                for filename in due:
+                    freed = _purge_orphan_image(db, filename)
+                    if freed:
+                        stats['purged'] += 1
+                        stats['freedBytes'] += freed
+            if len(due) < IMAGE_GC_BATCH_SIZE:
+                break
+
+    logger.info(f"图片回收完成: {stats}")
+    return stats
+
+@job_manager.register(IMAGE_GC_COMMAND)
+def collect_orphan_images_job(params, cancel_event):
+    """
+    后台任务：回收不再被引用的图片
+    """
+    try:
+        return dict(collect_orphan_images(params.get('purge', True), cancel_event=cancel_event), success=True)
+    except ApiError as e:
+        return {'success': False, 'error': e.message}
+
+# 回收不再被引用的图片，在后台任务中执行；dryRun为真时只记录未被引用的图片，不删除
+@app.route('/api/images/gc', methods=['POST'])
+def collect_orphan_images_api():
+    data = request.json or {}
+    try:
+        job_id = job_manager.submit(IMAGE_GC_COMMAND, None, {'purge': not data.get('dryRun')})
+        if data.get('wait'):
+            return wait_for_job_response(job_id)
+        return jsonify({'success': True, 'jobId': job_id, 'status': 'queued'}), 202
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 列出最近一次回收扫描发现的未被引用的图片，dueAt之后会被删除
+@app.route('/api/images/orphans', methods=['GET'])
+def list_orphan_images():
+    try:
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        offset = request.args.get('offset', 0, type=int)
+        db = get_db()
+        total = db.execute("SELECT COUNT(*) FROM image_orphans").fetchone()[0]
+        rows = db.execute(
+            "SELECT filename, since FROM image_orphans ORDER BY since, filename LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+        return jsonify({
+            'total': total,
+            'orphans': [
+                {
+                    'filename': filename,
+                    'url': f'{base_url}/api/get-image/{filename}',
+                    'since': since,
+                    'dueAt': since + IMAGE_GC_GRACE_DAYS * 86400
+                }
+                for filename, since in rows
+            ]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 图片优化效果统计：每张图片的原始大小和优化后的大小记录在images表中
+@app.route('/api/images/stats', methods=['GET'])
+def get_image_stats():
+    try:
+        db = get_db()
+        count, optimized, converted, original_bytes, stored_bytes = db.execute(
+            """
+            SELECT COUNT(*),
+                   COUNT(optimized_at),
+                   COUNT(stored_filename),
+                   COALESCE(SUM(size), 0),
+                   COALESCE(SUM(COALESCE(optimized_size, size)), 0)
+            FROM images
+            """
+        ).fetchone()
+        return jsonify({
+            'images': count,
+            'optimized': optimized,
+            'rewritten': converted,
+            'originalBytes': original_bytes,
+            'storedBytes': stored_bytes,
+            'savedBytes': original_bytes - stored_bytes
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 查询图片被哪些文件引用
+@app.route('/api/image-refs/<filename>', methods=['GET'])
+def get_image_refs(filename):
+    try:
+        db = get_db()
+        rows = db.execute(
+            """
+            SELECT r.session_id, r.item_id, f.display_name
+            FROM image_refs r LEFT JOIN file_mapping f ON f.id = r.item_id
+            WHERE r.filename = ?
+            ORDER BY r.session_id
+            """,
+            (filename,)
+        ).fetchall()
+        return jsonify({
+            'filename': filename,
+            'refs': [
+                {'sessionId': session_id, 'id': item_id, 'name': display_name}
+                for session_id, item_id, display_name in rows
+            ]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 新增：获取图片API
+# 按内容哈希命名的图片，ETag直接使用哈希
+IMAGE_HASH_NAME_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+def send_image(path, etag):
+    """
+    发送图片文件：长期缓存、ETag/Last-Modified条件请求和Range请求
+    配置了IMAGE_OFFLOAD时只返回响应头，由前端代理发送文件内容（Range也由代理处理）
+    """
+    if not IMAGE_OFFLOAD:
+        response = send_file(path, etag=etag, max_age=IMAGE_CACHE_MAX_AGE, conditional=True)
+    else:
+        stat = os.stat(path)
+        response = app.response_class(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+        response = response.make_conditional(request)
+        if response.status_code == 200:
+            if IMAGE_OFFLOAD == 'x-accel':
+                rel_path = os.path.relpath(path, DATA_FOLDER).replace(os.sep, '/')
+                response.headers['X-Accel-Redirect'] = IMAGE_ACCEL_PREFIX.rstrip('/') + '/' + quote(rel_path)
+            else:
+                response.headers['X-Sendfile'] = path
+    response.cache_control.immutable = True
+    return response
+
 # 新增：获取图片API
 @app.route('/api/get-image/<filename>')
 def get_image(filename):
     try:
-        return send_from_directory(PIC_FOLDER, filename)
+        if os.path.basename(filename) != filename:
+            return jsonify({'error': '图片不存在'}), 404
+        original_path = image_disk_path(filename)
+        if not os.path.isfile(original_path):
+            return jsonify({'error': '图片不存在'}), 404
+
+        if IMAGE_HASH_NAME_PATTERN.match(os.path.splitext(filename)[0]):
+            # 优化后的图片内容不同，ETag使用实际保存的文件名
+            etag = os.path.splitext(os.path.basename(original_path))[0]
+        else:
+            # 旧的随机文件名按修改时间和大小生成ETag
+            stat = os.stat(original_path)
+            etag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+        # ?w= 请求缩略图，未安装Pillow、原图不够大或生成失败时返回原图
+        width = request.args.get('w', type=int)
+        if width and Image is not None:
+            variant_width = image_variants.pick_width(width)
+            if variant_width:
+                try:
+                    variant_path = image_variants.get(original_path, variant_width)
+                except Exception:
+                    logger.exception(f"生成缩略图失败: {filename} w={variant_width}")
+                    variant_path = None
+                if variant_path:
+                    return send_image(variant_path, f'{etag}-w{variant_width}')
+        return send_image(original_path, etag)
+    except HTTPException:
+        # Range无法满足时的416等由Flask返回
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 404
 
@@ -415,8 +2614,9 @@ def get_image(filename):
 @app.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,If-Match,If-None-Match,Range,If-Range')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,Content-Range,Accept-Ranges,X-Next-Cursor')
     return response
     
 # 新增：获取所有文件夹会话API
@@ -424,8 +2624,8 @@ def after_request(response):
 def get_all_sessions():
     try:
         # 从数据库中查询所有会话记录
-        cursor.execute("SELECT session_id, folder_name, folder_path, created_at FROM sessions")
-        sessions_data = cursor.fetchall()
+        with transaction(immediate=False) as db:
+            sessions_data = db.execute("SELECT session_id, folder_name, folder_path, created_at FROM sessions").fetchall()
         
         sessions = []
         for session in sessions_data:
@@ -464,61 +2664,166 @@ def create_website_session():
     try:
         # 构建网站文件夹路径
         website_folder = os.path.join(WEBSITES_FOLDER, folder_name)
-        # 定义固定模板文件夹路径
-        fixed_showlist_folder = os.path.join(DATA_FOLDER, 'fixed_ShowlistFold')
 
-        # 检查文件夹是否存在
+        # 新文件夹需要执行gitbook init/install，放入后台任务；wait为真时保持原来的阻塞行为
         if not os.path.exists(website_folder):
-            # 创建文件夹
-            os.makedirs(website_folder, exist_ok=True)
-
-            # 检查固定模板文件夹是否存在
-            if os.path.exists(fixed_showlist_folder):
-                # 复制 book.json 文件
-                src_book_json = os.path.join(fixed_showlist_folder, 'book.json')
-                dest_book_json = os.path.join(website_folder, 'book.json')
-                if os.path.exists(src_book_json):
-                    try:
-                        shutil.copy2(src_book_json, dest_book_json)
-                    except Exception as e:
-                        logger.error(f'复制 book.json 文件失败: {str(e)}')
-            else:
-                logger.warning(f'固定模板文件夹不存在: {fixed_showlist_folder}')
+            job_id = job_manager.submit('init-website', None, {'folder_name': folder_name, 'website_folder': website_folder})
+            if data.get('wait'):
+                return wait_for_job_response(job_id)
+            return jsonify({'jobId': job_id, 'status': 'queued'}), 202
+
+        return jsonify({'sessionId': open_website_session(folder_name, website_folder)})
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.exception(f"创建网站会话失败: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-            # 执行 gitbook init 命令
-            returncode, stdout, stderr = run_gitbook_command(f'init {website_folder}')
+@job_manager.register('init-website')
+def init_website_job(params, cancel_event):
+    """
+    后台任务：初始化新的网站文件夹并创建会话，结果为 {'sessionId': ...}
+    """
+    folder_name = params['folder_name']
+    website_folder = params['website_folder']
 
-            if returncode != 0:
-                # 如果 gitbook init 失败，删除创建的文件夹
-                shutil.rmtree(website_folder, ignore_errors=True)
-                return jsonify({
-                    'error': f'gitbook init 失败: {stderr}'
-                }), 500
+    # 排队期间可能已被其他任务创建
+    if not os.path.exists(website_folder):
+        init_website_folder(website_folder, cancel_event)
 
-            logger.info(f"开始执行 gitbook install: {website_folder}")
-            returncode, stdout, stderr = run_gitbook_command(f'install {website_folder}')
-        
-            if returncode != 0:
-                logger.error(f"gitbook install 失败: {stderr}")
-                return jsonify({
-                    'error': f'gitbook install失败: {stderr}'
-                }), 500
+    return {'sessionId': open_website_session(folder_name, website_folder)}
+
+def init_website_folder(website_folder, cancel_event=None):
+    """
+    创建网站文件夹，复制模板中的book.json，并执行gitbook init和gitbook install
+    失败时抛出RuntimeError
+    """
+    # 定义固定模板文件夹路径
+    fixed_showlist_folder = os.path.join(DATA_FOLDER, 'fixed_ShowlistFold')
+
+    # 创建文件夹
+    os.makedirs(website_folder, exist_ok=True)
+
+    # 检查固定模板文件夹是否存在
+    if os.path.exists(fixed_showlist_folder):
+        # 复制 book.json 文件
+        src_book_json = os.path.join(fixed_showlist_folder, 'book.json')
+        dest_book_json = os.path.join(website_folder, 'book.json')
+        if os.path.exists(src_book_json):
+            try:
+                shutil.copy2(src_book_json, dest_book_json)
+            except Exception as e:
+                logger.error(f'复制 book.json 文件失败: {str(e)}')
+    else:
+        logger.warning(f'固定模板文件夹不存在: {fixed_showlist_folder}')
+
+    # 执行 gitbook init 命令
+    returncode, stdout, stderr = run_gitbook_command(f'init {website_folder}', cancel_event=cancel_event)
+
+    if returncode != 0:
+        # 如果 gitbook init 失败，删除创建的文件夹
+        shutil.rmtree(website_folder, ignore_errors=True)
+        raise RuntimeError(f'gitbook init 失败: {stderr}')
+
+    install_plugins(website_folder, cancel_event)
+
+# 共享插件仓库：相同插件列表（含版本）的书共用一份node_modules，
+# 新书通过符号链接（不支持时用硬链接复制）使用仓库中的插件，只有从未见过的插件组合才执行gitbook install
+_plugin_store_locks = {}
+_plugin_store_locks_guard = threading.Lock()
+
+def plugin_store_key(website_folder):
+    """
+    根据book.json中的gitbook版本和插件列表计算插件仓库的键
+    """
+    try:
+        with open(os.path.join(website_folder, 'book.json'), 'r', encoding='utf-8') as f:
+            book_config = json.load(f)
+    except (OSError, ValueError):
+        book_config = {}
+    spec = {
+        'gitbook': book_config.get('gitbook'),
+        'plugins': sorted(book_config.get('plugins') or [])
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def _link_node_modules(store_modules, website_folder):
+    """
+    让书的node_modules指向仓库中的插件
+    """
+    target = os.path.join(website_folder, 'node_modules')
+    if os.path.lexists(target):
+        if os.path.islink(target) or os.path.isfile(target):
+            os.remove(target)
+        else:
+            shutil.rmtree(target)
+    try:
+        os.symlink(store_modules, target, target_is_directory=True)
+    except OSError:
+        shutil.copytree(store_modules, target, symlinks=True, copy_function=os.link)
+
+def install_plugins(website_folder, cancel_event=None):
+    """
+    为新书准备GitBook插件：仓库中已有相同插件组合时直接链接，否则执行gitbook install并放入仓库
+    """
+    key = plugin_store_key(website_folder)
+    store_folder = os.path.join(PLUGIN_STORE_FOLDER, key)
+    store_modules = os.path.join(store_folder, 'node_modules')
+    complete_marker = os.path.join(store_folder, '.complete')
+
+    with _plugin_store_locks_guard:
+        lock = _plugin_store_locks.setdefault(key, threading.Lock())
+
+    # 同一插件组合同时只安装一次，其他任务等待后直接使用
+    with lock:
+        if os.path.exists(complete_marker):
+            logger.info(f"使用共享插件仓库 {key}: {website_folder}")
+            _link_node_modules(store_modules, website_folder)
+            return
+
+        logger.info(f"开始执行 gitbook install: {website_folder}")
+        returncode, stdout, stderr = run_gitbook_command(f'install {website_folder}', cancel_event=cancel_event)
+
+        if returncode != 0:
+            logger.error(f"gitbook install 失败: {stderr}")
+            raise RuntimeError(f'gitbook install失败: {stderr}')
+
+        # 把安装结果移入仓库，再链接回来；放入仓库失败不影响这本书的使用
+        installed_modules = os.path.join(website_folder, 'node_modules')
+        if not os.path.isdir(installed_modules):
+            return
+        try:
+            shutil.rmtree(store_folder, ignore_errors=True)
+            os.makedirs(store_folder)
+            shutil.move(installed_modules, store_modules)
+            with open(complete_marker, 'w', encoding='utf-8') as f:
+                f.write(key)
+            _link_node_modules(store_modules, website_folder)
+            logger.info(f"插件已加入共享插件仓库 {key}")
+        except Exception as e:
+            logger.error(f'加入共享插件仓库失败: {str(e)}')
+            if not os.path.exists(installed_modules) and os.path.isdir(store_modules):
+                shutil.move(store_modules, installed_modules)
 
+def open_website_session(folder_name, website_folder):
+    """
+    返回网站文件夹对应的会话ID，没有会话时创建会话并导入文件夹结构
+    """
+    with transaction() as db:
         # 检查是否已存在相同文件夹的会话
-        cursor.execute("SELECT session_id FROM sessions WHERE folder_path = ?", (website_folder,))
-        existing_session = cursor.fetchone()
+        existing_session = db.execute("SELECT session_id FROM sessions WHERE folder_path = ?", (website_folder,)).fetchone()
 
-        # 如果存在相同文件夹的会话，先检查file_mapping表中是否有该文件夹的映射
+        # 如果存在相同文件夹的会话，先检查file_mapping表中是否有该会话的映射
         if existing_session:
-            # 检查file_mapping表中是否有该文件夹的映射
-            cursor.execute("SELECT COUNT(*) FROM file_mapping WHERE file_path = ?", (website_folder,))
-            count = cursor.fetchone()[0]
+            has_mapping = db.execute("SELECT 1 FROM file_mapping WHERE session_id = ? LIMIT 1", (existing_session[0],)).fetchone()
             
             # 如果没有映射，导入文件夹结构
-            if count == 0:
-                import_folder_structure(website_folder)
+            if not has_mapping:
+                success, message = import_folder_structure(website_folder, existing_session[0])
+                if not success:
+                    raise RuntimeError(f'导入文件夹结构失败: {message}')
                 
-            return jsonify({'sessionId': existing_session[0]})
+            return existing_session[0]
 
         # 生成唯一 ID
         session_id = str(uuid.uuid4())[:8]
@@ -527,19 +2832,17 @@ def create_website_session():
         session_folder = os.path.join(USER_FOLDER, session_id)
         os.makedirs(session_folder, exist_ok=True)
         
-        # 将文件夹结构导入到file_mapping表中
-        import_folder_structure(website_folder)
-        
-        cursor.execute(
+        db.execute(
             "INSERT INTO sessions (session_id, folder_name, folder_path) VALUES (?, ?, ?)",
             (session_id, folder_name, website_folder)
         )
-        conn.commit()
-        
-        return jsonify({'sessionId': session_id})
-    except Exception as e:
-        logger.exception(f"创建网站会话失败: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+
+        # 将文件夹结构导入到file_mapping表中
+        success, message = import_folder_structure(website_folder, session_id)
+        if not success:
+            raise RuntimeError(f'导入文件夹结构失败: {message}')
+    
+    return session_id
 
 
 # 获取文件夹会话API
@@ -551,25 +2854,35 @@ def get_folder_session():
         return jsonify({'error': '会话ID不能为空'}), 400
 
     try:
-        # 查找会话文件夹
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        # 优先使用缓存的文件树，未缓存时从数据库构建
+        cached = tree_cache.get(session_id)
+        if cached and os.path.exists(cached[1]):
+            revision, folder_path, body = cached
+        else:
+            # 先取修订号再读数据库，读取期间有写入时不会把旧树放入缓存
+            revision = tree_cache.revision(session_id)
+            with transaction(immediate=False) as db:
+                # 查找会话文件夹
+                result = db.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
 
-        if not result:
-            return jsonify({'error': '会话不存在'}), 404
+                if not result:
+                    return jsonify({'error': '会话不存在'}), 404
 
-        folder_path = result[0]
+                folder_path = result[0]
 
-        if not os.path.exists(folder_path):
-            return jsonify({'error': '文件夹不存在'}), 404
+                if not os.path.exists(folder_path):
+                    return jsonify({'error': '文件夹不存在'}), 404
 
-         # 读取文件夹结构
-        structure = read_folder_structure(folder_path)
+                # 读取文件夹结构
+                structure = read_folder_structure(folder_path)
 
-        return jsonify({
-            'structure': structure,
-            'folderPath': folder_path
-        })
+            body = tree_cache.store(session_id, revision, folder_path, structure)
+
+        # 带上ETag，内容未变化时返回304
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(tree_cache.etag(session_id, revision))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -595,54 +2908,387 @@ def read_folder():
             return jsonify({'error': '提供的路径不是文件夹'}), 400
 
         # 读取文件夹结构
-        structure = read_folder_structure(normalized_path)
+        with transaction(immediate=False):
+            structure = read_folder_structure(normalized_path)
         return jsonify(structure)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# 递归读取文件夹结构
+# 读取文件夹结构
 def read_folder_structure(folder_path):
     """
     基于数据库构建文件树结构
+    通过递归CTE一次查询取回整棵子树，再在内存中一次遍历组装成树
     """
     structure = []
     try:
-        # 标准化路径
-        normalized_folder_path = os.path.abspath(folder_path)
+        db = get_db()
+        folder = resolve_item_path(db, folder_path)
+        if not folder or folder.item_type != 'folder':
+            return structure
         
-        # 从数据库中获取当前文件夹下的所有子项
-        cursor.execute(
-            "SELECT id, display_name, file_path, item_type FROM file_mapping WHERE parent_path = ? ORDER BY position",
-            (normalized_folder_path,)
-        )
-        items = cursor.fetchall()
+        # 一次性获取该文件夹下的所有后代节点（按position排序，保证同级顺序）
+        items = fetch_subtree(db, folder.session_id, folder.item_id, folder.rel_path)
+        
+        # 父节点ID -> 子项列表，文件夹节点直接引用自己的子项列表
+        children_by_parent = {folder.item_id: structure}
         
         for item in items:
-            item_id, display_name, file_path, item_type = item
+            item_id, parent_id, display_name, rel_path, item_type = item
+            file_path = item_disk_path(folder.folder_path, rel_path)
             
+            item_info = make_tree_node(item_id, display_name, item_type, file_path)
             if item_type == 'folder':
-                # 如果是文件夹，递归获取其子项
-                item_info = {
-                    'id': item_id,
-                    'name': display_name,
-                    'type': 'folder',
-                    'filePath': file_path,
-                    'children': read_folder_structure(file_path)
-                }
-            else:
-                # 如果是文件
-                item_info = {
-                    'id': item_id,
-                    'name': display_name,
-                    'type': 'file',
-                    'filePath': file_path
-                }
+                # 子项可能先于文件夹本身出现，复用已经收集的子项列表
+                item_info['children'] = children_by_parent.setdefault(item_id, [])
             
-            structure.append(item_info)
+            children_by_parent.setdefault(parent_id, []).append(item_info)
     except Exception as e:
         print(f"读取文件夹结构时出错: {e}")
     return structure
 
+# 获取文件内容的API
+def atomic_write_bytes(path, data):
+    """
+    原子且持久地写入文件：先写同目录下的临时文件并fsync，再用rename替换原文件
+    写入中断时原文件保持完整，不会出现只写了一半的文件
+    :return: 新文件的os.stat结果
+    """
+    dir_path = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(path)}.', suffix='.tmp', dir=dir_path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # 保留原文件的权限（mkstemp创建的文件只有属主可读写）
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # 同步目录项，保证rename本身在断电后也不会丢失
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+    return os.stat(path)
+
+class PatchError(ValueError):
+    """补丁无法应用"""
+
+def apply_text_edits(text, edits):
+    """
+    把一组范围编辑应用到文本上
+    :param edits: [{'start': int, 'end': int, 'text': str}]，偏移量为基础版本中的UTF-16码元位置（与浏览器中的字符串下标一致），
+                  各范围相对基础版本且互不重叠
+    """
+    ranges = []
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise PatchError('补丁格式错误')
+        start, end, new_text = edit.get('start'), edit.get('end'), edit.get('text', '')
+        # bool是int的子类，需要单独排除
+        if type(start) is not int or type(end) is not int or not isinstance(new_text, str):
+            raise PatchError('补丁格式错误')
+        ranges.append((start, end, new_text))
+
+    units = text.encode('utf-16-le')
+    length = len(units) // 2
+    pieces = []
+    cursor = 0
+    for start, end, new_text in sorted(ranges, key=lambda r: (r[0], r[1])):
+        if start < cursor or end < start or end > length:
+            raise PatchError('补丁范围越界或互相重叠')
+        pieces.append(units[cursor * 2:start * 2])
+        pieces.append(new_text.encode('utf-16-le'))
+        cursor = end
+    pieces.append(units[cursor * 2:])
+    try:
+        return b''.join(pieces).decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise PatchError('补丁范围截断了字符')
+
+class FileValidatorCache:
+    """
+    文件内容ETag（内容哈希）的缓存，以(修改时间, 大小, inode)判断文件是否变化，避免每次请求重新计算哈希
+    按LRU淘汰，最多保存max_entries个文件
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def compute(content_bytes):
+        return hashlib.sha256(content_bytes).hexdigest()[:32]
+
+    def get(self, path, stat):
+        """
+        返回缓存的ETag，文件已变化或未缓存时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != (stat.st_mtime_ns, stat.st_size, stat.st_ino):
+                return None
+            self._entries.move_to_end(path)
+            return entry[1]
+
+    def put(self, path, stat, etag):
+        with self._lock:
+            self._entries[path] = ((stat.st_mtime_ns, stat.st_size, stat.st_ino), etag)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def current(self, path):
+        """
+        返回文件当前的ETag，未缓存时读取文件计算
+        """
+        stat = os.stat(path)
+        etag = self.get(path, stat)
+        if etag is None:
+            with open(path, 'rb') as f:
+                etag = self.compute(f.read())
+            if os.stat(path).st_mtime_ns == stat.st_mtime_ns:
+                self.put(path, stat, etag)
+        return etag
+
+file_validators = FileValidatorCache(FILE_ETAG_CACHE_SIZE)
+
+# 同一文件的“检查ETag + 写入”需要互斥，按路径哈希分配到固定数量的锁上
+_file_write_locks = [threading.Lock() for _ in range(64)]
+
+def file_write_lock(path):
+    return _file_write_locks[hash(path) % len(_file_write_locks)]
+
+def _path_under(path, prefix):
+    return path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep)
+
+# 延迟写入缓冲中的一个文件：最新内容及其ETag，首次和最近一次保存的时间
+PendingWrite = namedtuple('PendingWrite', 'content etag created updated')
+
+class WriteBehindBuffer:
+    """
+    可选的延迟写入层：保存的内容先放在内存中，同一文件的连续保存合并为一次磁盘写入
+    每次保存先追加到日志并fsync后才确认，进程崩溃后启动时从日志恢复；
+    每隔interval秒、文件空闲idle秒后以及导出/生成目录之前刷新到磁盘；修订记录和全文索引也在写入磁盘时更新
+    调用方必须持有file_write_lock(path)后再调用put
+    文件或文件夹改名/移动时调用relocate，提交后缓冲中的内容改到新路径；已确认的内容不会被丢弃，
+    所在文件夹已不存在时写入lost_folder
+    """
+    def __init__(self, journal_path, enabled, interval, idle, lost_folder):
+        self.journal_path = journal_path
+        self.enabled = enabled
+        self.interval = interval
+        self.idle = idle
+        self.lost_folder = lost_folder
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # 写入磁盘与relocate互斥：relocate返回后不会再有写入旧路径的操作
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._moving = []
+        # 已调用cancel_relocate、事务结束时不再处理的路径
+        self._cancelled = []
+        self._journal = None
+
+    def get(self, path):
+        """
+        :return: 尚未写入磁盘的PendingWrite，没有时返回None
+        """
+        with self._lock:
+            return self._pending.get(path)
+
+    def put(self, path, content, etag):
+        now = time.time()
+        record = json.dumps({'path': path, 'etag': etag, 'content': content.decode('utf-8')}, ensure_ascii=False)
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'ab')
+            self._journal.write(record.encode('utf-8') + b'\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            previous = self._pending.get(path)
+            self._pending[path] = PendingWrite(content, etag, previous.created if previous else now, now)
+
+    def flush(self, prefix=None, idle_only=False):
+        """
+        把缓冲的内容写入磁盘，并记录修订、更新全文索引；正在改名或移动的路径留到改名结束后再写
+        不能在事务中调用（修订和索引在各自的事务中更新）
+        :param prefix: 只刷新该路径（文件或文件夹）下的文件
+        :param idle_only: 只刷新已空闲或缓冲时间超过interval的文件（后台线程使用）
+        """
+        with self._flush_lock:
+            now = time.time()
+            with self._lock:
+                paths = [
+                    path for path, entry in self._pending.items()
+                    if (prefix is None or _path_under(path, prefix))
+                    and (not idle_only or now - entry.updated >= self.idle or now - entry.created >= self.interval)
+                ]
+            written = False
+            for path in paths:
+                with file_write_lock(path):
+                    with self._lock:
+                        entry = self._pending.get(path)
+                        if entry is None or self._is_moving(path):
+                            continue
+                    if not os.path.isdir(os.path.dirname(path)):
+                        self._save_lost(path, entry.content)
+                        with self._lock:
+                            self._pending.pop(path, None)
+                        written = True
+                        continue
+                    record_file_revision(path, entry.content, previous_on_disk=True)
+                    with self._write_lock:
+                        with self._lock:
+                            if self._is_moving(path):
+                                continue
+                        try:
+                            stat = atomic_write_bytes(path, entry.content)
+                        except Exception:
+                            logger.exception(f"延迟写入失败，稍后重试: {path}")
+                            continue
+                        file_validators.put(path, stat, entry.etag)
+                        with self._lock:
+                            if self._pending.get(path) is entry:
+                                del self._pending[path]
+                    written = True
+                    update_search_document(path, entry.content.decode('utf-8'), entry.etag)
+            if written:
+                self._compact_journal()
+
+    def _is_moving(self, path):
+        return any(_path_under(path, prefix) for prefix in self._moving)
+
+    def _save_lost(self, path, content):
+        """
+        文件所在的文件夹已不存在时，把已确认的内容保存到lost_folder
+        """
+        os.makedirs(self.lost_folder, exist_ok=True)
+        lost_path = os.path.join(self.lost_folder, f'{int(time.time())}-{uuid.uuid4().hex[:8]}-{os.path.basename(path)}')
+        atomic_write_bytes(lost_path, content)
+        logger.error(f"文件所在文件夹已不存在，未写入的内容已保存到 {lost_path}（原路径 {path}）")
+
+    def relocate(self, old_prefix, new_prefix):
+        """
+        文件或文件夹将要从old_prefix改名/移动到new_prefix，必须在执行改名的事务中、改名之前调用
+        事务结束前不再写入该路径下的文件；提交后缓冲中的内容改到新路径，回滚时保持原路径
+        """
+        if not self.enabled:
+            return
+        with self._write_lock:
+            with self._lock:
+                self._moving.append(old_prefix)
+        after_commit(lambda: self._finish_relocate(old_prefix, new_prefix))
+        after_rollback(lambda: self._finish_relocate(old_prefix, None))
+
+    def cancel_relocate(self, old_prefix):
+        """
+        relocate之后改名失败时调用：缓冲中的内容保持原路径，提交后不再改到新路径
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._moving.remove(old_prefix)
+            self._cancelled.append(old_prefix)
+
+    def _finish_relocate(self, old_prefix, new_prefix):
+        moved = False
+        with self._lock:
+            if old_prefix in self._cancelled:
+                self._cancelled.remove(old_prefix)
+                return
+            self._moving.remove(old_prefix)
+            if new_prefix is not None:
+                for path in [path for path in self._pending if _path_under(path, old_prefix)]:
+                    self._pending[new_prefix + path[len(old_prefix):]] = self._pending.pop(path)
+                    moved = True
+        if moved:
+            self._compact_journal()
+
+    def discard(self, prefix):
+        """
+        丢弃某个路径下尚未写入的内容（文件被删除时使用）
+        """
+        with self._flush_lock:
+            with self._lock:
+                for path in [path for path in self._pending if _path_under(path, prefix)]:
+                    del self._pending[path]
+            self._compact_journal()
+
+    def _compact_journal(self):
+        """
+        日志中只保留仍在缓冲中的内容，缓冲为空时清空日志
+        """
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            lines = [
+                json.dumps({'path': path, 'etag': entry.etag, 'content': entry.content.decode('utf-8')}, ensure_ascii=False) + '\n'
+                for path, entry in self._pending.items()
+            ]
+            if lines or os.path.exists(self.journal_path):
+                atomic_write_bytes(self.journal_path, ''.join(lines).encode('utf-8'))
+
+    def recover(self):
+        """
+        启动时把日志中已确认但尚未写入磁盘的保存写回文件
+        最后一行可能因崩溃而不完整，这样的保存没有被确认，直接忽略
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        latest = {}
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                latest[record['path']] = record
+        for path, record in latest.items():
+            content = record['content'].encode('utf-8')
+            if not os.path.isdir(os.path.dirname(path)):
+                self._save_lost(path, content)
+                continue
+            stat = atomic_write_bytes(path, content)
+            file_validators.put(path, stat, record['etag'])
+        if latest:
+            logger.info(f"已从保存日志恢复 {len(latest)} 个文件")
+        self._compact_journal()
+
+    def start(self):
+        """
+        启动后台刷新线程
+        """
+        def run():
+            while True:
+                time.sleep(max(min(self.idle, self.interval) / 2, 0.1))
+                try:
+                    self.flush(idle_only=True)
+                except Exception:
+                    logger.exception("后台刷新延迟写入失败")
+        threading.Thread(target=run, name='write-behind', daemon=True).start()
+        atexit.register(self.flush)
+
+write_behind = WriteBehindBuffer(
+    os.path.join(DATA_FOLDER, 'save-journal.log'), WRITE_BEHIND_ENABLED, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_IDLE,
+    os.path.join(DATA_FOLDER, 'save-lost')
+)
+
 # 获取文件内容的API
 @app.route('/api/file-content', methods=['GET'])
 def get_file_content():
@@ -652,39 +3298,980 @@ def get_file_content():
         return jsonify({'error': '文件路径不能为空'}), 400
 
     try:
+        normalized_path = os.path.abspath(file_path)
+
         # 检查文件是否存在
-        if not os.path.exists(file_path):
+        if not os.path.exists(normalized_path):
             return jsonify({'error': '文件不存在'}), 404
 
-        # 读取文件内容
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return jsonify({'content': content})
+        # 客户端的版本仍是最新时直接返回304，不读取文件
+        pending = write_behind.get(normalized_path)
+        etag = pending.etag if pending else file_validators.get(normalized_path, os.stat(normalized_path))
+        if etag is not None and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        elif pending:
+            # 尚未写入磁盘的最新内容
+            response = jsonify({'content': pending.content.decode('utf-8')})
+        else:
+            # 读取文件内容，同时计算ETag
+            with open(normalized_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                content_bytes = f.read()
+            etag = file_validators.compute(content_bytes)
+            file_validators.put(normalized_path, stat, etag)
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                response = jsonify({'content': content_bytes.decode('utf-8')})
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def read_file_version(path, known_etag=None):
+    """
+    读取文件的当前版本（包括延迟写入缓冲中尚未写入磁盘的内容）
+    :param known_etag: 客户端已有的版本，仍是最新时不读取文件
+    :return: (etag, content_bytes)，known_etag仍是最新时content_bytes为None
+    """
+    pending = write_behind.get(path)
+    if pending:
+        return pending.etag, None if pending.etag == known_etag else pending.content
+    if known_etag is not None and file_validators.get(path, os.stat(path)) == known_etag:
+        return known_etag, None
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        content_bytes = f.read()
+    etag = file_validators.compute(content_bytes)
+    file_validators.put(path, stat, etag)
+    return etag, None if etag == known_etag else content_bytes
+
+def peek_file_version(path):
+    """
+    不读取文件内容，返回(etag, size)：etag取自延迟写入缓冲或ETag缓存，没有缓存时为None
+    """
+    pending = write_behind.get(path)
+    if pending:
+        return pending.etag, len(pending.content)
+    stat = os.stat(path)
+    return file_validators.get(path, stat), stat.st_size
+
+def resolve_bulk_read_files(db, params):
+    """
+    解析批量读取的范围
+    :param params: ids为文件ID列表；或folderId为文件夹ID（整棵子树）；或sessionId为整本书，
+                   子树超过BULK_READ_MAX_FILES个文件时分页，cursor为上一页返回的nextCursor
+    :return: ([(id, display_name, disk_path)], next_cursor)，只包含文件；ids中找不到的文件display_name和disk_path为None；
+             next_cursor为None表示已经是最后一页
+    """
+    ids = params.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(item_id, str) for item_id in ids):
+            raise ApiError('ids必须是文件ID列表')
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > BULK_READ_MAX_FILES:
+            raise ApiError(f'一次最多读取 {BULK_READ_MAX_FILES} 个文件')
+        if not ids:
+            return [], None
+        found = item_disk_paths(db, ids, item_type='file')
+        return [(item_id,) + found[item_id] if item_id in found else (item_id, None, None) for item_id in ids], None
+
+    cursor = params.get('cursor') or '0'
+    if not isinstance(cursor, str) or not cursor.isdigit():
+        raise ApiError('cursor无效')
+    offset = int(cursor)
+
+    folder_id = params.get('folderId')
+    if folder_id:
+        location = get_item_location(db, folder_id)
+        if not location or location[3] != 'folder':
+            raise ApiError('文件夹不存在', 404)
+        session_id, folder_path, rel_path, _ = location
+    elif params.get('sessionId'):
+        session_id, folder_id, rel_path = params['sessionId'], ROOT_PARENT_ID, ''
+        result = db.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if not result:
+            raise ApiError('会话不存在', 404)
+        folder_path = result[0]
+    else:
+        raise ApiError('必须提供ids、folderId或sessionId')
+
+    files = [
+        (item_id, display_name, item_disk_path(folder_path, item_rel_path))
+        for item_id, _, display_name, item_rel_path, item_type in fetch_subtree(db, session_id, folder_id, rel_path)
+        if item_type == 'file'
+    ]
+    # 分页按子树中的顺序，两次请求之间文件树发生变化时可能有重复或遗漏，客户端可按ETag重新读取
+    end = offset + BULK_READ_MAX_FILES
+    return files[offset:end], (str(end) if end < len(files) else None)
+
+def iter_bulk_read_records(files, known):
+    """
+    依次读取文件，生成每个文件的结果
+    客户端已有最新版本的文件只返回notModified；剩余的BULK_READ_MAX_BYTES放不下的文件只返回skipped，由客户端单独读取，
+    这样的文件不读取内容（etag只在已缓存时返回），之后较小的文件仍然返回内容
+    """
+    budget = BULK_READ_MAX_BYTES
+    for item_id, display_name, disk_path in files:
+        if disk_path is None:
+            yield {'id': item_id, 'error': '文件不存在'}
+            continue
+        known_etag = known.get(item_id)
+        try:
+            etag, size = peek_file_version(disk_path)
+            if size > budget and (etag is None or etag != known_etag):
+                yield {'id': item_id, 'name': display_name, 'filePath': disk_path, 'etag': etag, 'skipped': True}
+                continue
+            etag, content_bytes = read_file_version(disk_path, known_etag)
+        except OSError:
+            yield {'id': item_id, 'error': '文件不存在'}
+            continue
+        record = {'id': item_id, 'name': display_name, 'filePath': disk_path, 'etag': etag}
+        if content_bytes is None:
+            record['notModified'] = True
+        elif len(content_bytes) > budget:
+            # 读取前后文件变大
+            record['skipped'] = True
+        else:
+            budget -= len(content_bytes)
+            record['content'] = content_bytes.decode('utf-8')
+        yield record
+
+def _gzip_stream(chunks, flush_size=64 * 1024):
+    """
+    流式gzip压缩，积累到flush_size后输出一块，客户端可以边下载边解析
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_size:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
+# 批量读取文件内容的API（预取整个章节或整本书）
+# 请求：ids / folderId / sessionId 三选一；known为{文件ID: ETag}，对应文件未变化时不返回内容
+# 请求头Accept为application/x-ndjson时按文件逐行流式返回，否则返回{"files": [...], "nextCursor": ...}；
+# folderId/sessionId超过BULK_READ_MAX_FILES个文件时分页，nextCursor（同时在X-Next-Cursor头中）非空表示还有下一页；
+# 客户端支持gzip时压缩响应
+@app.route('/api/file-contents', methods=['POST'])
+def get_file_contents():
+    data = request.json or {}
+    known = data.get('known') or {}
+    if not isinstance(known, dict):
+        return jsonify({'error': 'known必须是文件ID到ETag的映射'}), 400
+
+    try:
+        with transaction(immediate=False) as db:
+            files, next_cursor = resolve_bulk_read_files(db, data)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    streaming = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+    if streaming:
+        # 还有下一页时最后一行为{"nextCursor": ...}
+        records = iter_bulk_read_records(files, known)
+        if next_cursor:
+            records = itertools.chain(records, [{'nextCursor': next_cursor}])
+        chunks = (json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n' for record in records)
+        mimetype = 'application/x-ndjson'
+    else:
+        body = {'files': list(iter_bulk_read_records(files, known)), 'nextCursor': next_cursor}
+        chunks = [json.dumps(body, ensure_ascii=False).encode('utf-8')]
+        mimetype = 'application/json'
+
+    compress = 'gzip' in request.accept_encodings
+    response = app.response_class(_gzip_stream(chunks) if compress else chunks, mimetype=mimetype)
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+# 全文搜索：文件的增删改在同一事务中维护索引，保存文件后更新正文
+SEARCH_REBUILD_COMMAND = 'rebuild-search-index'
+SEARCH_MAX_RESULTS = 100
+SEARCH_SNIPPET_CHARS = 40
+
+def update_search_document(path, content, etag):
+    """
+    保存文件后更新其全文索引，索引失败只记录日志，不影响保存
+    """
+    try:
+        with transaction() as db:
+            item = resolve_item_path(db, path)
+            if not item or item.item_type != 'file':
+                return
+            title = db.execute("SELECT display_name FROM file_mapping WHERE id = ?", (item.item_id,)).fetchone()[0]
+            index_search_document(db, item.item_id, item.session_id, title, content, etag)
+    except Exception:
+        logger.exception(f"更新全文索引失败: {path}")
+
+def rebuild_search_index(session_id=None, batch_size=200):
+    """
+    重建全文索引（冷启动、导入或索引与磁盘不一致时使用）
+    内容版本与索引中记录的相同的文件跳过，已不存在的文件从索引中删除
+    :param session_id: 只重建该会话，为None时重建全部会话
+    :return: {'indexed': 重新索引的文件数, 'unchanged': 跳过的文件数, 'removed': 删除的索引数}
+    """
+    stats = {'indexed': 0, 'unchanged': 0, 'removed': 0}
+    with transaction(immediate=False) as db:
+        if session_id:
+            sessions = db.execute("SELECT session_id, folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchall()
+        else:
+            sessions = db.execute("SELECT session_id, folder_path FROM sessions").fetchall()
+
+    for sid, folder_path in sessions:
+        with transaction(immediate=False) as db:
+            files = [
+                (item_id, display_name, item_disk_path(folder_path, rel_path))
+                for item_id, _, display_name, rel_path, item_type in fetch_subtree(db, sid)
+                if item_type == 'file'
+            ]
+            indexed = dict(db.execute("SELECT item_id, etag FROM search_docs WHERE session_id = ?", (sid,)).fetchall())
+
+        for start in range(0, len(files), batch_size):
+            documents = []
+            for item_id, display_name, disk_path in files[start:start + batch_size]:
+                try:
+                    etag, content_bytes = read_file_version(disk_path, indexed.get(item_id))
+                except OSError:
+                    continue
+                if content_bytes is None:
+                    stats['unchanged'] += 1
+                    continue
+                documents.append((item_id, display_name, content_bytes.decode('utf-8', 'replace'), etag))
+            with transaction() as db:
+                for item_id, display_name, content, etag in documents:
+                    index_search_document(db, item_id, sid, display_name, content, etag)
+            stats['indexed'] += len(documents)
+
+        stale = set(indexed) - {item_id for item_id, _, _ in files}
+        if stale:
+            with transaction() as db:
+                for item_id in stale:
+                    db.execute("DELETE FROM file_search WHERE rowid = (SELECT id FROM search_docs WHERE item_id = ?)", (item_id,))
+                    db.execute("DELETE FROM search_docs WHERE item_id = ?", (item_id,))
+                    db.execute("DELETE FROM image_refs WHERE item_id = ?", (item_id,))
+            stats['removed'] += len(stale)
+
+        with transaction() as db:
+            # 会话中的每个文件都已按当前内容建立索引（同时建立图片引用）时才标记为完整；
+            # 重建期间重新导入或有文件读取失败时保持未完成
+            missing = db.execute(
+                "SELECT 1 FROM file_mapping f LEFT JOIN search_docs d ON d.item_id = f.id "
+                "WHERE f.session_id = ? AND f.item_type = 'file' AND d.etag IS NULL LIMIT 1",
+                (sid,)
+            ).fetchone()
+            db.execute("UPDATE sessions SET image_refs_complete = ? WHERE session_id = ?", (0 if missing else 1, sid))
+
+    logger.info(f"全文索引重建完成: {session_id or '全部会话'} {stats}")
+    return stats
+
+@job_manager.register(SEARCH_REBUILD_COMMAND)
+def rebuild_search_index_job(params, cancel_event):
+    """
+    后台任务：重建全文索引
+    """
+    return dict(rebuild_search_index(params.get('session_id')), success=True)
+
+def _search_snippet(content, terms):
+    """
+    不使用FTS时生成摘要：取第一个命中词前后SEARCH_SNIPPET_CHARS个字符，命中词用<mark>标记
+    """
+    lower_content = content.lower()
+    hits = [(lower_content.find(term.lower()), term) for term in terms]
+    hits = [(index, term) for index, term in hits if index >= 0]
+    if not hits:
+        return content[:SEARCH_SNIPPET_CHARS * 2]
+    index, term = min(hits)
+    start = max(index - SEARCH_SNIPPET_CHARS, 0)
+    end = index + len(term) + SEARCH_SNIPPET_CHARS
+    return (
+        ('…' if start > 0 else '') + content[start:index] + '<mark>' + content[index:index + len(term)] + '</mark>'
+        + content[index + len(term):end] + ('…' if end < len(content) else '')
+    )
+
+def search_documents(db, session_id, query, limit):
+    """
+    在会话的全文索引中搜索，多个词之间是“并且”的关系
+    trigram分词无法匹配少于3个字符的词，这样的词改用LIKE在索引的正文中匹配
+    :return: [(item_id, snippet)]，按相关度排序
+    """
+    terms = query.split()[:10]
+    if SEARCH_MODE == 'like':
+        match_terms, like_terms = [], terms
+    elif SEARCH_MODE == 'trigram':
+        match_terms = [term for term in terms if len(term) >= 3]
+        like_terms = [term for term in terms if len(term) < 3]
+    else:
+        match_terms, like_terms = terms, []
+
+    conditions = ["d.session_id = ?"]
+    params = [session_id]
+    for term in like_terms:
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append("(file_search.title LIKE ? ESCAPE '\\' OR file_search.content LIKE ? ESCAPE '\\')")
+        params += [pattern, pattern]
+
+    if match_terms:
+        # 每个词作为一个短语，避免用户输入被当作FTS5查询语法
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in match_terms)
+        rows = db.execute(
+            f"""
+            SELECT d.item_id, snippet(file_search, -1, '<mark>', '</mark>', '…', 24)
+            FROM file_search JOIN search_docs d ON d.id = file_search.rowid
+            WHERE file_search MATCH ? AND {' AND '.join(conditions)}
+            ORDER BY bm25(file_search, 10.0, 1.0) LIMIT ?
+            """,
+            [match] + params + [limit]
+        ).fetchall()
+        return rows
+
+    # 标题命中的排在前面
+    rows = db.execute(
+        f"""
+        SELECT d.item_id, file_search.content
+        FROM file_search JOIN search_docs d ON d.id = file_search.rowid
+        WHERE {' AND '.join(conditions)}
+        ORDER BY instr(lower(file_search.title), lower(?)) = 0, file_search.title LIMIT ?
+        """,
+        params + [terms[0], limit]
+    ).fetchall()
+    return [(item_id, _search_snippet(content, terms)) for item_id, content in rows]
+
+# 全文搜索API：GET /api/search?sessionId=...&q=...&limit=...
+# 返回按相关度排序的文件及摘要，摘要中的命中词用<mark>标记（其余内容为原始markdown，显示前需转义）
+@app.route('/api/search', methods=['GET'])
+def search():
+    session_id = request.args.get('sessionId')
+    query = (request.args.get('q') or '').strip()
+    limit = min(request.args.get('limit', 20, type=int), SEARCH_MAX_RESULTS)
+
+    if not session_id:
+        return jsonify({'error': '会话ID不能为空'}), 400
+    if not query:
+        return jsonify({'error': '搜索内容不能为空'}), 400
+
+    try:
+        started = time.time()
+        with transaction(immediate=False) as db:
+            hits = search_documents(db, session_id, query, max(limit, 1))
+            paths = item_disk_paths(db, [item_id for item_id, _ in hits])
+        results = [
+            {'id': item_id, 'name': paths[item_id][0], 'filePath': paths[item_id][1], 'snippet': snippet}
+            for item_id, snippet in hits if item_id in paths
+        ]
+        return jsonify({'results': results, 'tookMs': round((time.time() - started) * 1000, 1)})
+    except sqlite3.OperationalError as e:
+        return jsonify({'error': f'搜索语法错误: {e}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 重建全文索引API（sessionId为空时重建全部会话），在后台任务中执行
+@app.route('/api/search/rebuild', methods=['POST'])
+def rebuild_search():
+    data = request.json or {}
+    try:
+        job_id = job_manager.submit(SEARCH_REBUILD_COMMAND, data.get('sessionId'), {'session_id': data.get('sessionId')})
+        if data.get('wait'):
+            return wait_for_job_response(job_id)
+        return jsonify({'success': True, 'jobId': job_id, 'status': 'queued'}), 202
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _schedule_search_index_cold_start():
+    """
+    升级后第一次启动时索引为空（或迁移清空了内容版本、有会话的图片引用未完成），在后台为已有的会话建立索引
+    """
+    db = get_db()
+    if (
+        db.execute("SELECT 1 FROM file_mapping LIMIT 1").fetchone()
+        and not db.execute("SELECT 1 FROM search_docs LIMIT 1").fetchone()
+    ) or db.execute("SELECT 1 FROM search_docs WHERE etag IS NULL LIMIT 1").fetchone() or _image_refs_incomplete(db):
+        logger.info("全文索引为空，开始在后台建立索引")
+        job_manager.submit(SEARCH_REBUILD_COMMAND, None, {})
+
+# 修订历史：每次保存前把文件内容记录为一个修订，内容按SHA-256去重保存在revision_blobs中
+# 最新的版本保存完整内容，较旧的版本在后台改为相对于后一个版本的行差量（反向差量），
+# 删除最旧的修订时不会影响其他版本，恢复最近的版本也不需要应用差量
+def _encode_delta(base_text, text):
+    """
+    计算从base_text得到text的行差量：[起始行, 结束行]表示复制基础版本中的行，字符串表示插入的内容
+    """
+    base_lines = base_text.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(lines[j1:j2]))
+    return json.dumps(ops).encode('utf-8')
+
+def _apply_delta(base_text, delta):
+    base_lines = base_text.splitlines(keepends=True)
+    return ''.join(
+        ''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in json.loads(delta)
+    )
+
+def _decode_text(content_bytes):
+    return content_bytes.decode('utf-8', 'surrogateescape')
+
+def load_revision_blob(db, blob_hash):
+    """
+    还原一个版本的完整内容：沿差量链找到完整内容，再依次应用差量
+    """
+    deltas = []
+    current = blob_hash
+    while True:
+        row = db.execute("SELECT base_hash, data FROM revision_blobs WHERE hash = ?", (current,)).fetchone()
+        if row is None:
+            raise KeyError(f'修订内容不存在: {current}')
+        base_hash, data = row
+        if base_hash is None:
+            text = _decode_text(zlib.decompress(data))
+            break
+        deltas.append(data)
+        current = base_hash
+    for data in reversed(deltas):
+        text = _apply_delta(text, zlib.decompress(data))
+    return text.encode('utf-8', 'surrogateescape')
+
+def _store_full_blob(db, blob_hash, content_bytes):
+    """
+    以完整内容保存版本；已存在的差量版本改为完整内容，避免之后以它为基础时形成环
+    """
+    db.execute(
+        "INSERT INTO revision_blobs (hash, base_hash, size, data) VALUES (?, NULL, ?, ?) "
+        "ON CONFLICT(hash) DO UPDATE SET base_hash = NULL, data = excluded.data WHERE base_hash IS NOT NULL",
+        (blob_hash, len(content_bytes), zlib.compress(content_bytes))
+    )
+
+def _dependent_chain_length(db, blob_hash):
+    """
+    以该版本为基础的最长差量链长度
+    """
+    return db.execute(
+        """
+        WITH RECURSIVE dependents(hash, depth) AS (
+            SELECT hash, 1 FROM revision_blobs WHERE base_hash = ?
+            UNION ALL
+            SELECT b.hash, d.depth + 1 FROM revision_blobs b JOIN dependents d ON b.base_hash = d.hash
+            WHERE d.depth <= ?
+        )
+        SELECT COALESCE(MAX(depth), 0) FROM dependents
+        """,
+        (blob_hash, REVISION_MAX_CHAIN)
+    ).fetchone()[0]
+
+def _blob_chain(db, blob_hash):
+    """
+    从该版本沿差量基础到完整内容经过的所有版本（包括它自己）
+    """
+    return [row[0] for row in db.execute(
+        """
+        WITH RECURSIVE chain(hash, base_hash) AS (
+            SELECT hash, base_hash FROM revision_blobs WHERE hash = ?
+            UNION
+            SELECT b.hash, b.base_hash FROM revision_blobs b JOIN chain c ON b.hash = c.base_hash
+        )
+        SELECT hash FROM chain
+        """,
+        (blob_hash,)
+    )]
+
+def _can_rebase(db, blob_hash, base_hash):
+    """
+    能否把一个版本改为相对于base_hash的差量：base_hash必须仍然存在（可能已被合并替换后回收），不能形成环，
+    恢复最旧的版本时应用的差量不能超过REVISION_MAX_CHAIN个
+    """
+    chain = _blob_chain(db, base_hash)
+    return bool(chain) and blob_hash not in chain and _dependent_chain_length(db, blob_hash) + len(chain) <= REVISION_MAX_CHAIN
+
+def _encode_rebase(db, blob_hash, base_hash):
+    """
+    计算把一个版本改为相对于base_hash的差量后保存的数据
+    :return: 压缩后的差量；不能改为差量或差量不比完整内容小时返回None
+    """
+    if not _can_rebase(db, blob_hash, base_hash):
+        return None
+    text = _decode_text(load_revision_blob(db, blob_hash))
+    delta = zlib.compress(_encode_delta(_decode_text(load_revision_blob(db, base_hash)), text))
+    if len(delta) >= len(zlib.compress(text.encode('utf-8', 'surrogateescape'))):
+        return None
+    return delta
+
+def _gc_revision_blobs(db, candidates):
+    """
+    删除既没有修订引用、也不是其他版本的差量基础的内容
+    """
+    pending = set(candidates)
+    progress = True
+    while pending and progress:
+        progress = False
+        for blob_hash in list(pending):
+            if db.execute(
+                "SELECT 1 FROM revisions WHERE blob_hash = ? UNION ALL SELECT 1 FROM revision_blobs WHERE base_hash = ? LIMIT 1",
+                (blob_hash, blob_hash)
+            ).fetchone():
+                continue
+            row = db.execute("SELECT base_hash FROM revision_blobs WHERE hash = ?", (blob_hash,)).fetchone()
+            db.execute("DELETE FROM revision_blobs WHERE hash = ?", (blob_hash,))
+            pending.discard(blob_hash)
+            if row and row[0]:
+                pending.add(row[0])
+            progress = True
+
+def _drop_revision(db, revision_id, blob_hash):
+    """
+    删除一个修订；其内容不再被引用时，把以它为基础的差量改为以它的基础为基础（或完整内容），再回收
+    """
+    db.execute("DELETE FROM revisions WHERE id = ?", (revision_id,))
+    if db.execute("SELECT 1 FROM revisions WHERE blob_hash = ? LIMIT 1", (blob_hash,)).fetchone():
+        return
+    base_hash = db.execute("SELECT base_hash FROM revision_blobs WHERE hash = ?", (blob_hash,)).fetchone()[0]
+    for (dependent_hash,) in db.execute("SELECT hash FROM revision_blobs WHERE base_hash = ?", (blob_hash,)).fetchall():
+        content_bytes = load_revision_blob(db, dependent_hash)
+        if base_hash:
+            delta = _encode_delta(_decode_text(load_revision_blob(db, base_hash)), _decode_text(content_bytes))
+            db.execute(
+                "UPDATE revision_blobs SET base_hash = ?, data = ? WHERE hash = ?",
+                (base_hash, zlib.compress(delta), dependent_hash)
+            )
+        else:
+            _store_full_blob(db, dependent_hash, content_bytes)
+    _gc_revision_blobs(db, [blob_hash])
+
+def apply_revision_retention(db, item_id, now=None):
+    """
+    按保留策略清理一个文件的修订：最新的修订总是保留
+    """
+    now = now or time.time()
+    rows = db.execute(
+        "SELECT id, blob_hash, created_at FROM revisions WHERE item_id = ? ORDER BY created_at DESC, id DESC",
+        (item_id,)
+    ).fetchall()
+    kept_days = set()
+    for index, (revision_id, blob_hash, created_at) in enumerate(rows):
+        age = now - created_at
+        if index == 0:
+            kept_days.add(int(created_at // 86400))
+            continue
+        drop = index >= REVISION_MAX_PER_FILE or age > REVISION_KEEP_DAYS * 86400
+        if not drop and age > 86400:
+            # 一天以前的修订每天只保留最后一个
+            day = int(created_at // 86400)
+            drop = day in kept_days
+            kept_days.add(day)
+        if drop:
+            _drop_revision(db, revision_id, blob_hash)
+
+def record_revision(db, item_id, session_id, content_bytes, previous_loader=None, coalesce=True):
+    """
+    记录文件的一个新版本
+    :param previous_loader: 文件还没有修订时用于读取保存前的内容，作为第一个修订
+    :param coalesce: 最近的修订在REVISION_MIN_INTERVAL秒内时直接替换它
+    :return: 修订ID，内容与最近的修订相同时返回None
+    """
+    now = time.time()
+    latest = db.execute(
+        "SELECT id, blob_hash, created_at FROM revisions WHERE item_id = ? ORDER BY created_at DESC, id DESC LIMIT 1",
+        (item_id,)
+    ).fetchone()
+    if latest is None and previous_loader is not None:
+        previous_bytes = previous_loader()
+        if previous_bytes is not None and previous_bytes != content_bytes:
+            previous_hash = hashlib.sha256(previous_bytes).hexdigest()
+            _store_full_blob(db, previous_hash, previous_bytes)
+            revision_id = db.execute(
+                "INSERT INTO revisions (item_id, session_id, blob_hash, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                (item_id, session_id, previous_hash, len(previous_bytes), now)
+            ).lastrowid
+            # 保存前的内容不参与合并
+            latest = (revision_id, previous_hash, 0)
+
+    blob_hash = hashlib.sha256(content_bytes).hexdigest()
+    if latest and latest[1] == blob_hash:
+        return None
+    _store_full_blob(db, blob_hash, content_bytes)
+
+    if latest and coalesce and now - latest[2] < REVISION_MIN_INTERVAL:
+        # 合并到最近的修订；被替换的版本仍是更早修订的差量基础时，在后台改为以新内容为基础后回收
+        revision_id = latest[0]
+        db.execute(
+            "UPDATE revisions SET blob_hash = ?, size = ?, created_at = ? WHERE id = ?",
+            (blob_hash, len(content_bytes), now, revision_id)
+        )
+        _gc_revision_blobs(db, [latest[1]])
+    else:
+        revision_id = db.execute(
+            "INSERT INTO revisions (item_id, session_id, blob_hash, size, created_at) VALUES (?, ?, ?, ?, ?)",
+            (item_id, session_id, blob_hash, len(content_bytes), now)
+        ).lastrowid
+
+    after_commit(lambda: schedule_revision_maintenance(item_id))
+    return revision_id
+
+# 保存时只写入新版本的完整内容；把较旧的修订改为差量以及按保留策略清理在后台线程中执行，
+# 同一文件的多次保存只处理一次
+revision_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='revision')
+_pending_revision_items = set()
+_pending_revision_lock = threading.Lock()
+
+def schedule_revision_maintenance(item_id):
+    """
+    在后台处理文件的修订，该文件已在等待处理时不重复提交
+    """
+    with _pending_revision_lock:
+        if item_id in _pending_revision_items:
+            return
+        _pending_revision_items.add(item_id)
+    revision_executor.submit(_run_revision_maintenance, item_id)
+
+def _run_revision_maintenance(item_id):
+    with _pending_revision_lock:
+        _pending_revision_items.discard(item_id)
+    try:
+        rebase_revisions(item_id)
+    except Exception:
+        logger.exception(f"处理修订失败: {item_id}")
+
+def _pending_rebases(db, item_id):
+    """
+    找出需要改为差量的修订内容：从最新的修订向前，每个版本应以后一个修订的内容为基础，
+    遇到已经以后一个修订为基础的版本时停止（更早的已经处理过）；最新修订的内容始终保存完整内容
+    :return: [(内容hash, 当前的基础, 新的基础)]，从旧到新排列
+    """
+    rows = db.execute(
+        "SELECT r.blob_hash, b.base_hash FROM revisions r JOIN revision_blobs b ON b.hash = r.blob_hash "
+        "WHERE r.item_id = ? ORDER BY r.created_at DESC, r.id DESC LIMIT ?",
+        (item_id, REVISION_MAX_CHAIN + 1)
+    ).fetchall()
+    if not rows:
+        return []
+    latest_hash = rows[0][0]
+    pending = []
+    for (newer_hash, _), (blob_hash, base_hash) in zip(rows, rows[1:]):
+        if base_hash == newer_hash:
+            break
+        if blob_hash not in (newer_hash, latest_hash):
+            pending.append((blob_hash, base_hash, newer_hash))
+    return pending[::-1]
+
+def rebase_revisions(item_id):
+    """
+    把文件较旧的修订改为相对于后一个修订的差量（反向差量），再按保留策略清理
+    差量在只读事务中计算，写入时确认该版本没有被其他操作改变，计算期间不阻塞保存
+    """
+    with transaction(immediate=False) as db:
+        pending = _pending_rebases(db, item_id)
+    for blob_hash, old_base, new_base in pending:
+        with transaction(immediate=False) as db:
+            delta = _encode_rebase(db, blob_hash, new_base)
+            # 不能改为差量时保存为完整内容，原来的基础（被合并替换的版本）才能回收
+            full_bytes = load_revision_blob(db, blob_hash) if delta is None and old_base is not None else None
+        with transaction() as db:
+            row = db.execute("SELECT base_hash FROM revision_blobs WHERE hash = ?", (blob_hash,)).fetchone()
+            if row is None or row[0] != old_base:
+                continue
+            if delta is not None and _can_rebase(db, blob_hash, new_base):
+                db.execute("UPDATE revision_blobs SET base_hash = ?, data = ? WHERE hash = ?", (new_base, delta, blob_hash))
+            elif full_bytes is not None:
+                _store_full_blob(db, blob_hash, full_bytes)
+            if old_base is not None:
+                _gc_revision_blobs(db, [old_base])
+    with transaction() as db:
+        apply_revision_retention(db, item_id)
+
+def delete_revisions(db, condition, params):
+    """
+    删除满足条件的修订并回收不再需要的内容
+    """
+    blob_hashes = [row[0] for row in db.execute(f"SELECT DISTINCT blob_hash FROM revisions WHERE {condition}", params)]
+    if blob_hashes:
+        db.execute(f"DELETE FROM revisions WHERE {condition}", params)
+        _gc_revision_blobs(db, blob_hashes)
+
+def record_file_revision(path, content_bytes, coalesce=True, previous_on_disk=False):
+    """
+    保存文件前记录修订，失败只记录日志，不影响保存；调用方持有file_write_lock(path)
+    :param previous_on_disk: 文件还没有修订时以磁盘上的内容（而不是延迟写入缓冲中的内容）作为保存前的版本
+    """
+    def read_previous():
+        try:
+            if previous_on_disk:
+                with open(path, 'rb') as f:
+                    return f.read()
+            return read_file_version(path)[1]
+        except OSError:
+            return None
+    try:
+        with transaction() as db:
+            item = resolve_item_path(db, path)
+            if item and item.item_type == 'file':
+                record_revision(db, item.item_id, item.session_id, content_bytes, read_previous, coalesce)
+    except Exception:
+        logger.exception(f"记录修订失败: {path}")
+
+def write_file_content(path, content_bytes, etag, coalesce=True):
+    """
+    写入文件的新内容：记录修订、写入磁盘（或放入延迟写入缓冲）、更新ETag和全文索引
+    启用延迟写入时修订和全文索引在刷新到磁盘时更新，连续保存只处理一次
+    调用方必须持有file_write_lock(path)
+    """
+    if write_behind.enabled:
+        if not coalesce:
+            # 不合并的修订（如恢复旧版本）立即记录
+            record_file_revision(path, content_bytes, coalesce)
+        # 写入日志后即确认，稍后合并写入磁盘
+        write_behind.put(path, content_bytes, etag)
+        return
+    record_file_revision(path, content_bytes, coalesce)
+    # 原子写入文件内容
+    stat = atomic_write_bytes(path, content_bytes)
+    file_validators.put(path, stat, etag)
+    update_search_document(path, content_bytes.decode('utf-8'), etag)
+
+def _revision_info(row):
+    revision_id, blob_hash, size, created_at = row
+    return {
+        'id': revision_id,
+        'hash': blob_hash,
+        'size': size,
+        'createdAt': datetime.fromtimestamp(created_at).isoformat(timespec='seconds')
+    }
+
+def _get_revision(db, revision_id):
+    """
+    :return: (item_id, blob_hash, created_at)，不存在时返回None
+    """
+    return db.execute("SELECT item_id, blob_hash, created_at FROM revisions WHERE id = ?", (revision_id,)).fetchone()
+
+# 获取文件的修订列表（最新的在前）
+@app.route('/api/revisions', methods=['GET'])
+def list_revisions():
+    file_path = request.args.get('filePath')
+
+    if not file_path:
+        return jsonify({'error': '文件路径不能为空'}), 400
+
+    try:
+        with transaction(immediate=False) as db:
+            item = resolve_item_path(db, os.path.abspath(file_path))
+            if not item or item.item_type != 'file':
+                return jsonify({'error': '文件不存在于数据库中'}), 404
+            rows = db.execute(
+                "SELECT id, blob_hash, size, created_at FROM revisions WHERE item_id = ? ORDER BY created_at DESC, id DESC",
+                (item.item_id,)
+            ).fetchall()
+        return jsonify({'id': item.item_id, 'revisions': [_revision_info(row) for row in rows]})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 获取某个修订的内容
+@app.route('/api/revisions/<int:revision_id>', methods=['GET'])
+def get_revision(revision_id):
+    try:
+        with transaction(immediate=False) as db:
+            revision = _get_revision(db, revision_id)
+            if not revision:
+                return jsonify({'error': '修订不存在'}), 404
+            content_bytes = load_revision_blob(db, revision[1])
+        response = jsonify({'id': revision_id, 'content': content_bytes.decode('utf-8', 'replace')})
+        # 修订内容不会改变
+        response.set_etag(revision[1])
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        return response.make_conditional(request)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 比较两个版本：against为另一个修订ID或current（文件当前内容），默认与前一个修订比较
+@app.route('/api/revisions/<int:revision_id>/diff', methods=['GET'])
+def diff_revision(revision_id):
+    against = request.args.get('against')
+    try:
+        with transaction(immediate=False) as db:
+            revision = _get_revision(db, revision_id)
+            if not revision:
+                return jsonify({'error': '修订不存在'}), 404
+            item_id, blob_hash, created_at = revision
+            new_bytes = load_revision_blob(db, blob_hash)
+            new_label = f'revision {revision_id}'
+
+            if against == 'current':
+                location = get_item_location(db, item_id)
+                if not location:
+                    return jsonify({'error': '文件不存在于数据库中'}), 404
+                # 当前内容作为新版本
+                old_bytes, old_label = new_bytes, new_label
+                new_bytes = read_file_version(item_disk_path(location[1], location[2]))[1]
+                new_label = 'current'
+            else:
+                if against:
+                    other = _get_revision(db, int(against))
+                    if not other or other[0] != item_id:
+                        return jsonify({'error': '比较的修订不存在'}), 404
+                    other_id = int(against)
+                else:
+                    row = db.execute(
+                        "SELECT id FROM revisions WHERE item_id = ? AND (created_at < ? OR (created_at = ? AND id < ?)) ORDER BY created_at DESC, id DESC LIMIT 1",
+                        (item_id, created_at, created_at, revision_id)
+                    ).fetchone()
+                    other_id = row[0] if row else None
+                    other = _get_revision(db, other_id) if other_id else None
+                old_bytes = load_revision_blob(db, other[1]) if other else b''
+                old_label = f'revision {other_id}' if other else 'empty'
+
+        diff = ''.join(difflib.unified_diff(
+            old_bytes.decode('utf-8', 'replace').splitlines(keepends=True),
+            new_bytes.decode('utf-8', 'replace').splitlines(keepends=True),
+            fromfile=old_label, tofile=new_label
+        ))
+        return jsonify({'diff': diff})
+    except ValueError:
+        return jsonify({'error': 'against必须是修订ID或current'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# 把文件恢复到某个修订（恢复本身也会记录为一个新修订，可以撤销）；带If-Match时只有当前版本一致才恢复
+@app.route('/api/revisions/<int:revision_id>/restore', methods=['POST'])
+def restore_revision(revision_id):
+    try:
+        with transaction(immediate=False) as db:
+            revision = _get_revision(db, revision_id)
+            if not revision:
+                return jsonify({'error': '修订不存在'}), 404
+            location = get_item_location(db, revision[0])
+            if not location:
+                return jsonify({'error': '文件不存在于数据库中'}), 404
+            content_bytes = load_revision_blob(db, revision[1])
+        normalized_path = item_disk_path(location[1], location[2])
+
+        with file_write_lock(normalized_path):
+            if request.if_match:
+                pending = write_behind.get(normalized_path)
+                current_etag = pending.etag if pending else file_validators.current(normalized_path)
+                if not request.if_match.contains(current_etag) and not request.if_match.star_tag:
+                    response = jsonify({'error': '文件已被其他人修改，请重新打开后再恢复', 'etag': current_etag})
+                    response.set_etag(current_etag)
+                    return response, 412
+            etag = file_validators.compute(content_bytes)
+            write_file_content(normalized_path, content_bytes, etag, coalesce=False)
+
+        response = jsonify({'success': True, 'filePath': normalized_path, 'etag': etag, 'content': content_bytes.decode('utf-8')})
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def compact_revisions():
+    """
+    对所有文件执行差量压缩和保留策略（长时间没有保存的文件不会在保存后处理，进程退出时未处理完的文件也在这里补上）
+    """
+    with transaction(immediate=False) as db:
+        item_ids = [row[0] for row in db.execute("SELECT DISTINCT item_id FROM revisions")]
+    for item_id in item_ids:
+        rebase_revisions(item_id)
+    with transaction(immediate=False) as db:
+        revisions, blobs, stored = db.execute(
+            "SELECT (SELECT COUNT(*) FROM revisions), COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM revision_blobs"
+        ).fetchone()
+    return {'files': len(item_ids), 'revisions': revisions, 'blobs': blobs, 'storedBytes': stored}
+
+@job_manager.register('compact-revisions')
+def compact_revisions_job(params, cancel_event):
+    """
+    后台任务：压缩并按保留策略清理所有文件的修订
+    """
+    return dict(compact_revisions(), success=True)
+
+# 按保留策略清理修订历史，在后台任务中执行
+@app.route('/api/revisions/compact', methods=['POST'])
+def compact_revisions_api():
+    data = request.json or {}
+    try:
+        job_id = job_manager.submit('compact-revisions', None, {})
+        if data.get('wait'):
+            return wait_for_job_response(job_id)
+        return jsonify({'success': True, 'jobId': job_id, 'status': 'queued'}), 202
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # 保存文件内容的API
+# 支持两种方式：content为完整内容；edits为相对If-Match所指版本的范围编辑（补丁保存，必须带If-Match）
 @app.route('/api/save-file', methods=['POST'])
 def save_file():
     data = request.json
     file_path = data.get('filePath')
     content = data.get('content')
+    edits = data.get('edits')
 
     if not file_path:
         return jsonify({'error': '文件路径不能为空'}), 400
 
-    if content is None:
+    if content is None and edits is None:
         return jsonify({'error': '文件内容不能为空'}), 400
 
+    if edits is None and not isinstance(content, str):
+        return jsonify({'error': '文件内容必须是字符串'}), 400
+
+    if edits is not None:
+        if not isinstance(edits, list):
+            return jsonify({'error': '补丁格式错误'}), 400
+        # 补丁必须基于确定的版本
+        if not request.if_match:
+            return jsonify({'error': '补丁保存必须提供If-Match版本'}), 428
+
     try:
+        normalized_path = os.path.abspath(file_path)
+
         # 检查文件是否存在
-        if not os.path.exists(file_path):
+        if not os.path.exists(normalized_path):
             return jsonify({'error': '文件不存在'}), 404
 
-        # 写入文件内容
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        return jsonify({'success': True, 'message': '文件保存成功'})
+        with file_write_lock(normalized_path):
+            # 带If-Match时只有客户端持有的版本仍是最新才允许写入，避免覆盖其他标签页的修改
+            pending = write_behind.get(normalized_path)
+            if request.if_match:
+                current_etag = pending.etag if pending else file_validators.current(normalized_path)
+                if not request.if_match.contains(current_etag) and not request.if_match.star_tag:
+                    response = jsonify({'error': '文件已被其他人修改，请重新打开后再保存', 'etag': current_etag})
+                    response.set_etag(current_etag)
+                    return response, 412
+
+            if edits is not None:
+                # 在服务器上把补丁应用到当前版本
+                if pending:
+                    content = apply_text_edits(pending.content.decode('utf-8'), edits)
+                else:
+                    with open(normalized_path, 'r', encoding='utf-8', newline='') as f:
+                        content = apply_text_edits(f.read(), edits)
+
+            content_bytes = content.encode('utf-8')
+            etag = file_validators.compute(content_bytes)
+            write_file_content(normalized_path, content_bytes, etag)
+
+        response = jsonify({'success': True, 'message': '文件保存成功', 'etag': etag})
+        response.set_etag(etag)
+        return response
+    except PatchError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -696,63 +4283,427 @@ def export_book():
     session_id = data.get('sessionId')
 
     if not session_id:
-        logger.error("导出电子书失败: 会话ID不能为空")
+        logger.error("导出电子书失败: 会话ID不能为空")
+        return jsonify({'error': '会话ID不能为空'}), 400
+
+    try:
+        # 从数据库中获取文件夹路径
+        result = get_db().execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+
+        if not result:
+            logger.error(f"导出电子书失败: 会话不存在 - {session_id}")
+            return jsonify({'error': '会话不存在'}), 404
+
+        folder_path = result[0]
+
+        # 检查文件夹是否存在
+        if not os.path.exists(folder_path):
+            logger.error(f"导出电子书失败: 文件夹不存在 - {folder_path}")
+            return jsonify({'error': '文件夹不存在'}), 404
+
+        # 导出前先把缓冲中的保存写入磁盘
+        write_behind.flush(folder_path)
+
+        # 内容与上次发布完全相同且发布结果仍在时，直接返回已有的发布结果；force为真时强制重新发布
+        target_book_folder = os.path.join(USER_FOLDER, session_id, '_book')
+        previous = load_build_manifest(session_id)
+        if previous and not data.get('force') and os.path.isdir(target_book_folder):
+            manifest = compute_build_manifest(folder_path, previous)
+            if manifest['tree_hash'] == previous['tree_hash']:
+                logger.info(f"内容未变化，跳过gitbook build: {folder_path}")
+                return jsonify({
+                    'success': True,
+                    'message': '内容未变化，使用已有的发布结果',
+                    'output': '',
+                    'book_path': target_book_folder,
+                    'skipped': True,
+                    'changes': diff_build_manifest(manifest, manifest)
+                })
+
+        # 放入后台任务执行，wait为真时保持原来的阻塞行为
+        job_id = job_manager.submit('export-book', session_id, {'session_id': session_id, 'folder_path': folder_path})
+        if data.get('wait'):
+            return wait_for_job_response(job_id)
+        return jsonify({'success': True, 'jobId': job_id, 'status': 'queued'}), 202
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.exception(f"导出电子书时发生异常: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@job_manager.register('export-book')
+def export_book_job(params, cancel_event):
+    """
+    后台任务：执行gitbook build并把_book文件夹移动到会话文件夹
+    """
+    session_id = params['session_id']
+    folder_path = params['folder_path']
+
+    # 在构建前计算清单，构建期间发生的修改会在下次发布时被发现
+    write_behind.flush(folder_path)
+    previous = load_build_manifest(session_id)
+    manifest = compute_build_manifest(folder_path, previous)
+    changes = diff_build_manifest(previous, manifest)
+
+    logger.info(f"开始执行 gitbook build: {folder_path}")
+    returncode, stdout, stderr = run_gitbook_command(f'build {folder_path}', cancel_event=cancel_event)
+    
+    if returncode != 0:
+        logger.error(f"gitbook build 失败: {stderr}")
+        raise RuntimeError(f'gitbook build失败: {stderr}')
+
+    # 移动 _book 文件夹
+    source_book_folder = os.path.join(folder_path, '_book')
+    if not os.path.exists(source_book_folder):
+        logger.error(f"_book文件夹不存在: {source_book_folder}")
+        raise RuntimeError('_book文件夹不存在，请检查gitbook build是否成功')
+
+    target_session_folder = os.path.join(USER_FOLDER, session_id)
+    os.makedirs(target_session_folder, exist_ok=True)
+    target_book_folder = os.path.join(target_session_folder, '_book')
+
+    if os.path.exists(target_book_folder):
+        shutil.rmtree(target_book_folder)
+
+    shutil.move(source_book_folder, target_session_folder)
+    logger.info(f"电子书导出成功: {target_book_folder}")
+
+    # 记录本次发布的清单和变化的文件，供后续的增量处理使用
+    manifest['changes'] = changes
+    save_build_manifest(session_id, manifest)
+
+    return {
+        'success': True,
+        'message': '导出成功',
+        'output': stdout,
+        'book_path': target_book_folder,
+        'skipped': False,
+        'changes': changes
+    }
+
+# 增量发布：每次发布后在会话文件夹中保存内容清单（md文件、book.json和md中引用的图片的哈希），
+# 下次发布时内容哈希相同则跳过gitbook build，不同则记录具体变化的文件
+BUILD_MANIFEST_NAME = 'build-manifest.json'
+BUILD_MANIFEST_VERSION = 1
+# 图片上传到PIC_FOLDER后通过 /api/get-image/<filename> 引用，清单中以该前缀区分
+MANIFEST_PIC_PREFIX = '@pic/'
+IMAGE_REF_PATTERN = re.compile(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)|<img\s[^>]*?src\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+def _build_manifest_path(session_id):
+    return os.path.join(USER_FOLDER, session_id, BUILD_MANIFEST_NAME)
+
+def load_build_manifest(session_id):
+    """
+    读取上次发布的清单，不存在或格式不符时返回None
+    """
+    try:
+        with open(_build_manifest_path(session_id), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return manifest if manifest.get('version') == BUILD_MANIFEST_VERSION else None
+    except (OSError, ValueError):
+        return None
+
+def save_build_manifest(session_id, manifest):
+    """
+    保存发布清单（原子写入，避免留下不完整的清单）
+    """
+    path = _build_manifest_path(session_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_write_bytes(path, json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+
+def _extract_image_refs(md_rel_path, content):
+    """
+    提取md内容中引用的本地图片，返回清单中的键
+    """
+    refs = set()
+    for match in IMAGE_REF_PATTERN.finditer(content):
+        url = unquote((match.group(1) or match.group(2)).split('#')[0].split('?')[0])
+        if '/api/get-image/' in url:
+            refs.add(MANIFEST_PIC_PREFIX + url.rsplit('/api/get-image/', 1)[1])
+        elif '://' in url or url.startswith(('data:', '//')):
+            # 站外图片不在清单范围内
+            continue
+        else:
+            if url.startswith('/'):
+                rel_path = os.path.normpath(url.lstrip('/'))
+            else:
+                rel_path = os.path.normpath(os.path.join(os.path.dirname(md_rel_path), url))
+            if not rel_path.startswith('..'):
+                refs.add(rel_path.replace(os.sep, '/'))
+    return sorted(refs)
+
+def compute_build_manifest(folder_path, previous=None):
+    """
+    计算文件夹的发布清单 {'version', 'tree_hash', 'files': {相对路径: {hash, size, mtime_ns[, images]}}}
+    大小和修改时间与上次清单相同的文件直接复用上次的哈希，不重新读取
+    """
+    previous_files = (previous or {}).get('files', {})
+    files = {}
+
+    def file_entry(key, path, is_markdown):
+        stat = os.stat(path)
+        old = previous_files.get(key)
+        if old and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns:
+            return old
+        digest = hashlib.sha256()
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        with open(path, 'rb') as f:
+            if is_markdown:
+                content = f.read()
+                digest.update(content)
+                entry['images'] = _extract_image_refs(key, content.decode('utf-8', errors='ignore'))
+            else:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        entry['hash'] = digest.hexdigest()
+        return entry
+
+    # md文件（包括SUMMARY.md）和book.json
+    for dir_path, dir_names, file_names in os.walk(folder_path):
+        dir_names[:] = [name for name in dir_names if name not in IMPORT_SKIP_DIRS]
+        rel_dir = os.path.relpath(dir_path, folder_path)
+        for file_name in file_names:
+            if not file_name.endswith('.md') and not (file_name == 'book.json' and rel_dir == '.'):
+                continue
+            key = os.path.normpath(os.path.join(rel_dir, file_name)).replace(os.sep, '/')
+            files[key] = file_entry(key, os.path.join(dir_path, file_name), file_name.endswith('.md'))
+
+    # md中引用的图片
+    image_keys = {ref for entry in list(files.values()) for ref in entry.get('images', ())}
+    for key in image_keys:
+        if key.startswith(MANIFEST_PIC_PREFIX):
+            path = image_disk_path(os.path.basename(key[len(MANIFEST_PIC_PREFIX):]))
+        else:
+            path = os.path.join(folder_path, key)
+        if key not in files and os.path.isfile(path):
+            files[key] = file_entry(key, path, False)
+
+    tree_digest = hashlib.sha256()
+    for key in sorted(files):
+        tree_digest.update(f"{key}\0{files[key]['hash']}\n".encode('utf-8'))
+
+    return {
+        'version': BUILD_MANIFEST_VERSION,
+        'tree_hash': tree_digest.hexdigest(),
+        'files': files
+    }
+
+def diff_build_manifest(previous, manifest):
+    """
+    比较两次清单，返回新增、修改和删除的文件（没有上次清单时所有文件都算新增）
+    """
+    old_files = (previous or {}).get('files', {})
+    new_files = manifest['files']
+    return {
+        'added': sorted(key for key in new_files if key not in old_files),
+        'modified': sorted(key for key in new_files if key in old_files and old_files[key]['hash'] != new_files[key]['hash']),
+        'removed': sorted(key for key in old_files if key not in new_files)
+    }
+
+# 下载发布结果：不生成临时压缩包，按请求边读文件边输出不压缩（STORED）的zip
+# 每个条目的大小和CRC32都已知时整个压缩包的布局是确定的，Range请求可以直接定位到对应文件的对应位置；
+# 条目索引按_book的指纹（文件路径、大小、修改时间）缓存在内存和会话文件夹中，重复下载不需要重新计算CRC
+BOOK_ZIP_INDEX_NAME = 'book-zip-index.json'
+BOOK_ZIP_INDEX_CACHE_SIZE = 16
+BOOK_ZIP_CHUNK_SIZE = 256 * 1024
+
+BookZipEntry = namedtuple('BookZipEntry', 'name path size crc mtime offset')
+
+_book_zip_indexes = OrderedDict()
+_book_zip_lock = threading.Lock()
+
+def scan_book_output(book_folder):
+    """
+    列出_book文件夹中的所有文件
+    :return: ([(zip中的名称, 磁盘路径, stat)]，按名称排序, 指纹)
+    """
+    files = []
+    for root, dirs, names in os.walk(book_folder):
+        dirs.sort()
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files.append((os.path.relpath(path, book_folder).replace(os.sep, '/'), path, stat))
+    files.sort(key=lambda item: item[0])
+    digest = hashlib.sha256()
+    for name, _, stat in files:
+        digest.update(f'{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return files, digest.hexdigest()[:32]
+
+def _file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(BOOK_ZIP_CHUNK_SIZE)
+            if not chunk:
+                return crc
+            crc = zlib.crc32(chunk, crc)
+
+def _zip_local_header(entry, name_bytes):
+    dos_time, dos_date = _zip_dos_datetime(entry.mtime)
+    return struct.pack(
+        '<IHHHHHIIIHH', 0x04034b50, 10, 0x0800, 0, dos_time, dos_date,
+        entry.crc, entry.size, entry.size, len(name_bytes), 0
+    ) + name_bytes
+
+def _zip_central_header(entry, name_bytes):
+    dos_time, dos_date = _zip_dos_datetime(entry.mtime)
+    return struct.pack(
+        '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 10, 0x0800, 0, dos_time, dos_date,
+        entry.crc, entry.size, entry.size, len(name_bytes), 0, 0, 0, 0, 0o100644 << 16, entry.offset
+    ) + name_bytes
+
+def _zip_dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def load_book_zip_index(session_id, book_folder):
+    """
+    获取_book对应zip的条目索引，_book的指纹未变化时使用缓存
+    :return: (指纹, [BookZipEntry], 压缩包总字节数)
+    """
+    files, fingerprint = scan_book_output(book_folder)
+    with _book_zip_lock:
+        cached = _book_zip_indexes.get(session_id)
+        if cached and cached[0] == fingerprint:
+            _book_zip_indexes.move_to_end(session_id)
+            return cached
+
+    # 内存中没有时读取保存在会话文件夹中的CRC，仍然没有再逐个计算
+    index_path = os.path.join(USER_FOLDER, session_id, BOOK_ZIP_INDEX_NAME)
+    crcs = {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('fingerprint') == fingerprint:
+            crcs = saved['crcs']
+    except (OSError, ValueError):
+        pass
+    computed = not crcs
+
+    entries = []
+    offset = 0
+    for name, path, stat in files:
+        if stat.st_size > 0xFFFFFFFF:
+            raise ApiError('发布结果中有超过4GB的文件，无法打包下载', 413)
+        crc = crcs[name] if name in crcs else _file_crc32(path)
+        entry = BookZipEntry(name, path, stat.st_size, crc, stat.st_mtime, offset)
+        entries.append(entry)
+        offset += 30 + len(name.encode('utf-8')) + entry.size
+    central_size = sum(46 + len(entry.name.encode('utf-8')) for entry in entries)
+    total = offset + central_size + 22
+    if total > 0xFFFFFFFF or len(entries) > 0xFFFF:
+        raise ApiError('发布结果过大，无法打包下载', 413)
+
+    if computed:
+        atomic_write_bytes(index_path, json.dumps({
+            'fingerprint': fingerprint,
+            'crcs': {entry.name: entry.crc for entry in entries}
+        }, ensure_ascii=False).encode('utf-8'))
+
+    result = (fingerprint, entries, total)
+    with _book_zip_lock:
+        _book_zip_indexes[session_id] = result
+        _book_zip_indexes.move_to_end(session_id)
+        while len(_book_zip_indexes) > BOOK_ZIP_INDEX_CACHE_SIZE:
+            _book_zip_indexes.popitem(last=False)
+    return result
+
+def _book_zip_segments(entries):
+    """
+    按顺序生成压缩包的各个部分：bytes为头部数据，(路径, 大小)为文件内容
+    """
+    for entry in entries:
+        yield _zip_local_header(entry, entry.name.encode('utf-8'))
+        yield (entry.path, entry.size)
+    central_offset = 0
+    if entries:
+        last = entries[-1]
+        central_offset = last.offset + 30 + len(last.name.encode('utf-8')) + last.size
+    central_size = 0
+    for entry in entries:
+        header = _zip_central_header(entry, entry.name.encode('utf-8'))
+        central_size += len(header)
+        yield header
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(entries), len(entries), central_size, central_offset, 0)
+
+def iter_book_zip(entries, start, stop):
+    """
+    输出压缩包中[start, stop)范围内的字节，只读取范围内的文件
+    """
+    position = 0
+    for segment in _book_zip_segments(entries):
+        if position >= stop:
+            return
+        if isinstance(segment, bytes):
+            length = len(segment)
+            if position + length > start:
+                yield segment[max(start - position, 0):stop - position]
+        else:
+            path, length = segment
+            if position + length > start:
+                begin = max(start - position, 0)
+                remaining = min(length, stop - position) - begin
+                with open(path, 'rb') as f:
+                    f.seek(begin)
+                    while remaining > 0:
+                        chunk = f.read(min(BOOK_ZIP_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise IOError(f'文件在下载过程中被修改: {path}')
+                        remaining -= len(chunk)
+                        yield chunk
+        position += length
+
+# 下载发布结果API，支持Range断点续传
+@app.route('/api/download-book', methods=['GET'])
+def download_book():
+    session_id = request.args.get('sessionId')
+
+    if not session_id:
         return jsonify({'error': '会话ID不能为空'}), 400
 
     try:
-        # 从数据库中获取文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
-
+        result = get_db().execute("SELECT folder_name FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
         if not result:
-            logger.error(f"导出电子书失败: 会话不存在 - {session_id}")
             return jsonify({'error': '会话不存在'}), 404
 
-        folder_path = result[0]
-
-        # 检查文件夹是否存在
-        if not os.path.exists(folder_path):
-            logger.error(f"导出电子书失败: 文件夹不存在 - {folder_path}")
-            return jsonify({'error': '文件夹不存在'}), 404
-
-        logger.info(f"开始执行 gitbook build: {folder_path}")
-        returncode, stdout, stderr = run_gitbook_command(f'build {folder_path}')
-        
-        if returncode != 0:
-            logger.error(f"gitbook build 失败: {stderr}")
-            return jsonify({
-                'success': False,
-                'error': f'gitbook build失败: {stderr}'
-
-            }), 500
-
-        # 移动 _book 文件夹
-        source_book_folder = os.path.join(folder_path, '_book')
-        if not os.path.exists(source_book_folder):
-            logger.error(f"_book文件夹不存在: {source_book_folder}")
-            return jsonify({
-                'success': False,
-                'error': '_book文件夹不存在，请检查gitbook build是否成功'
-            }), 500
-
-        target_session_folder = os.path.join(USER_FOLDER, session_id)
-        os.makedirs(target_session_folder, exist_ok=True)
-        target_book_folder = os.path.join(target_session_folder, '_book')
-
-        if os.path.exists(target_book_folder):
-            shutil.rmtree(target_book_folder)
-
-        shutil.move(source_book_folder, target_session_folder)
-        logger.info(f"电子书导出成功: {target_book_folder}")
-
-        return jsonify({
-            'success': True,
-            'message': '导出成功',
-            'output': stdout,
-            'book_path': target_book_folder
-        })
+        book_folder = os.path.join(USER_FOLDER, session_id, '_book')
+        if not os.path.isdir(book_folder):
+            return jsonify({'error': '电子书尚未发布'}), 404
+
+        fingerprint, entries, total = load_book_zip_index(session_id, book_folder)
+        if request.if_none_match.contains(fingerprint):
+            response = app.response_class(status=304)
+            response.set_etag(fingerprint)
+            return response
+
+        # If-Range与当前版本不一致时返回完整内容
+        byte_range = request.range
+        if_range = request.if_range
+        if byte_range and (if_range.etag or if_range.date) and if_range.etag != fingerprint:
+            byte_range = None
+        content_range = byte_range.range_for_length(total) if byte_range else None
+        if byte_range and content_range is None and len(byte_range.ranges) == 1:
+            response = app.response_class(status=416)
+            response.headers['Content-Range'] = f'bytes */{total}'
+            return response
+
+        start, stop = content_range or (0, total)
+        response = app.response_class(iter_book_zip(entries, start, stop), mimetype='application/zip')
+        if content_range:
+            response.status_code = 206
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total}'
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(result[0])}.zip"
+        response.set_etag(fingerprint)
+        return response
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
     except Exception as e:
-        logger.exception(f"导出电子书时发生异常: {str(e)}")
+        logger.exception(f"下载电子书失败: {e}")
         return jsonify({'error': str(e)}), 500
 
 # 导出PDF API
@@ -767,8 +4718,7 @@ def export_pdf():
 
     try:
         # 从数据库中获取文件夹路径和名称
-        cursor.execute("SELECT folder_path, folder_name FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        result = get_db().execute("SELECT folder_path, folder_name FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
 
         if not result:
             logger.error(f"导出PDF失败: 会话不存在 - {session_id}")
@@ -782,44 +4732,114 @@ def export_pdf():
             logger.error(f"导出PDF失败: 文件夹不存在 - {folder_path}")
             return jsonify({'error': '文件夹不存在'}), 404
 
-        # 执行 gitbook pdf 命令生成PDF
-        pdf_output_path = os.path.join(folder_path, f'{folder_name}.pdf')
-        logger.info(f"开始执行 gitbook pdf: {folder_path} -> {pdf_output_path}")
-        
-        # 使用绝对路径指定输出文件
-        returncode, stdout, stderr = run_gitbook_command(f'pdf . {pdf_output_path}', cwd=folder_path)
-        
-        if returncode != 0:
-            logger.error(f"gitbook pdf 失败: {stderr}")
-            return jsonify({
-                'success': False,
-                'error': f'生成PDF失败: {stderr}'
-            }), 500
-
-        # 检查PDF文件是否生成成功
-        if not os.path.exists(pdf_output_path):
-            logger.error(f"PDF文件不存在: {pdf_output_path}")
-            return jsonify({
-                'success': False,
-                'error': 'PDF文件生成失败，请检查日志'
-            }), 500
-
-        logger.info(f"PDF导出成功: {pdf_output_path}")
-        
-        # 返回PDF文件供下载
-        return send_file(
-            pdf_output_path,
-            as_attachment=True,
-            download_name=f'{folder_name}.pdf',
-            mimetype='application/pdf'
-        )
-        
+        # 放入后台任务执行，wait为真时保持原来的阻塞行为（直接返回PDF文件）
+        job_id = job_manager.submit('export-pdf', session_id, {'folder_path': folder_path, 'folder_name': folder_name})
+        if data.get('wait'):
+            return wait_for_job_response(job_id)
+        return jsonify({'success': True, 'jobId': job_id, 'status': 'queued'}), 202
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         logger.exception(f"导出PDF时发生异常: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@job_manager.register('export-pdf')
+def export_pdf_job(params, cancel_event):
+    """
+    后台任务：执行gitbook pdf生成PDF，结果通过 /api/jobs/<job_id>/result 下载
+    """
+    folder_path = params['folder_path']
+    folder_name = params['folder_name']
+
+    # 导出前先把缓冲中的保存写入磁盘
+    write_behind.flush(folder_path)
+
+    # 执行 gitbook pdf 命令生成PDF
+    pdf_output_path = os.path.join(folder_path, f'{folder_name}.pdf')
+    logger.info(f"开始执行 gitbook pdf: {folder_path} -> {pdf_output_path}")
+    
+    # 使用绝对路径指定输出文件
+    returncode, stdout, stderr = run_gitbook_command(f'pdf . {pdf_output_path}', cwd=folder_path, cancel_event=cancel_event)
+    
+    if returncode != 0:
+        logger.error(f"gitbook pdf 失败: {stderr}")
+        raise RuntimeError(f'生成PDF失败: {stderr}')
+
+    # 检查PDF文件是否生成成功
+    if not os.path.exists(pdf_output_path):
+        logger.error(f"PDF文件不存在: {pdf_output_path}")
+        raise RuntimeError('PDF文件生成失败，请检查日志')
+
+    logger.info(f"PDF导出成功: {pdf_output_path}")
+    
+    return {
+        'file_path': pdf_output_path,
+        'download_name': f'{folder_name}.pdf',
+        'mimetype': 'application/pdf'
+    }
+
 
 # 修改create_file函数，使用更简短的真实文件名
+def create_file_op(db, plan, params):
+    """
+    在文件夹中新建空白文件
+    :param params: folderPath, fileName（显示名称）
+    :return: 新文件的树节点
+    """
+    folder_path = params.get('folderPath')
+    display_name = params.get('fileName')
+
+    if not folder_path or not display_name:
+        raise ApiError('文件夹路径和文件名不能为空')
+
+    # 标准化路径
+    normalized_folder_path = os.path.abspath(folder_path)
+
+    # 解析文件夹所在的会话和节点
+    folder = resolve_item_path(db, normalized_folder_path)
+    if not folder or folder.item_type != 'folder':
+        raise ApiError('文件夹不存在于数据库中', 404)
+
+    # 检查显示文件名是否已存在
+    if check_display_name_duplicate(folder.session_id, folder.item_id, display_name):
+        raise ApiError('该名称的文件已存在')
+
+    # 生成更简短的真实文件名
+    short_uuid = str(uuid.uuid4()).split('-')[0]
+    timestamp_suffix = str(int(time.time()))[-4:]
+    real_name = f"{short_uuid}_{timestamp_suffix}.md"
+    file_path = os.path.join(normalized_folder_path, real_name)
+
+    # 检查生成的简短文件名是否真的不存在
+    while plan.exists(file_path):
+        short_uuid = str(uuid.uuid4()).split('-')[0]
+        timestamp_suffix = str(int(time.time()))[-4:]
+        real_name = f"{short_uuid}_{timestamp_suffix}.md"
+        file_path = os.path.join(normalized_folder_path, real_name)
+
+    # 创建新文件
+    plan.create_file(file_path)
+
+    # 获取当前位置（在父文件夹中排最后）
+    position = next_child_position(db, folder.session_id, folder.item_id)
+
+    # 生成随机ID
+    item_id = str(uuid.uuid4())
+
+    # 存储映射关系到数据库
+    insert_item(db, folder.session_id, folder.item_id, item_id, real_name, display_name, position, 'file')
+    index_search_document(db, item_id, folder.session_id, display_name, '', file_validators.compute(b''))
+
+    # 更新父文件夹的子节点数量
+    adjust_child_count(db, folder.item_id, 1)
+
+    # 提交后把新文件加入缓存的文件树
+    new_file = make_tree_node(item_id, display_name, 'file', file_path)
+    after_commit(lambda: tree_cache.update(
+        folder.session_id, lambda tree: tree.add(folder.item_id, dict(new_file))
+    ))
+    return new_file
+
 @app.route('/api/create-file', methods=['POST'])
 def create_file():
     data = request.json
@@ -841,60 +4861,96 @@ def create_file():
         if not os.path.isdir(normalized_folder_path):
             return jsonify({'error': '提供的路径不是文件夹'}), 400
 
-        # 检查显示文件名是否已存在
-        if check_display_name_duplicate(normalized_folder_path, display_name):
-            return jsonify({'error': '该名称的文件已存在'}), 400
-
-        # 生成更简短的真实文件名
-        short_uuid = str(uuid.uuid4()).split('-')[0]
-        timestamp_suffix = str(int(time.time()))[-4:]
-        real_name = f"{short_uuid}_{timestamp_suffix}.md"
-        file_path = os.path.join(normalized_folder_path, real_name)
-
-        # 检查生成的简短文件名是否真的不存在
-        while os.path.exists(file_path):
-            short_uuid = str(uuid.uuid4()).split('-')[0]
-            timestamp_suffix = str(int(time.time()))[-4:]
-            real_name = f"{short_uuid}_{timestamp_suffix}.md"
-            file_path = os.path.join(normalized_folder_path, real_name)
-
-        # 创建新文件
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write('')
-
-        # 获取当前位置（在父文件夹中排最后）
-        cursor.execute("SELECT COUNT(*) FROM file_mapping WHERE parent_path = ?", (normalized_folder_path,))
-        position = cursor.fetchone()[0]
-        
-        # 生成随机ID
-        item_id = str(uuid.uuid4())
-
-        # 存储映射关系到数据库
-        cursor.execute(
-            "INSERT INTO file_mapping (id, real_name, display_name, file_path, parent_path, position, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (item_id, real_name, display_name, file_path, normalized_folder_path, position, 'file')
-        )
-        
-        # 更新父文件夹的子节点数量
-        cursor.execute(
-            "UPDATE file_mapping SET child_count = child_count + 1 WHERE file_path = ?",
-            (normalized_folder_path,)
-        )
-        conn.commit()
+        with planned_transaction() as (db, plan):
+            new_file = create_file_op(db, plan, data)
 
         # 返回新创建的文件信息
-        new_file = {
-            'id': item_id,
-            'name': display_name,
-            'type': 'file',
-            'filePath': file_path
-        }
-
         return jsonify(new_file)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # 创建新文件夹API
+def create_folder_op(db, plan, params):
+    """
+    新建文件夹，并在其中自动创建README.md
+    :param params: parentPath, folderName, targetType（parentPath是文件时传'file'，在其所在文件夹中创建）
+    :return: 新文件夹的树节点
+    """
+    target_path = params.get('parentPath')
+    folder_name = params.get('folderName')
+    target_type = params.get('targetType', 'folder')
+
+    if not target_path or not folder_name:
+        raise ApiError('目标路径和文件夹名不能为空')
+
+    # 标准化路径
+    normalized_path = os.path.abspath(target_path)
+
+    # 获取父目录
+    if target_type == 'file' and plan.isfile(normalized_path):
+        normalized_parent_path = os.path.dirname(normalized_path)
+    else:
+        normalized_parent_path = normalized_path
+
+    # 构建新文件夹路径
+    new_folder_path = os.path.join(normalized_parent_path, folder_name)
+
+    # 检查文件夹是否已存在
+    if plan.exists(new_folder_path):
+        raise ApiError('文件夹已存在')
+
+    # 解析父文件夹所在的会话和节点
+    parent = resolve_item_path(db, normalized_parent_path)
+    if not parent or parent.item_type != 'folder':
+        raise ApiError('父文件夹不存在于数据库中', 404)
+
+    # 同一文件夹下的显示名称必须唯一
+    if check_display_name_duplicate(parent.session_id, parent.item_id, folder_name):
+        raise ApiError('该名称的文件或文件夹已存在')
+
+    # 创建新文件夹和README.md文件
+    readme_path = os.path.join(new_folder_path, "README.md")
+    plan.create_folder(new_folder_path, readme_path)
+
+    # 获取当前位置（在父文件夹中排最后）
+    position = next_child_position(db, parent.session_id, parent.item_id)
+
+    # 生成随机ID
+    folder_id = str(uuid.uuid4())
+    readme_id = str(uuid.uuid4())
+
+    # 存储文件夹映射关系到数据库（新文件夹的子节点只有README.md）
+    insert_item(db, parent.session_id, parent.item_id, folder_id, folder_name, folder_name, position, 'folder', child_count=1)
+
+    # 存储README.md映射关系到数据库
+    insert_item(db, parent.session_id, folder_id, readme_id, "README.md", "README.md", POSITION_GAP, 'file')
+    index_search_document(db, readme_id, parent.session_id, "README.md", '', file_validators.compute(b''))
+
+    # 更新父文件夹的子节点数量
+    adjust_child_count(db, parent.item_id, 1)
+
+    # 提交后把新文件夹（含README.md）加入缓存的文件树
+    def add_new_folder(tree):
+        node = make_tree_node(folder_id, folder_name, 'folder', new_folder_path)
+        node['children'].append(make_tree_node(readme_id, 'README.md', 'file', readme_path))
+        tree.add(parent.item_id, node)
+    after_commit(lambda: tree_cache.update(parent.session_id, add_new_folder))
+
+    # 返回新创建的文件夹信息
+    return {
+        'id': folder_id,
+        'name': folder_name,
+        'type': 'folder',
+        'children': [{
+            'id': readme_id,
+            'name': 'README.md',
+            'type': 'file',
+            'filePath': readme_path
+        }]
+    }
+
 @app.route('/api/create-folder', methods=['POST'])
 def create_new_folder():
     data = request.json
@@ -923,93 +4979,253 @@ def create_new_folder():
         if not os.path.isdir(normalized_parent_path):
             return jsonify({'error': '提供的父路径不是文件夹'}), 400
 
-        # 构建新文件夹路径
-        new_folder_path = os.path.join(normalized_parent_path, folder_name)
+        with planned_transaction() as (db, plan):
+            new_folder = create_folder_op(db, plan, data)
 
-        # 检查文件夹是否已存在
-        if os.path.exists(new_folder_path):
-            return jsonify({'error': '文件夹已存在'}), 400
-
-        # 创建新文件夹
-        os.makedirs(new_folder_path, exist_ok=True, mode=0o777)
-        os.chmod(new_folder_path, 0o777)
-
-        # 自动创建README.md文件
-        readme_path = os.path.join(new_folder_path, "README.md")
-        with open(readme_path, 'w', encoding='utf-8') as f:
-            f.write('')
+        return jsonify(new_folder)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        # 获取当前位置（在父文件夹中排最后）
-        cursor.execute("SELECT COUNT(*) FROM file_mapping WHERE parent_path = ?", (normalized_parent_path,))
-        position = cursor.fetchone()[0]
-        
-        # 生成随机ID
+class UploadStager:
+    """
+    把上传的md文件、图片和压缩包解压到临时目录，记录每个条目的相对路径和结果
+    压缩包逐个条目流式复制到磁盘（zip按中央目录逐个打开，tar.gz按顺序读取），不在内存中缓存整个压缩包
+    """
+    def __init__(self, staging_dir):
+        self.staging_dir = staging_dir
+        self.files = OrderedDict()
+        self.folders = OrderedDict()
+        self.report = []
+        self.remaining = UPLOAD_MAX_BYTES
+
+    def stage(self, file):
+        """
+        暂存一个上传的文件，压缩包会被展开
+        """
+        lower_name = file.filename.lower()
+        try:
+            if lower_name.endswith('.zip'):
+                with zipfile.ZipFile(file.stream) as archive:
+                    for info in archive.infolist():
+                        if info.is_dir():
+                            self.add_folder(info.filename, file.filename)
+                        else:
+                            with archive.open(info) as src:
+                                self.add_stream(info.filename, src, file.filename)
+            elif lower_name.endswith(('.tar.gz', '.tgz')):
+                with tarfile.open(fileobj=file.stream, mode='r|gz') as archive:
+                    for member in archive:
+                        if member.isdir():
+                            self.add_folder(member.name, file.filename)
+                        elif member.isfile():
+                            self.add_stream(member.name, archive.extractfile(member), file.filename)
+                        else:
+                            self.skip(member.name, '不支持链接等特殊文件', file.filename)
+            else:
+                self.add_stream(os.path.basename(file.filename.replace('\\', '/')), file.stream)
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error) as e:
+            self.report.append({'name': file.filename, 'status': 'error', 'error': f'压缩包无法读取: {e}'})
+
+    def skip(self, name, reason, archive=None):
+        entry = {'name': name, 'status': 'skipped', 'error': reason}
+        if archive:
+            entry['archive'] = archive
+        self.report.append(entry)
+
+    def add_folder(self, name, archive=None):
+        rel_path = self._safe_rel_path(name)
+        if rel_path:
+            self.folders.setdefault(rel_path, archive)
+
+    def add_stream(self, name, src, archive=None):
+        rel_path = self._safe_rel_path(name)
+        if rel_path is None:
+            # 隐藏文件、__MACOSX等元数据不需要报告
+            return
+        lower_name = rel_path.lower()
+        if not lower_name.endswith('.md') and not lower_name.endswith(UPLOAD_IMAGE_EXTENSIONS):
+            return self.skip(rel_path, '只能上传.md和图片文件', archive)
+        if rel_path in self.files:
+            return self.skip(rel_path, '上传内容中有重复的文件', archive)
+        if len(self.files) >= UPLOAD_MAX_ENTRIES:
+            raise ApiError(f'一次最多上传 {UPLOAD_MAX_ENTRIES} 个文件', 413)
+
+        staged_path = os.path.join(self.staging_dir, str(len(self.files)))
+        with open(staged_path, 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                self.remaining -= len(chunk)
+                if self.remaining < 0:
+                    raise ApiError('上传内容超过大小限制', 413)
+                dst.write(chunk)
+        os.chmod(staged_path, 0o644)
+        self.files[rel_path] = (staged_path, archive)
+        parent_rel_dir = rel_path.rpartition('/')[0]
+        if parent_rel_dir:
+            self.add_folder(parent_rel_dir, archive)
+
+    @staticmethod
+    def _safe_rel_path(name):
+        """
+        把条目名称规范化为以/分隔的相对路径，..、隐藏文件和IMPORT_SKIP_DIRS中的目录返回None
+        """
+        parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+        if not parts or any(part == '..' or part.startswith('.') or part in IMPORT_SKIP_DIRS or part == '__MACOSX' for part in parts):
+            return None
+        return '/'.join(parts)
+
+def make_upload_staging_dir(folder_path):
+    """
+    为一次上传创建暂存目录：不放在书籍文件夹中（避免出现在文件树、导入和搜索中），
+    但必须与目标文件夹在同一文件系统上，提交时只需改名
+    优先使用UPLOAD_STAGING_FOLDER；数据目录与目标不在同一文件系统时放在书籍文件夹的上级目录
+    :param folder_path: 上传的目标文件夹
+    """
+    staging_parent = UPLOAD_STAGING_FOLDER
+    if os.stat(staging_parent).st_dev != os.stat(folder_path).st_dev:
+        with transaction(immediate=False) as db:
+            session = find_session_by_path(db, folder_path)
+        if not session:
+            raise ApiError('文件夹不存在于数据库中', 404)
+        staging_parent = os.path.dirname(session[1])
+    return tempfile.mkdtemp(prefix='.upload-', dir=staging_parent)
+
+def cleanup_upload_staging(max_age=24 * 3600):
+    """
+    启动时清理上次进程异常退出时留下的暂存目录（只清理足够旧的，避免影响其他进程正在进行的上传）
+    """
+    now = time.time()
+    with os.scandir(UPLOAD_STAGING_FOLDER) as entries:
+        for entry in entries:
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime > max_age:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+def commit_staged_upload(db, plan, folder, folder_disk_path, stager):
+    """
+    把暂存的条目放入目标文件夹：按目录结构创建文件夹，md文件使用生成的真实名称，
+    图片保留原名（与导入文件夹时一样不写入数据库）；所有映射在同一个事务中写入
+    同名的已有文件夹会被合并，同名的已有文件报告为错误
+    :return: 每个条目的结果列表
+    """
+    results = []
+    folder_nodes = {'': (folder.item_id, folder_disk_path)}
+    next_positions = {}
+    child_deltas = {}
+    # 提交后按创建顺序（文件夹在其内容之前）加入缓存的文件树
+    added_nodes = []
+
+    def add_item(parent_id, item_id, real_name, display_name, item_type, disk_path):
+        if parent_id not in next_positions:
+            next_positions[parent_id] = next_child_position(db, folder.session_id, parent_id)
+        insert_item(db, folder.session_id, parent_id, item_id, real_name, display_name, next_positions[parent_id], item_type)
+        next_positions[parent_id] += POSITION_GAP
+        child_deltas[parent_id] = child_deltas.get(parent_id, 0) + 1
+        added_nodes.append((parent_id, item_id, display_name, item_type, disk_path))
+
+    def find_child(parent_id, display_name):
+        return db.execute(
+            "SELECT id, real_name, item_type FROM file_mapping WHERE session_id = ? AND parent_id = ? AND display_name = ?",
+            (folder.session_id, parent_id, display_name)
+        ).fetchone()
+
+    # 父文件夹排在子文件夹之前
+    for rel_dir, archive in sorted(stager.folders.items(), key=lambda item: item[0].count('/')):
+        parent_rel_dir, _, name = rel_dir.rpartition('/')
+        parent = folder_nodes.get(parent_rel_dir)
+        if parent is None:
+            continue
+        parent_id, parent_disk_path = parent
+        disk_path = os.path.join(parent_disk_path, name)
+        existing = find_child(parent_id, name)
+        if existing and existing[2] == 'folder':
+            folder_nodes[rel_dir] = (existing[0], os.path.join(parent_disk_path, existing[1]))
+            continue
+        if existing or os.path.isfile(disk_path):
+            results.append({'name': rel_dir, 'status': 'error', 'error': '已存在同名文件，文件夹中的内容未上传'})
+            continue
         folder_id = str(uuid.uuid4())
-        readme_id = str(uuid.uuid4())
+        add_item(parent_id, folder_id, name, name, 'folder', disk_path)
+        if not os.path.isdir(disk_path):
+            plan.add(lambda path=disk_path: os.mkdir(path, 0o777), lambda path=disk_path: os.rmdir(path))
+        folder_nodes[rel_dir] = (folder_id, disk_path)
+        results.append({'name': rel_dir, 'status': 'created', 'type': 'folder', 'id': folder_id, 'filePath': disk_path})
+
+    for rel_path, (staged_path, archive) in stager.files.items():
+        parent_rel_dir, _, name = rel_path.rpartition('/')
+        parent = folder_nodes.get(parent_rel_dir)
+        if parent is None:
+            continue
+        parent_id, parent_disk_path = parent
+        result = {'name': rel_path}
+        if archive:
+            result['archive'] = archive
+        if name.lower().endswith('.md'):
+            real_name = _generate_real_name(name)
+            disk_path = os.path.join(parent_disk_path, real_name)
+            if find_child(parent_id, name) or os.path.exists(disk_path):
+                result.update(status='error', error='该名称的文件已存在')
+            else:
+                item_id = str(uuid.uuid4())
+                add_item(parent_id, item_id, real_name, name, 'file', disk_path)
+                with open(staged_path, 'rb') as f:
+                    content_bytes = f.read()
+                index_search_document(
+                    db, item_id, folder.session_id, name,
+                    content_bytes.decode('utf-8', 'replace'), file_validators.compute(content_bytes)
+                )
+                plan.rename(staged_path, disk_path)
+                result.update(status='created', type='file', id=item_id, filePath=disk_path)
+        else:
+            disk_path = os.path.join(parent_disk_path, name)
+            if os.path.exists(disk_path):
+                result.update(status='error', error='该名称的图片已存在')
+            else:
+                plan.rename(staged_path, disk_path)
+                result.update(status='created', type='image', filePath=disk_path)
+        results.append(result)
 
-        # 存储文件夹映射关系到数据库
-        cursor.execute(
-            "INSERT INTO file_mapping (id, real_name, display_name, file_path, parent_path, position, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (folder_id, folder_name, folder_name, new_folder_path, normalized_parent_path, position, 'folder')
-        )
-        
-        # 存储README.md映射关系到数据库
-        cursor.execute(
-            "INSERT INTO file_mapping (id, real_name, display_name, file_path, parent_path, position, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (readme_id, "README.md", "README.md", readme_path, new_folder_path, 0, 'file')
-        )
-        
-        # 更新父文件夹的子节点数量
-        cursor.execute(
-            "UPDATE file_mapping SET child_count = child_count + 1 WHERE file_path = ?",
-            (normalized_parent_path,)
-        )
-        
-        # 更新新文件夹的子节点数量
-        cursor.execute(
-            "UPDATE file_mapping SET child_count = 1 WHERE id = ?",
-            (folder_id,)
-        )
-        conn.commit()
-
-        # 返回新创建的文件夹信息
-        new_folder = {
-            'id': folder_id,
-            'name': folder_name,
-            'type': 'folder',
-            'children': [{
-                'id': readme_id,
-                'name': 'README.md',
-                'type': 'file',
-                'filePath': readme_path
-            }]
-        }
+    for parent_id, delta in child_deltas.items():
+        adjust_child_count(db, parent_id, delta)
 
-        return jsonify(new_folder)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    def add_uploaded(tree):
+        for parent_id, item_id, display_name, item_type, disk_path in added_nodes:
+            tree.add(parent_id, make_tree_node(item_id, display_name, item_type, disk_path))
+    if added_nodes:
+        after_commit(lambda: tree_cache.update(folder.session_id, add_uploaded))
+    return results
 
 # 上传文件API
+# 支持一次上传多个md文件、图片以及.zip/.tar.gz压缩包（保持压缩包中的目录结构），返回每个条目的结果；
+# 只上传一个md文件时返回该文件的节点，与旧版本兼容
 @app.route('/api/upload-file', methods=['POST'])
 def upload_file():
     # 检查是否有文件上传
+    files = [file for file in request.files.getlist('file') if file.filename]
+    folder_path = request.form.get('folderPath')
+
     if 'file' not in request.files:
         return jsonify({'error': '没有文件上传'}), 400
 
-    file = request.files['file']
-    folder_path = request.form.get('folderPath')
-
     if not folder_path:
         return jsonify({'error': '文件夹路径不能为空'}), 400
 
     # 如果用户没有选择文件，浏览器会提交一个空文件
-    if file.filename == '':
+    if not files:
         return jsonify({'error': '没有选择文件'}), 400
 
-    # 确保文件以.md结尾
-    if not file.filename.endswith('.md'):
-        return jsonify({'error': '只能上传.md文件'}), 400
+    # 只上传一个文件时保持原来的检查和返回格式
+    single_md = len(files) == 1 and files[0].filename.endswith('.md')
+    if len(files) == 1 and not single_md and not files[0].filename.lower().endswith(UPLOAD_ARCHIVE_EXTENSIONS + UPLOAD_IMAGE_EXTENSIONS):
+        return jsonify({'error': '只能上传.md文件、图片或压缩包'}), 400
 
+    staging_dir = None
     try:
         # 标准化路径
         normalized_folder_path = os.path.abspath(folder_path)
@@ -1022,139 +5238,106 @@ def upload_file():
         if not os.path.isdir(normalized_folder_path):
             return jsonify({'error': '提供的路径不是文件夹'}), 400
 
-        # 显示名称就是原始文件名
-        display_name = file.filename
-        
-        # 检查显示文件名是否已存在
-        if check_display_name_duplicate(normalized_folder_path, display_name):
-            return jsonify({'error': '该名称的文件已存在'}), 400
+        # 先在书籍文件夹之外暂存（同一文件系统，之后只需改名）
+        staging_dir = make_upload_staging_dir(normalized_folder_path)
+        stager = UploadStager(staging_dir)
+        for file in files:
+            stager.stage(file)
+
+        with planned_transaction() as (db, plan):
+            # 解析文件夹所在的会话和节点
+            folder = resolve_item_path(db, normalized_folder_path)
+            if not folder or folder.item_type != 'folder':
+                return jsonify({'error': '文件夹不存在于数据库中'}), 404
+
+            results = stager.report + commit_staged_upload(db, plan, folder, normalized_folder_path, stager)
+
+        if single_md:
+            if not results or results[0]['status'] != 'created':
+                return jsonify({'error': results[0]['error'] if results else '文件名无效'}), 400
+            result = results[0]
+            # 返回上传的文件信息
+            return jsonify(make_tree_node(result['id'], files[0].filename, 'file', result['filePath']))
+
+        created = sum(1 for result in results if result['status'] == 'created')
+        return jsonify({'success': True, 'created': created, 'results': results})
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if staging_dir:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
-        # 生成更简短的真实文件名
-        short_uuid = str(uuid.uuid4()).split('-')[0]
-        timestamp_suffix = str(int(time.time()))[-4:]
-        real_name = f"{short_uuid}_{timestamp_suffix}.md"
-        file_path = os.path.join(normalized_folder_path, real_name)
+#  添加删除文件/文件夹的API
+def delete_item_op(db, plan, params):
+    """
+    删除文件或文件夹（含所有子项）
+    :param params: filePath, isFolder
+    """
+    file_path = params.get('filePath')
+    is_folder = params.get('isFolder', False)
 
-        # 检查生成的简短文件名是否真的不存在
-        while os.path.exists(file_path):
-            short_uuid = str(uuid.uuid4()).split('-')[0]
-            timestamp_suffix = str(int(time.time()))[-4:]
-            real_name = f"{short_uuid}_{timestamp_suffix}.md"
-            file_path = os.path.join(normalized_folder_path, real_name)
+    if not file_path:
+        raise ApiError('文件路径不能为空')
 
-        # 保存文件
-        file.save(file_path)
+    # 标准化路径
+    normalized_path = os.path.abspath(file_path)
 
-        # 获取当前位置（在父文件夹中排最后）
-        cursor.execute("SELECT COUNT(*) FROM file_mapping WHERE parent_path = ?", (normalized_folder_path,))
-        position = cursor.fetchone()[0]
-        
-        # 生成随机ID
-        item_id = str(uuid.uuid4())
+    # 获取节点在数据库中的记录
+    item = resolve_item_path(db, normalized_path)
+    row = None
+    if item and item.item_id != ROOT_PARENT_ID:
+        row = db.execute(
+            "SELECT parent_id, display_name FROM file_mapping WHERE id = ?",
+            (item.item_id,)
+        ).fetchone()
+
+    if row:
+        parent_id, display_name = row
+
+        # 通过闭包表删除该节点及其所有子项的映射
+        delete_subtree(db, item.item_id)
 
-        # 存储映射关系到数据库
-        cursor.execute(
-            "INSERT INTO file_mapping (id, real_name, display_name, file_path, parent_path, position, item_type) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (item_id, real_name, display_name, file_path, normalized_folder_path, position, 'file')
-        )
-        
         # 更新父文件夹的子节点数量
-        cursor.execute(
-            "UPDATE file_mapping SET child_count = child_count + 1 WHERE file_path = ?",
-            (normalized_folder_path,)
-        )
-        conn.commit()
+        adjust_child_count(db, parent_id, -1)
+        # 位置之间允许有空隙，不需要移动同级项目
 
-        # 返回上传的文件信息
-        uploaded_file = {
-            'id': item_id,
-            'name': display_name,
-            'type': 'file',
-            'filePath': file_path
-        }
+        after_commit(lambda: tree_cache.update(item.session_id, lambda tree: tree.remove(item.item_id)))
+    elif not is_folder:
+        raise ApiError('文件不存在于数据库中', 404)
+    elif not plan.exists(normalized_path):
+        raise ApiError('文件或文件夹不存在', 404)
 
-        return jsonify(uploaded_file)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    # 提交后丢弃该路径下缓冲的保存，回滚时保留
+    after_commit(lambda: write_behind.discard(normalized_path))
+
+    # 删除文件或文件夹及其内容（失败时事务回滚，数据库映射保持不变）
+    plan.remove(normalized_path)
+
+    if is_folder:
+        return {'success': True, 'message': f'文件夹 {os.path.basename(normalized_path)} 已成功删除'}
+    return {'success': True, 'message': f'文件 {display_name} 已成功删除'}
 
-#  添加删除文件/文件夹的API
 @app.route('/api/delete-item', methods=['POST'])
 def delete_item():
     data = request.json
     file_path = data.get('filePath')
-    is_folder = data.get('isFolder', False)
 
     if not file_path:
         return jsonify({'error': '文件路径不能为空'}), 400
 
     try:
-        # 标准化路径
-        normalized_path = os.path.abspath(file_path)
-        
-        # 获取父文件夹路径
-        parent_path = os.path.dirname(normalized_path)
-
         # 检查路径是否存在
-        if not os.path.exists(normalized_path):
+        if not os.path.exists(os.path.abspath(file_path)):
             return jsonify({'error': '文件或文件夹不存在'}), 404
 
-        if is_folder:
-            # 先获取该文件夹的所有子项ID
-            cursor.execute("SELECT id FROM file_mapping WHERE file_path LIKE ?", (normalized_path + '%',))
-            item_ids = [row[0] for row in cursor.fetchall()]
-            
-            # 删除文件夹及其内容
-            shutil.rmtree(normalized_path)
-            
-            # 删除数据库中的映射
-            cursor.execute("DELETE FROM file_mapping WHERE file_path LIKE ?", (normalized_path + '%',))
-            
-            # 更新父文件夹的子节点数量
-            cursor.execute(
-                "UPDATE file_mapping SET child_count = child_count - 1 WHERE file_path = ?",
-                (parent_path,)
-            )
-            
-            # 更新所有受影响的文件的位置
-            cursor.execute(
-                "UPDATE file_mapping SET position = position - 1 WHERE parent_path = ? AND position > (SELECT position FROM file_mapping WHERE file_path = ?)",
-                (parent_path, normalized_path)
-            )
-            
-            conn.commit()
-            
-            return jsonify({'success': True, 'message': f'文件夹 {os.path.basename(normalized_path)} 已成功删除'})
-        else:
-            # 获取文件在数据库中的记录
-            cursor.execute("SELECT id, display_name, position FROM file_mapping WHERE file_path = ?", (normalized_path,))
-            result = cursor.fetchone()
-            
-            if not result:
-                return jsonify({'error': '文件不存在于数据库中'}), 404
-                
-            item_id, display_name, position = result
+        with planned_transaction() as (db, plan):
+            result = delete_item_op(db, plan, data)
 
-            # 删除文件
-            os.remove(normalized_path)
-            
-            # 删除数据库中的映射
-            cursor.execute("DELETE FROM file_mapping WHERE id = ?", (item_id,))
-            
-            # 更新父文件夹的子节点数量
-            cursor.execute(
-                "UPDATE file_mapping SET child_count = child_count - 1 WHERE file_path = ?",
-                (parent_path,)
-            )
-            
-            # 更新同级文件的位置
-            cursor.execute(
-                "UPDATE file_mapping SET position = position - 1 WHERE parent_path = ? AND position > ?",
-                (parent_path, position)
-            )
-            
-            conn.commit()
-            
-            return jsonify({'success': True, 'message': f'文件 {display_name} 已成功删除'})
+        return jsonify(result)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
     except PermissionError:
         return jsonify({'error': '权限不足，无法删除文件或文件夹'}), 403
     except Exception as e:
@@ -1171,46 +5354,38 @@ def edit_session():
         return jsonify({'error': '会话ID和新名称不能为空'}), 400
 
     try:
-         # 从数据库中获取原文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        with transaction() as db:
+            # 从数据库中获取原文件夹路径
+            result = db.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
 
-        if not result:
-            return jsonify({'error': '会话不存在'}), 404
+            if not result:
+                return jsonify({'error': '会话不存在'}), 404
 
-        old_folder_path = result[0]
-        parent_path = os.path.dirname(old_folder_path)
+            old_folder_path = result[0]
+            parent_path = os.path.dirname(old_folder_path)
 
-        # 构建新的文件夹路径
-        new_folder_path = os.path.join(parent_path, new_name)
+            # 构建新的文件夹路径
+            new_folder_path = os.path.join(parent_path, new_name)
 
-        # 检查新名称的文件夹是否已存在
-        if os.path.exists(new_folder_path):
-            return jsonify({'error': '该名称的文件夹已存在'}), 400
+            # 检查新名称的文件夹是否已存在
+            if os.path.exists(new_folder_path):
+                return jsonify({'error': '该名称的文件夹已存在'}), 400
 
-        # 重命名文件夹
-        os.rename(old_folder_path, new_folder_path)
+            # 缓冲中的保存在提交后改到新路径
+            write_behind.relocate(old_folder_path, new_folder_path)
 
-       # 更新数据库中的文件夹路径和名称
-        cursor.execute(
-            "UPDATE sessions SET folder_name = ?, folder_path = ? WHERE session_id = ?",
-            (new_name, new_folder_path, session_id)
-        )
-        
-        # 更新file_mapping表中所有包含原文件夹路径的记录
-        # 1. 更新file_path包含原文件夹路径的记录
-        cursor.execute(
-            "UPDATE file_mapping SET file_path = REPLACE(file_path, ?, ?) WHERE file_path LIKE ?",
-            (old_folder_path, new_folder_path, old_folder_path + '%')
-        )
-        
-        # 2. 更新parent_path包含原文件夹路径的记录
-        cursor.execute(
-            "UPDATE file_mapping SET parent_path = REPLACE(parent_path, ?, ?) WHERE parent_path LIKE ?",
-            (old_folder_path, new_folder_path, old_folder_path + '%')
-        )
-        
-        conn.commit()
+            # 更新数据库中的文件夹路径和名称
+            # file_mapping中只保存相对会话的结构，不需要改写任何文件记录
+            db.execute(
+                "UPDATE sessions SET folder_name = ?, folder_path = ? WHERE session_id = ?",
+                (new_name, new_folder_path, session_id)
+            )
+
+            # 重命名文件夹（失败时事务回滚）
+            os.rename(old_folder_path, new_folder_path)
+
+            # 所有节点的路径都变了，直接丢弃缓存
+            after_commit(lambda: tree_cache.invalidate(session_id))
 
         return jsonify({'success': True, 'message': '会话更新成功', 'newFolderPath': new_folder_path})
     except PermissionError:
@@ -1228,40 +5403,46 @@ def delete_session():
         return jsonify({'error': '会话ID不能为空'}), 400
 
     try:
-        # 先从数据库中获取会话的文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            website_folder = result[0]
-            
-            # 查询该文件夹下所有文件的映射关系
-            cursor.execute(
-                "SELECT file_path, display_name FROM file_mapping WHERE file_path LIKE ? AND item_type = 'file'",
-                (website_folder + '%',)
-            )
-            files_to_rename = cursor.fetchall()
+        with transaction() as db:
+            # 先从数据库中获取会话的文件夹路径
+            result = db.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
             
-            # 将所有md文件的文件名更改为display_name
-            for file_path, display_name in files_to_rename:
-                if display_name.endswith('.md'):
-                    # 获取文件所在目录
-                    dir_path = os.path.dirname(file_path)
-                    # 构建新的文件路径
-                    new_file_path = os.path.join(dir_path, display_name)
-                    # 如果新文件名与原文件名不同，则重命名
-                    if file_path != new_file_path and os.path.exists(file_path):
-                        try:
-                            os.rename(file_path, new_file_path)
-                        except Exception as e:
-                            print(f"重命名文件时出错 {file_path} -> {display_name}: {e}")
+            if result:
+                website_folder = result[0]
+                
+                # 查询该会话下所有文件的映射关系
+                files_to_rename = [
+                    (item_disk_path(website_folder, rel_path), display_name)
+                    for _, _, display_name, rel_path, item_type in fetch_subtree(db, session_id)
+                    if item_type == 'file'
+                ]
+                
+                # 将所有md文件的文件名更改为display_name
+                for file_path, display_name in files_to_rename:
+                    if display_name.endswith('.md'):
+                        # 获取文件所在目录
+                        dir_path = os.path.dirname(file_path)
+                        # 构建新的文件路径
+                        new_file_path = os.path.join(dir_path, display_name)
+                        # 如果新文件名与原文件名不同，则重命名
+                        if file_path != new_file_path and os.path.exists(file_path):
+                            write_behind.relocate(file_path, new_file_path)
+                            try:
+                                os.rename(file_path, new_file_path)
+                            except Exception as e:
+                                # 文件仍在原路径，缓冲中的内容也写回原路径
+                                write_behind.cancel_relocate(file_path)
+                                print(f"重命名文件时出错 {file_path} -> {display_name}: {e}")
+                
+                # 会话删除后不会再有保存，提交后把缓冲中的内容写入磁盘
+                after_commit(lambda: write_behind.flush(website_folder))
+
+            # 删除file_mapping表中该会话的所有有关内容
+            delete_session_items(db, session_id)
             
-            # 删除file_mapping表中该文件夹中的所有有关内容
-            cursor.execute("DELETE FROM file_mapping WHERE file_path LIKE ?", (website_folder + '%',))
-        
-        # 从数据库中删除会话记录
-        cursor.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-        conn.commit()
+            # 从数据库中删除会话记录
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            after_commit(lambda: tree_cache.invalidate(session_id))
 
         # 删除会话文件夹
         session_folder = os.path.join(USER_FOLDER, session_id)
@@ -1274,96 +5455,220 @@ def delete_session():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# 添加重命名文件/文件夹的API
-def rename_item(file_path, new_name, is_folder=False):
+# 修改文件重命名逻辑，使用显示文件名检查重复
+def rename_item_op(db, plan, params):
     """
     重命名文件或文件夹
-    :param file_path: 要重命名的文件或文件夹路径
-    :param new_name: 新名称
-    :param is_folder: 是否是文件夹
-    :return: (success, message)
+    文件只修改显示名称（必须以.md结尾），文件夹同时重命名磁盘上的文件夹
+    :param params: filePath, newName, isFolder
     """
-    try:
-        # 标准化路径
-        normalized_path = os.path.abspath(file_path)
+    file_path = params.get('filePath')
+    new_display_name = params.get('newName')
+    is_folder = params.get('isFolder', False)
 
-        # 检查路径是否存在
-        if not os.path.exists(normalized_path):
-            return False, '文件或文件夹不存在'
+    # 验证输入参数
+    if not file_path:
+        raise ApiError('文件路径不能为空')
+    if not new_display_name:
+        raise ApiError('新名称不能为空')
 
-        # 检查是否为正确的类型
-        if is_folder and not os.path.isdir(normalized_path):
-            return False, '提供的路径不是文件夹'
-        if not is_folder and not os.path.isfile(normalized_path):
-            return False, '提供的路径不是文件'
+    normalized_path = os.path.abspath(file_path)
 
-        # 获取父文件夹路径
-        parent_path = os.path.dirname(normalized_path)
+    # 文件的显示名称必须以.md结尾
+    if not is_folder and not new_display_name.endswith('.md'):
+        new_display_name += '.md'
 
-        # 构建新的路径
-        new_path = os.path.join(parent_path, new_name)
+    item = resolve_item_path(db, normalized_path)
+    if not item or item.item_id == ROOT_PARENT_ID:
+        raise ApiError('文件或文件夹不存在于数据库中', 404)
+    if is_folder != (item.item_type == 'folder'):
+        raise ApiError('提供的路径不是文件夹' if is_folder else '提供的路径不是文件')
 
-        # 检查新名称是否已存在
-        if os.path.exists(new_path):
-            return False, '该名称的文件或文件夹已存在'
+    parent_id = db.execute("SELECT parent_id FROM file_mapping WHERE id = ?", (item.item_id,)).fetchone()[0]
 
-        # 执行重命名操作
-        os.rename(normalized_path, new_path)
+    # 检查显示文件名是否已存在（这是新增的重要检查）
+    if check_display_name_duplicate(item.session_id, parent_id, new_display_name, exclude_id=item.item_id):
+        raise ApiError('该名称的文件已存在')
 
-        return True, f'{"文件夹" if is_folder else "文件"} "{os.path.basename(normalized_path)}" 已成功重命名为 "{new_name}"'  
-    except PermissionError:
-        return False, '权限不足，无法重命名'
-    except Exception as e:
-        return False, str(e)
+    if is_folder:
+        new_path = os.path.join(os.path.dirname(normalized_path), new_display_name)
+        if new_path != normalized_path and plan.exists(new_path):
+            raise ApiError('该名称的文件或文件夹已存在')
+
+        # 文件夹中缓冲的保存在提交后改到新路径
+        write_behind.relocate(normalized_path, new_path)
+
+        # 文件夹的真实名称就是磁盘上的名称，只需更新这一条记录，子项路径由父节点推导
+        db.execute(
+            "UPDATE file_mapping SET real_name = ?, display_name = ? WHERE id = ?",
+            (new_display_name, new_display_name, item.item_id)
+        )
+        # 重命名磁盘上的文件夹（失败时事务回滚）
+        if new_path != normalized_path:
+            plan.rename(normalized_path, new_path)
+
+        def rename_folder(tree):
+            tree.nodes[item.item_id]['name'] = new_display_name
+            tree.set_path(item.item_id, new_path)
+        after_commit(lambda: tree_cache.update(item.session_id, rename_folder))
+        return {'success': True, 'message': f'文件夹 "{os.path.basename(normalized_path)}" 已成功重命名为 "{new_display_name}"'}
+
+    # 文件只修改显示名称
+    db.execute(
+        "UPDATE file_mapping SET display_name = ? WHERE id = ?",
+        (new_display_name, item.item_id)
+    )
+    rename_search_document(db, item.item_id, new_display_name)
+
+    def rename_file(tree):
+        tree.nodes[item.item_id]['name'] = new_display_name
+    after_commit(lambda: tree_cache.update(item.session_id, rename_file))
+    return {'success': True, 'message': f'文件已成功重命名为 "{new_display_name}"'}
 
-# 修改文件重命名逻辑，使用显示文件名检查重复
 @app.route('/api/rename-item', methods=['POST'])
 def api_rename_item():
-    data = request.json
-    file_path = data.get('filePath')
-    new_display_name = data.get('newName')
-    is_folder = data.get('isFolder', False)
+    try:
+        with planned_transaction() as (db, plan):
+            result = rename_item_op(db, plan, request.json)
+        return jsonify(result)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
+    except PermissionError:
+        return jsonify({'error': '权限不足，无法重命名'}), 403
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-    # 验证输入参数
-    if not file_path:
-        return jsonify({'error': '文件路径不能为空'}), 400
-    if not new_display_name:
-        return jsonify({'error': '新名称不能为空'}), 400
-    
+# 新增：移动文件/文件夹API
+def move_item_op(db, plan, params):
+    """
+    把文件或文件夹移动到同一会话的另一个文件夹中，放在最后
+    :param params: filePath, targetFolderPath
+    :return: 移动后的磁盘路径
+    """
+    file_path = params.get('filePath')
+    target_folder_path = params.get('targetFolderPath')
+
+    if not file_path or not target_folder_path:
+        raise ApiError('文件路径和目标文件夹不能为空')
+
+    normalized_path = os.path.abspath(file_path)
+
+    item = resolve_item_path(db, normalized_path)
+    if not item or item.item_id == ROOT_PARENT_ID:
+        raise ApiError('文件或文件夹不存在于数据库中', 404)
+
+    target = resolve_item_path(db, target_folder_path)
+    if not target or target.item_type != 'folder':
+        raise ApiError('目标文件夹不存在于数据库中', 404)
+    if target.session_id != item.session_id:
+        raise ApiError('不能移动到其他会话')
+
+    # 不能移动到自身或自己的子文件夹中
+    if target.item_id != ROOT_PARENT_ID and db.execute(
+        "SELECT 1 FROM file_closure WHERE ancestor_id = ? AND descendant_id = ?",
+        (item.item_id, target.item_id)
+    ).fetchone():
+        raise ApiError('不能移动到自身或其子文件夹中')
+
+    old_parent_id, real_name, display_name = db.execute(
+        "SELECT parent_id, real_name, display_name FROM file_mapping WHERE id = ?",
+        (item.item_id,)
+    ).fetchone()
+    if old_parent_id == target.item_id:
+        return {'success': True, 'filePath': normalized_path}
+
+    if check_display_name_duplicate(target.session_id, target.item_id, display_name):
+        raise ApiError('目标文件夹中已存在同名文件或文件夹')
+
+    target_disk_path = item_disk_path(target.folder_path, target.rel_path)
+    new_path = os.path.join(target_disk_path, real_name)
+    if plan.exists(new_path):
+        raise ApiError('目标文件夹中已存在同名文件或文件夹')
+
+    # 放到目标文件夹的最后
+    position = next_child_position(db, target.session_id, target.item_id)
+
+    # 只改写子树与原祖先之间的闭包记录
+    move_subtree(db, item.item_id, target.item_id)
+    db.execute("UPDATE file_mapping SET position = ? WHERE id = ?", (position, item.item_id))
+
+    # 更新原父文件夹和目标文件夹的子节点数量
+    adjust_child_count(db, old_parent_id, -1)
+    adjust_child_count(db, target.item_id, 1)
+
+    # 移动磁盘上的文件或文件夹（失败时事务回滚）
+    write_behind.relocate(normalized_path, new_path)
+    plan.rename(normalized_path, new_path)
+
+    def move_node(tree):
+        tree.place(item.item_id, target.item_id)
+        tree.set_path(item.item_id, new_path)
+    after_commit(lambda: tree_cache.update(item.session_id, move_node))
+    return {'success': True, 'filePath': new_path}
+
+@app.route('/api/move-item', methods=['POST'])
+def move_item():
     try:
-        if is_folder:
-            # 文件夹重命名，不需要修改数据库
-            success, message = rename_item(file_path, new_display_name, is_folder)
-        else:
-            # 获取当前真实文件名和父文件夹路径
-            normalized_path = os.path.abspath(file_path)
-            real_name = os.path.basename(normalized_path)
-            parent_path = os.path.dirname(normalized_path)
-            
-            # 确保文件以.md结尾
-            if not new_display_name.endswith('.md'):
-                new_display_name += '.md'
-            
-            # 检查显示文件名是否已存在（这是新增的重要检查）
-            if check_display_name_duplicate(parent_path, new_display_name):
-                return jsonify({'error': '该名称的文件已存在'}), 400
-            
-            # 更新数据库中的映射关系
-            cursor.execute(
-                "UPDATE file_mapping SET display_name = ? WHERE real_name = ?",
-                (new_display_name, real_name)
-            )
-            conn.commit()
-            
-            success, message = True, f'文件已成功重命名为 "{new_display_name}"'
-        
-        if success:
-            return jsonify({'success': True, 'message': message})
-        else:
-            return jsonify({'error': message}), 400
+        with planned_transaction() as (db, plan):
+            result = move_item_op(db, plan, request.json)
+        return jsonify(result)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status
+    except PermissionError:
+        return jsonify({'error': '权限不足，无法移动文件或文件夹'}), 403
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# 批量修改文件树：按顺序执行的操作类型及其实现
+BATCH_OPERATIONS = {
+    'create-file': create_file_op,
+    'create-folder': create_folder_op,
+    'rename-item': rename_item_op,
+    'delete-item': delete_item_op,
+    'reorder-items': reorder_items_op,
+    'move-item': move_item_op,
+}
+
+@app.route('/api/batch', methods=['POST'])
+def batch_operations():
+    """
+    在一个事务中按顺序执行多个文件树操作，全部成功或全部回滚
+    请求体：{"operations": [{"op": "create-file", "folderPath": ..., "fileName": ...}, ...]}，
+    每个操作的参数与对应的单独接口相同；后面的操作可以使用前面操作产生的路径
+    先修改数据库并登记磁盘操作，全部通过后统一执行磁盘操作再提交
+    :return: {"success": true, "results": [...]}，失败时返回出错操作的序号index
+    """
+    data = request.json or {}
+    operations = data.get('operations')
+
+    # 执行前先检查所有操作的格式
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': '操作列表不能为空'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'一次最多执行 {BATCH_MAX_OPERATIONS} 个操作'}), 400
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in BATCH_OPERATIONS:
+            return jsonify({'error': '不支持的操作类型', 'index': index}), 400
+
+    index = None
+    plan = None
+    try:
+        with planned_transaction() as (db, plan):
+            results = []
+            for index, operation in enumerate(operations):
+                plan.label = index
+                results.append(BATCH_OPERATIONS[operation['op']](db, plan, operation))
+            # 接下来的磁盘阶段出错时由plan记录出错的操作
+            index = None
+        return jsonify({'success': True, 'results': results})
+    except ApiError as e:
+        return jsonify({'error': e.message, 'index': index}), e.status
+    except PermissionError:
+        return jsonify({'error': '权限不足，无法修改文件或文件夹', 'index': plan.failed_label if plan else index}), 403
+    except Exception as e:
+        logger.exception("批量操作失败")
+        return jsonify({'error': str(e), 'index': plan.failed_label if plan and index is None else index}), 500
+
 # 新增：导出目录API
 def generate_summary_md(folder_path):
     """
@@ -1474,8 +5779,7 @@ def export_summary():
     
     try:
         # 从数据库中获取文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        result = get_db().execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
         
         if not result:
             return jsonify({'error': '会话不存在'}), 404
@@ -1486,15 +5790,21 @@ def export_summary():
         if not os.path.exists(folder_path):
             return jsonify({'error': '文件夹不存在'}), 404
         
+        # 先把缓冲中的保存写入磁盘，避免之后用旧内容覆盖新生成的SUMMARY.md
+        write_behind.flush(folder_path)
+
         # 生成SUMMARY.md文件内容
-        summary_content = generate_summary_md(folder_path)
+        with transaction(immediate=False):
+            summary_content = generate_summary_md(folder_path)
         
         # 构建SUMMARY.md文件路径
         summary_path = os.path.join(folder_path, 'SUMMARY.md')
         
         # 写入文件
-        with open(summary_path, 'w', encoding='utf-8') as f:
-            f.write(summary_content)
+        with file_write_lock(summary_path):
+            content_bytes = summary_content.encode('utf-8')
+            stat = atomic_write_bytes(summary_path, content_bytes)
+            file_validators.put(summary_path, stat, file_validators.compute(content_bytes))
         
         return jsonify({
             'success': True,
@@ -1504,6 +5814,32 @@ def export_summary():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def startup():
+    """
+    服务进程启动时执行一次：处理上次遗留的任务、恢复延迟写入、清理上传暂存目录、按需在后台建立全文索引
+    导入模块（测试）和执行命令行命令时不执行
+    """
+    job_manager.recover()
+    write_behind.recover()
+    if write_behind.enabled:
+        write_behind.start()
+    cleanup_upload_staging()
+    _schedule_search_index_cold_start()
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == [SEARCH_REBUILD_COMMAND]:
+        print(rebuild_search_index(sys.argv[2] if len(sys.argv) > 2 else None))
+        sys.exit(0)
+    if sys.argv[1:2] == [IMAGE_GC_COMMAND]:
+        try:
+            print(collect_orphan_images(purge='--dry-run' not in sys.argv[2:]))
+        except ApiError as e:
+            print(e.message)
+            sys.exit(1)
+        sys.exit(0)
     print(f'服务器运行在 http://{base_url}')
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    # 调试模式下重载器的监视进程不处理请求，启动任务只在实际服务的子进程中执行一次
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        startup()
+    # 每个请求在独立线程中处理，各自使用连接池中的数据库连接
+    app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
\ No newline at end of file
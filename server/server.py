@@ -6,8 +6,9 @@ import time
 import shutil  # 添加shutil模块用于删除文件夹
 from datetime import datetime
 import subprocess
+from contextlib import contextmanager
 import requests
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g
 import sqlite3
 from dotenv import load_dotenv
 # sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -42,11 +43,59 @@ WEBSITES_FOLDER = os.path.abspath(WEBSITES_FOLDER)
 
 
 sessions_db_path = os.path.join(DATA_FOLDER, 'sessions.db')
-conn = sqlite3.connect(sessions_db_path, check_same_thread=False)
-cursor = conn.cursor()
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
 
+def _open_db_connection():
+    """
+    打开一个新的数据库连接，事务由transaction()显式控制
+    """
+    db = sqlite3.connect(
+        sessions_db_path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        check_same_thread=False
+    )
+    db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    db.execute("PRAGMA synchronous = NORMAL")
+    return db
+
+def get_db():
+    """
+    获取当前请求专用的数据库连接，请求结束时关闭
+    """
+    if 'db' not in g:
+        g.db = _open_db_connection()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+@contextmanager
+def transaction(immediate=True):
+    """
+    在当前请求的连接上执行一个显式事务，正常结束时提交，出现异常时回滚
+    """
+    db = get_db()
+    if db.in_transaction:
+        yield db
+        return
+    db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
+_init_db = _open_db_connection()
+# WAL模式：读请求不再被写请求阻塞
+_init_db.execute("PRAGMA journal_mode = WAL")
 # 创建sessions表（如果不存在）
-cursor.execute('''
+_init_db.execute('''
     CREATE TABLE IF NOT EXISTS sessions (
         session_id TEXT PRIMARY KEY,
         folder_name TEXT NOT NULL,
@@ -54,7 +103,7 @@ cursor.execute('''
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
 ''')
-conn.commit()
+_init_db.close()
 
 # 新增：上传图片文件API (用于处理编辑器内粘贴或拖入的图片)
 @app.route('/api/upload-image', methods=['POST'])
@@ -186,8 +235,8 @@ def after_request(response):
 def get_all_sessions():
     try:
         # 从数据库中查询所有会话记录
-        cursor.execute("SELECT session_id, folder_name, folder_path, created_at FROM sessions")
-        sessions_data = cursor.fetchall()
+        with transaction(immediate=False) as db:
+            sessions_data = db.execute("SELECT session_id, folder_name, folder_path, created_at FROM sessions").fetchall()
         
         sessions = []
         for session in sessions_data:
@@ -273,26 +322,25 @@ def create_website_session():
                     'error': f'gitbook init 失败: {process.stderr}'
                 }), 500
 
-        # 检查是否已存在相同文件夹的会话
-        cursor.execute("SELECT session_id FROM sessions WHERE folder_path = ?", (website_folder,))
-        existing_session = cursor.fetchone()
+        with transaction() as db:
+            # 检查是否已存在相同文件夹的会话
+            existing_session = db.execute("SELECT session_id FROM sessions WHERE folder_path = ?", (website_folder,)).fetchone()
 
-        # 如果存在相同文件夹的会话，返回已有的 sessionId
-        if existing_session:
-            return jsonify({'sessionId': existing_session[0]})
+            # 如果存在相同文件夹的会话，返回已有的 sessionId
+            if existing_session:
+                return jsonify({'sessionId': existing_session[0]})
 
-        # 生成唯一 ID
-        session_id = str(uuid.uuid4())[:8]
+            # 生成唯一 ID
+            session_id = str(uuid.uuid4())[:8]
 
-        # 创建会话文件夹
-        session_folder = os.path.join(USER_FOLDER, session_id)
-        os.makedirs(session_folder, exist_ok=True)
-        
-        cursor.execute(
-            "INSERT INTO sessions (session_id, folder_name, folder_path) VALUES (?, ?, ?)",
-            (session_id, folder_name, website_folder)
-        )
-        conn.commit()
+            # 创建会话文件夹
+            session_folder = os.path.join(USER_FOLDER, session_id)
+            os.makedirs(session_folder, exist_ok=True)
+            
+            db.execute(
+                "INSERT INTO sessions (session_id, folder_name, folder_path) VALUES (?, ?, ?)",
+                (session_id, folder_name, website_folder)
+            )
 
         return jsonify({'sessionId': session_id})
     except Exception as e:
@@ -308,8 +356,7 @@ def get_folder_session():
 
     try:
         # 查找会话文件夹
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        result = get_db().execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
 
         if not result:
             return jsonify({'error': '会话不存在'}), 404
@@ -465,8 +512,7 @@ def export_book():
 
     try:
         # 从数据库中获取文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        result = get_db().execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
 
         if not result:
             return jsonify({'error': '会话不存在'}), 404
@@ -728,32 +774,31 @@ def edit_session():
         return jsonify({'error': '会话ID和新名称不能为空'}), 400
 
     try:
-         # 从数据库中获取原文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        with transaction() as db:
+            # 从数据库中获取原文件夹路径
+            result = db.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
 
-        if not result:
-            return jsonify({'error': '会话不存在'}), 404
+            if not result:
+                return jsonify({'error': '会话不存在'}), 404
 
-        old_folder_path = result[0]
-        parent_path = os.path.dirname(old_folder_path)
+            old_folder_path = result[0]
+            parent_path = os.path.dirname(old_folder_path)
 
-        # 构建新的文件夹路径
-        new_folder_path = os.path.join(parent_path, new_name)
+            # 构建新的文件夹路径
+            new_folder_path = os.path.join(parent_path, new_name)
 
-        # 检查新名称的文件夹是否已存在
-        if os.path.exists(new_folder_path):
-            return jsonify({'error': '该名称的文件夹已存在'}), 400
+            # 检查新名称的文件夹是否已存在
+            if os.path.exists(new_folder_path):
+                return jsonify({'error': '该名称的文件夹已存在'}), 400
 
-        # 重命名文件夹
-        os.rename(old_folder_path, new_folder_path)
+            # 更新数据库中的文件夹路径和名称
+            db.execute(
+                "UPDATE sessions SET folder_name = ?, folder_path = ? WHERE session_id = ?",
+                (new_name, new_folder_path, session_id)
+            )
 
-       # 更新数据库中的文件夹路径和名称
-        cursor.execute(
-            "UPDATE sessions SET folder_name = ?, folder_path = ? WHERE session_id = ?",
-            (new_name, new_folder_path, session_id)
-        )
-        conn.commit()
+            # 重命名文件夹（失败时事务回滚）
+            os.rename(old_folder_path, new_folder_path)
 
         # 重新读取文件夹结构
         # session_data['structure'] = read_folder_structure(new_folder_path)
@@ -775,8 +820,8 @@ def delete_session():
 
     try:
         # 从数据库中删除会话记录
-        cursor.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-        conn.commit()
+        with transaction() as db:
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
 
         # 删除会话文件夹
         session_folder = os.path.join(USER_FOLDER, session_id)
@@ -946,8 +991,7 @@ def export_summary():
     
     try:
         # 从数据库中获取文件夹路径
-        cursor.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,))
-        result = cursor.fetchone()
+        result = get_db().execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
         
         if not result:
             return jsonify({'error': '会话不存在'}), 404
@@ -978,4 +1022,4 @@ def export_summary():
 
 if __name__ == '__main__':
     print(f'服务器运行在 http://{base_url}')
-    app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
\ No newline at end of file
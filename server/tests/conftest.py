@@ -0,0 +1,83 @@
+import importlib.util
+import os
+
+import pytest
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server-docker.py')
+
+
+@pytest.fixture
+def load_server(tmp_path, monkeypatch):
+    """
+    在临时数据目录中加载服务模块，关键字参数作为环境变量（配置在加载时读取）
+    """
+    def load(**env):
+        for key, value in env.items():
+            monkeypatch.setenv(key, str(value))
+        monkeypatch.chdir(tmp_path)
+        spec = importlib.util.spec_from_file_location('server_docker', SERVER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
+
+
+@pytest.fixture
+def make_book():
+    """
+    在websites下建立书籍文件夹并打开会话，返回(会话ID, 书籍文件夹, {显示名称路径: 磁盘路径})
+    :param files: {相对路径: 内容}
+    """
+    def make(server, files, name='book'):
+        book = os.path.join(server.WEBSITES_FOLDER, name)
+        for rel_path, content in files.items():
+            path = os.path.join(book, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        client = server.app.test_client()
+        session_id = client.post('/api/create-website-session', json={'folderName': name, 'wait': True}).get_json()['sessionId']
+        wait_for_jobs(server)
+        return session_id, book, disk_paths(server, session_id)
+    return make
+
+
+def wait_for_jobs(server):
+    """
+    等待所有后台任务结束（导入后在后台建立全文索引）
+    """
+    with server.app.app_context():
+        job_ids = [row[0] for row in server.get_db().execute("SELECT id FROM jobs WHERE status IN ('queued', 'running')")]
+    for job_id in job_ids:
+        server.job_manager.wait(job_id, timeout=30)
+
+
+def disk_paths(server, session_id):
+    """
+    返回会话中每个节点的显示路径（如 ch/a.md）到磁盘路径的映射
+    """
+    with server.app.app_context():
+        db = server.get_db()
+        folder_path = db.execute("SELECT folder_path FROM sessions WHERE session_id = ?", (session_id,)).fetchone()[0]
+        rows = server.fetch_subtree(db, session_id)
+        names = {item_id: (parent_id, display_name) for item_id, parent_id, display_name, _, _ in rows}
+
+        def display_path(item_id):
+            parent_id, display_name = names[item_id]
+            return display_name if parent_id not in names else display_path(parent_id) + '/' + display_name
+
+        return {display_path(item_id): server.item_disk_path(folder_path, rel_path) for item_id, _, _, rel_path, _ in rows}
+
+
+def folder_tree(server, session_id):
+    return server.app.test_client().get('/api/get-folder-session', query_string={'id': session_id}).get_json()
+
+
+def assert_tree_cache_matches_db(server, session_id):
+    """
+    写操作后原地更新的缓存文件树必须与从数据库重新构建的一致
+    """
+    assert server.tree_cache.get(session_id) is not None, '文件树缓存已被丢弃'
+    cached = folder_tree(server, session_id)
+    server.tree_cache.invalidate(session_id)
+    assert cached == folder_tree(server, session_id)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from conftest import disk_paths
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def batch(client, *operations):
+    return client.post('/api/batch', json={'operations': list(operations)})
+
+
+def test_delete_then_recreate_folder(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'x/README.md': '', 'x/a.md': 'old'})
+    client = server.app.test_client()
+
+    response = batch(
+        client,
+        {'op': 'delete-item', 'filePath': paths['x'], 'isFolder': True},
+        {'op': 'create-folder', 'parentPath': book, 'folderName': 'x'},
+    )
+    assert response.status_code == 200, response.get_json()
+
+    after = disk_paths(server, session_id)
+    assert 'x/a.md' not in after
+    assert os.listdir(os.path.join(book, 'x')) == ['README.md']
+
+
+def test_rename_then_use_new_path(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a/README.md': '', 'b.md': ''})
+    client = server.app.test_client()
+    renamed = os.path.join(book, 'c')
+
+    response = batch(
+        client,
+        {'op': 'rename-item', 'filePath': paths['a'], 'newName': 'c', 'isFolder': True},
+        # 改名后原名称已空出，新名称已被占用
+        {'op': 'create-folder', 'parentPath': book, 'folderName': 'a'},
+        {'op': 'create-file', 'folderPath': renamed, 'fileName': 'new.md'},
+        {'op': 'move-item', 'filePath': paths['b.md'], 'targetFolderPath': renamed},
+    )
+    assert response.status_code == 200, response.get_json()
+
+    after = disk_paths(server, session_id)
+    assert {'a', 'a/README.md', 'c/README.md', 'c/new.md', 'c/b.md'} <= set(after)
+    assert all(os.path.exists(path) for path in after.values())
+
+
+def test_create_over_renamed_target_is_rejected(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a/README.md': ''})
+    client = server.app.test_client()
+
+    response = batch(
+        client,
+        {'op': 'rename-item', 'filePath': paths['a'], 'newName': 'c', 'isFolder': True},
+        {'op': 'create-folder', 'parentPath': book, 'folderName': 'c'},
+    )
+    assert response.status_code == 400
+    assert response.get_json()['index'] == 1
+
+
+def test_failed_batch_rolls_back_everything(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'x/README.md': '', 'x/a.md': 'old'})
+    client = server.app.test_client()
+    before = disk_paths(server, session_id)
+    listing = sorted(os.listdir(book))
+
+    response = batch(
+        client,
+        {'op': 'delete-item', 'filePath': paths['x'], 'isFolder': True},
+        {'op': 'create-folder', 'parentPath': book, 'folderName': 'y'},
+        {'op': 'rename-item', 'filePath': os.path.join(book, 'missing'), 'newName': 'z', 'isFolder': True},
+    )
+    assert response.status_code == 404
+    assert response.get_json()['index'] == 2
+
+    assert disk_paths(server, session_id) == before
+    assert sorted(os.listdir(book)) == listing
+    with open(paths['x/a.md'], encoding='utf-8') as f:
+        assert f.read() == 'old'
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server(BULK_READ_MAX_FILES='2')
+
+
+def test_session_read_is_paged(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': 'a', 'b.md': 'b', 'ch/README.md': '', 'ch/c.md': 'c'})
+    client = server.app.test_client()
+
+    names, cursor, pages = [], None, 0
+    while True:
+        response = client.post('/api/file-contents', json={'sessionId': session_id, 'cursor': cursor})
+        assert response.status_code == 200, response.get_json()
+        body = response.get_json()
+        assert len(body['files']) <= 2
+        assert response.headers.get('X-Next-Cursor') == body['nextCursor']
+        names += [record['name'] for record in body['files']]
+        pages += 1
+        cursor = body['nextCursor']
+        if not cursor:
+            break
+
+    assert pages == 3
+    assert sorted(names) == ['README.md', 'README.md', 'a.md', 'b.md', 'c.md']
+
+
+def test_streaming_read_ends_with_cursor(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': 'a', 'b.md': 'b'})
+    client = server.app.test_client()
+
+    response = client.post('/api/file-contents', json={'sessionId': session_id}, headers={'Accept': 'application/x-ndjson'})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 3
+    assert lines[-1] == {'nextCursor': '2'}
+
+
+def test_invalid_cursor_is_rejected(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': ''})
+    response = server.app.test_client().post('/api/file-contents', json={'sessionId': session_id, 'cursor': 'x'})
+    assert response.status_code == 400
+
+
+def test_file_over_budget_is_skipped_without_reading(load_server, make_book, monkeypatch):
+    server = load_server(BULK_READ_MAX_BYTES='100')
+    session_id, book, paths = make_book(server, {'README.md': 'r', 'big.md': 'x' * 500, 'small.md': 's'})
+    client = server.app.test_client()
+    read = []
+    original = server.read_file_version
+
+    def read_file_version(path, known_etag=None):
+        read.append(path)
+        return original(path, known_etag)
+
+    monkeypatch.setattr(server, 'read_file_version', read_file_version)
+    files = client.post('/api/file-contents', json={'sessionId': session_id}).get_json()['files']
+    records = {record['name']: record for record in files}
+
+    assert records['big.md']['skipped'] is True
+    assert 'content' not in records['big.md']
+    # 大文件之后的小文件仍然返回内容
+    assert records['small.md']['content'] == 's'
+    assert paths['big.md'] not in read
+
+
+def test_next_cursor_header_is_exposed(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': '', 'b.md': ''})
+    response = server.app.test_client().post('/api/file-contents', json={'sessionId': session_id})
+    assert 'X-Next-Cursor' in response.headers['Access-Control-Expose-Headers']
@@ -0,0 +1,104 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+BOOK_FILES = {
+    'index.html': b'<html>index</html>',
+    'empty.txt': b'',
+    'gitbook/big.js': bytes(range(256)) * 2500,
+    '章节/第一章.html': '第一章'.encode('utf-8'),
+}
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+@pytest.fixture
+def book(server, make_book):
+    session_id, _, _ = make_book(server, {'README.md': ''})
+    book_folder = os.path.join(server.USER_FOLDER, session_id, '_book')
+    for name, content in BOOK_FILES.items():
+        path = os.path.join(book_folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+    return session_id, book_folder
+
+
+def download(server, session_id, **headers):
+    return server.app.test_client().get('/api/download-book', query_string={'sessionId': session_id}, headers=headers)
+
+
+def test_full_download_is_valid_zip(server, book):
+    session_id, _ = book
+    response = download(server, session_id)
+    assert response.status_code == 200
+    body = response.get_data()
+    assert int(response.headers['Content-Length']) == len(body)
+
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        assert archive.testzip() is None
+        assert {name: archive.read(name) for name in archive.namelist()} == BOOK_FILES
+
+
+@pytest.mark.parametrize('spec', ['0-0', '0-29', '10-200', '100-300000', '-22', '-100', '300000-', '1-'])
+def test_range_equals_slice_of_full_body(server, book, spec):
+    session_id, _ = book
+    full = download(server, session_id).get_data()
+    total = len(full)
+    start, _, end = spec.partition('-')
+    if not start:
+        start, stop = total - int(end), total
+    else:
+        start, stop = int(start), (int(end) + 1 if end else total)
+
+    response = download(server, session_id, Range=f'bytes={spec}')
+    assert response.status_code == 206
+    assert response.get_data() == full[start:stop]
+    assert response.headers['Content-Range'] == f'bytes {start}-{stop - 1}/{total}'
+    assert int(response.headers['Content-Length']) == stop - start
+
+
+def test_unsatisfiable_range_returns_416(server, book):
+    session_id, _ = book
+    total = len(download(server, session_id).get_data())
+    response = download(server, session_id, Range=f'bytes={total}-')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{total}'
+
+
+def test_conditional_requests(server, book):
+    session_id, book_folder = book
+    first = download(server, session_id)
+    etag = first.headers['ETag']
+    assert download(server, session_id, **{'If-None-Match': etag}).status_code == 304
+    assert download(server, session_id, Range='bytes=0-9', **{'If-Range': etag}).status_code == 206
+    # If-Range不匹配时返回完整内容
+    response = download(server, session_id, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.get_data() == first.get_data()
+
+
+def test_crc_index_is_reused_until_book_changes(server, book, monkeypatch):
+    session_id, book_folder = book
+    full = download(server, session_id).get_data()
+
+    computed = []
+    original = server._file_crc32
+    monkeypatch.setattr(server, '_file_crc32', lambda path: computed.append(path) or original(path))
+    # 内存中的索引被淘汰后从会话文件夹中保存的索引读取CRC
+    server._book_zip_indexes.clear()
+    assert download(server, session_id).get_data() == full
+    assert computed == []
+
+    with open(os.path.join(book_folder, 'index.html'), 'wb') as f:
+        f.write(b'<html>changed</html>')
+    response = download(server, session_id)
+    assert computed
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as archive:
+        assert archive.testzip() is None
+        assert archive.read('index.html') == b'<html>changed</html>'
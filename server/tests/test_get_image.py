@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+HASH_NAME = 'ab' * 32 + '.png'
+LEGACY_NAME = '1a2b3c4d.png'
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def add_image(server, name, content=CONTENT):
+    path = os.path.join(server.PIC_FOLDER, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def get(server, name, **headers):
+    return server.app.test_client().get(f'/api/get-image/{name}', headers=headers)
+
+
+def test_hash_named_image_is_cached_immutably(server):
+    add_image(server, HASH_NAME)
+    response = get(server, HASH_NAME)
+    assert response.status_code == 200
+    assert response.get_data() == CONTENT
+    assert response.headers['ETag'] == f'"{"ab" * 32}"'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert f'max-age={server.IMAGE_CACHE_MAX_AGE}' in response.headers['Cache-Control']
+
+    assert get(server, HASH_NAME, **{'If-None-Match': response.headers['ETag']}).status_code == 304
+    not_modified = get(server, HASH_NAME, **{'If-Modified-Since': response.headers['Last-Modified']})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b''
+
+
+def test_range_requests(server):
+    add_image(server, HASH_NAME)
+    etag = get(server, HASH_NAME).headers['ETag']
+
+    response = get(server, HASH_NAME, Range='bytes=10-19')
+    assert response.status_code == 206
+    assert response.get_data() == CONTENT[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(CONTENT)}'
+
+    suffix = get(server, HASH_NAME, Range='bytes=-5')
+    assert suffix.status_code == 206 and suffix.get_data() == CONTENT[-5:]
+    assert get(server, HASH_NAME, Range='bytes=10-19', **{'If-Range': etag}).status_code == 206
+    # If-Range不匹配时返回完整内容
+    stale = get(server, HASH_NAME, Range='bytes=10-19', **{'If-Range': '"stale"'})
+    assert stale.status_code == 200 and stale.get_data() == CONTENT
+    unsatisfiable = get(server, HASH_NAME, Range=f'bytes={len(CONTENT)}-')
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
+
+
+def test_legacy_name_etag_follows_file(server):
+    path = add_image(server, LEGACY_NAME)
+    etag = get(server, LEGACY_NAME).headers['ETag']
+    assert get(server, LEGACY_NAME, **{'If-None-Match': etag}).status_code == 304
+
+    add_image(server, LEGACY_NAME, CONTENT + b'more')
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    response = get(server, LEGACY_NAME, **{'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_missing_image_returns_404(server):
+    assert get(server, HASH_NAME).status_code == 404
+
+
+@pytest.mark.parametrize('offload', ['x-accel', 'x-sendfile'])
+def test_offloaded_response_has_headers_only(load_server, offload):
+    server = load_server(IMAGE_OFFLOAD=offload, IMAGE_ACCEL_PREFIX='/internal/')
+    path = add_image(server, HASH_NAME)
+
+    response = get(server, HASH_NAME)
+    assert response.status_code == 200
+    assert response.get_data() == b''
+    assert response.headers['Content-Type'] == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    if offload == 'x-accel':
+        assert response.headers['X-Accel-Redirect'] == f'/internal/pic/{HASH_NAME}'
+    else:
+        assert response.headers['X-Sendfile'] == path
+
+    # 条件请求由后端直接返回304，不交给代理
+    not_modified = get(server, HASH_NAME, **{'If-None-Match': response.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert 'X-Accel-Redirect' not in not_modified.headers and 'X-Sendfile' not in not_modified.headers
+
+
+def test_variant_has_its_own_etag(server):
+    image_module = pytest.importorskip('PIL.Image')
+    path = os.path.join(server.PIC_FOLDER, HASH_NAME)
+    image_module.new('RGB', (1000, 500), 'red').save(path)
+
+    original = get(server, HASH_NAME)
+    response = server.app.test_client().get(f'/api/get-image/{HASH_NAME}', query_string={'w': 300})
+    assert response.status_code == 200
+    assert response.headers['ETag'] == f'"{"ab" * 32}-w320"'
+    assert response.headers['ETag'] != original.headers['ETag']
+    with image_module.open(server.image_variants.get(path, 320)) as variant:
+        assert variant.width == 320
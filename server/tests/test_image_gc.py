@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+
+DAY = 86400
+
+REFERENCED = ['inline.png', 'ref.png', 'link.png', 'alt.png', 'html.png', 'encoded name.png']
+
+CONTENT = '''# 图片
+
+![a](/api/get-image/inline.png)
+
+![b][r]
+
+[r]: http://example.com/api/get-image/ref.png "title"
+
+[下载](/api/get-image/link.png)
+
+![alt [x] y](/api/get-image/alt.png)
+
+<img alt="h" src="/api/get-image/html.png">
+
+![e](/api/get-image/encoded%20name.png)
+'''
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server(IMAGE_GC_GRACE_DAYS='1')
+
+
+def add_image(server, name, data=b'image'):
+    with open(os.path.join(server.PIC_FOLDER, name), 'wb') as f:
+        f.write(data)
+
+
+def pictures(server):
+    return sorted(name for name in os.listdir(server.PIC_FOLDER) if not name.startswith('.'))
+
+
+def test_every_link_form_counts_as_reference(server, make_book):
+    for name in REFERENCED + ['orphan.png']:
+        add_image(server, name)
+    make_book(server, {'README.md': CONTENT})
+
+    now = time.time()
+    assert server.collect_orphan_images(now=now)['orphans'] == 1
+    stats = server.collect_orphan_images(now=now + 2 * DAY)
+
+    assert stats['purged'] == 1
+    assert pictures(server) == sorted(REFERENCED)
+
+
+def test_gc_refuses_until_refs_are_complete(server, make_book):
+    add_image(server, 'orphan.png')
+    session_id, book, paths = make_book(server, {'README.md': ''})
+    with server.app.app_context():
+        server.get_db().execute("UPDATE sessions SET image_refs_complete = 0 WHERE session_id = ?", (session_id,))
+        server.get_db().commit()
+
+    with pytest.raises(server.ApiError) as excinfo:
+        server.collect_orphan_images()
+    assert excinfo.value.status == 409
+
+    server.rebuild_search_index(session_id)
+    assert server.collect_orphan_images()['orphans'] == 1
+
+
+def test_reused_image_leaves_orphan_list(server, make_book):
+    make_book(server, {'README.md': ''})
+    filename = server.store_image([b'same content'], '.png')
+    now = time.time()
+    server.collect_orphan_images(purge=False, now=now)
+
+    # 再次上传同一张图片后重新计算宽限期
+    assert server.store_image([b'same content'], '.png') == filename
+    server.collect_orphan_images(now=now + 2 * DAY)
+
+    assert pictures(server) == [filename]
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def test_import_indexes_after_commit(server, monkeypatch):
+    book = os.path.join(server.WEBSITES_FOLDER, 'book')
+    os.makedirs(book)
+    with open(os.path.join(book, 'README.md'), 'w', encoding='utf-8') as f:
+        f.write('keyword')
+    submitted = []
+
+    def submit(kind, session_id, params):
+        # 导入的写事务提交之后才提交索引任务
+        assert not server.get_db().in_transaction
+        submitted.append((kind, session_id, params))
+        return 'job'
+
+    monkeypatch.setattr(server.job_manager, 'submit', submit)
+    client = server.app.test_client()
+    session_id = client.post('/api/create-website-session', json={'folderName': 'book'}).get_json()['sessionId']
+
+    assert submitted == [(server.SEARCH_REBUILD_COMMAND, session_id, {'session_id': session_id})]
+    with server.app.app_context():
+        assert server.get_db().execute("SELECT COUNT(*) FROM search_docs").fetchone()[0] == 0
+
+    server.rebuild_search_index(session_id)
+    results = client.get('/api/search', query_string={'sessionId': session_id, 'q': 'keyword'}).get_json()['results']
+    assert len(results) == 1
@@ -0,0 +1,70 @@
+import pytest
+
+from conftest import assert_tree_cache_matches_db, folder_tree
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def children(server, session_id):
+    return [node['name'] for node in folder_tree(server, session_id)['structure']]
+
+
+def positions(server, session_id):
+    with server.app.app_context():
+        return [row[0] for row in server.get_db().execute(
+            "SELECT position FROM file_mapping WHERE session_id = ? AND parent_id = ? ORDER BY position",
+            (session_id, server.ROOT_PARENT_ID)
+        )]
+
+
+def test_reorder_renumbers_when_gap_runs_out(server, make_book, monkeypatch):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': '', 'b.md': '', 'c.md': ''})
+    renumbered = []
+    original = server.renumber_positions
+    monkeypatch.setattr(server, 'renumber_positions', lambda *args: renumbered.append(args) or original(*args))
+    client = server.app.test_client()
+    ids = {node['name']: node['id'] for node in folder_tree(server, session_id)['structure']}
+    order = children(server, session_id)
+
+    def drag(dragged, target):
+        response = client.post('/api/reorder-items', json={
+            'parentFolderPath': book, 'draggedId': ids[dragged], 'targetId': ids[target]
+        })
+        assert response.status_code == 200, response.get_json()
+        # 向下拖动放到目标之后，向上拖动放到目标之前
+        down = order.index(dragged) < order.index(target)
+        order.remove(dragged)
+        order.insert(order.index(target) + (1 if down else 0), dragged)
+
+    # 每次都插入到同一对相邻项目之间，间隔每次减半，很快用完
+    first, second = order[0], order[1]
+    for _ in range(3 * server.POSITION_GAP.bit_length()):
+        drag(order[-1], second)
+        second = order[1]
+        assert children(server, session_id) == order
+    assert order[0] == first
+
+    assert renumbered
+    # 重新编号后位置仍各不相同，且不会无限增长
+    current = positions(server, session_id)
+    assert len(set(current)) == len(current)
+    assert max(current) <= (len(current) + 1) * server.POSITION_GAP
+    assert_tree_cache_matches_db(server, session_id)
+
+
+def test_renumber_keeps_order_of_equal_positions(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': '', 'b.md': '', 'c.md': ''})
+    before = children(server, session_id)
+    with server.app.app_context():
+        db = server.get_db()
+        # 旧数据中位置相同的项目按rowid排序
+        db.execute("UPDATE file_mapping SET position = 0 WHERE session_id = ?", (session_id,))
+        server.renumber_positions(db, session_id, server.ROOT_PARENT_ID)
+        db.commit()
+    server.tree_cache.invalidate(session_id)
+
+    assert children(server, session_id) == before
+    assert positions(server, session_id) == [server.POSITION_GAP * (i + 1) for i in range(len(before))]
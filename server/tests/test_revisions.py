@@ -0,0 +1,65 @@
+import pytest
+
+
+@pytest.fixture
+def server(load_server, monkeypatch):
+    server = load_server(REVISION_MIN_INTERVAL='0')
+    scheduled = []
+    # 不在后台线程中处理，由测试显式调用rebase_revisions
+    monkeypatch.setattr(server, 'schedule_revision_maintenance', scheduled.append)
+    server.scheduled = scheduled
+    return server
+
+
+def save(client, path, content):
+    response = client.post('/api/save-file', json={'filePath': path, 'content': content})
+    assert response.status_code == 200, response.get_json()
+
+
+def revision_contents(client, path):
+    revisions = client.get('/api/revisions', query_string={'filePath': path}).get_json()['revisions']
+    return [client.get(f'/api/revisions/{revision["id"]}').get_json()['content'] for revision in revisions]
+
+
+def blob_bases(server):
+    with server.app.app_context():
+        return dict(server.get_db().execute("SELECT hash, base_hash FROM revision_blobs").fetchall())
+
+
+def versions(count):
+    base = ''.join(f'line {i}\n' for i in range(200))
+    return [base + f'edit {k}\n' for k in range(count)]
+
+
+def test_save_stores_full_content_and_rebases_later(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': ''})
+    client = server.app.test_client()
+    contents = versions(5)
+    for content in contents:
+        save(client, paths['README.md'], content)
+
+    assert all(base is None for base in blob_bases(server).values())
+    assert len(set(server.scheduled)) == 1
+
+    server.rebase_revisions(server.scheduled[0])
+    # 保存前的空内容不比差量大，保持完整内容；其余较旧的版本都改为差量
+    assert sum(base is None for base in blob_bases(server).values()) == 2
+    assert revision_contents(client, paths['README.md']) == contents[::-1] + ['']
+
+
+def test_coalesced_save_releases_replaced_base(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': ''})
+    client = server.app.test_client()
+    first, second, third = versions(3)
+    save(client, paths['README.md'], first)
+    save(client, paths['README.md'], second)
+    server.rebase_revisions(server.scheduled[0])
+
+    server.REVISION_MIN_INTERVAL = 3600
+    save(client, paths['README.md'], third)
+    # 被替换的版本在改为以新内容为基础之前仍是差量基础
+    assert len(blob_bases(server)) == 4
+    server.rebase_revisions(server.scheduled[0])
+
+    assert len(blob_bases(server)) == 3
+    assert revision_contents(client, paths['README.md']) == [third, first, '']
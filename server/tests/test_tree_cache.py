@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from conftest import assert_tree_cache_matches_db, disk_paths, folder_tree
+
+FILES = {
+    'README.md': '',
+    'a.md': 'a',
+    'b.md': 'b',
+    'c.md': 'c',
+    'ch/README.md': '',
+    'ch/x.md': 'x',
+    'ch/sub/README.md': '',
+    'ch/sub/y.md': 'y',
+    'other/README.md': '',
+}
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def item_id(server, session_id, display_path):
+    """
+    按显示路径查找节点ID
+    """
+    nodes = folder_tree(server, session_id)['structure']
+    for name in display_path.split('/'):
+        node = next(node for node in nodes if node['name'] == name)
+        nodes = node.get('children', [])
+    return node['id']
+
+
+def post(client, url, **data):
+    response = client.post(url, json=data)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+OPERATIONS = {
+    'create-file': lambda server, client, sid, book, paths: post(
+        client, '/api/create-file', folderPath=paths['ch/sub'], fileName='new.md'),
+    'create-folder': lambda server, client, sid, book, paths: post(
+        client, '/api/create-folder', parentPath=paths['ch'], folderName='fresh'),
+    'rename-file': lambda server, client, sid, book, paths: post(
+        client, '/api/rename-item', filePath=paths['ch/x.md'], newName='renamed.md', isFolder=False),
+    'rename-folder': lambda server, client, sid, book, paths: post(
+        client, '/api/rename-item', filePath=paths['ch'], newName='chapter', isFolder=True),
+    'move-file': lambda server, client, sid, book, paths: post(
+        client, '/api/move-item', filePath=paths['a.md'], targetFolderPath=paths['ch/sub']),
+    'move-folder': lambda server, client, sid, book, paths: post(
+        client, '/api/move-item', filePath=paths['ch/sub'], targetFolderPath=paths['other']),
+    'reorder-down': lambda server, client, sid, book, paths: post(
+        client, '/api/reorder-items', parentFolderPath=book,
+        draggedId=item_id(server, sid, 'a.md'), targetId=item_id(server, sid, 'c.md')),
+    'reorder-up': lambda server, client, sid, book, paths: post(
+        client, '/api/reorder-items', parentFolderPath=book,
+        draggedId=item_id(server, sid, 'c.md'), targetId=item_id(server, sid, 'a.md')),
+    'delete-file': lambda server, client, sid, book, paths: post(
+        client, '/api/delete-item', filePath=paths['b.md'], isFolder=False),
+    'delete-folder': lambda server, client, sid, book, paths: post(
+        client, '/api/delete-item', filePath=paths['ch'], isFolder=True),
+    'batch': lambda server, client, sid, book, paths: post(client, '/api/batch', operations=[
+        {'op': 'create-folder', 'parentPath': book, 'folderName': 'batch'},
+        {'op': 'create-file', 'folderPath': os.path.join(book, 'batch'), 'fileName': 'n.md'},
+        {'op': 'move-item', 'filePath': paths['c.md'], 'targetFolderPath': os.path.join(book, 'batch')},
+        {'op': 'rename-item', 'filePath': paths['other'], 'newName': 'others', 'isFolder': True},
+        {'op': 'delete-item', 'filePath': paths['ch/x.md'], 'isFolder': False},
+    ]),
+}
+
+
+@pytest.mark.parametrize('operation', sorted(OPERATIONS))
+def test_cached_tree_matches_database(server, make_book, operation):
+    session_id, book, paths = make_book(server, FILES)
+    client = server.app.test_client()
+    before = folder_tree(server, session_id)
+
+    OPERATIONS[operation](server, client, session_id, book, paths)
+
+    assert folder_tree(server, session_id) != before
+    assert_tree_cache_matches_db(server, session_id)
+    # 缓存中的路径都指向磁盘上实际存在的文件或文件夹
+    assert all(os.path.exists(path) for path in disk_paths(server, session_id).values())
+
+
+def test_cached_tree_etag_changes_after_write(server, make_book):
+    session_id, book, paths = make_book(server, FILES)
+    client = server.app.test_client()
+    etag = client.get('/api/get-folder-session', query_string={'id': session_id}).headers['ETag']
+    response = client.get('/api/get-folder-session', query_string={'id': session_id}, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    post(client, '/api/create-file', folderPath=book, fileName='new.md')
+    response = client.get('/api/get-folder-session', query_string={'id': session_id}, headers={'If-None-Match': etag})
+    assert response.status_code == 200
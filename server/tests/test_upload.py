@@ -0,0 +1,65 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from conftest import assert_tree_cache_matches_db, disk_paths, folder_tree
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server()
+
+
+def test_upload_is_staged_outside_book(server, make_book, monkeypatch):
+    session_id, book, paths = make_book(server, {'README.md': ''})
+    staged = []
+    original = server.UploadStager.add_stream
+
+    def add_stream(self, name, src, archive=None):
+        # 暂存时书籍文件夹中不能出现临时目录
+        staged.append((self.staging_dir, sorted(os.listdir(book))))
+        return original(self, name, src, archive)
+
+    monkeypatch.setattr(server.UploadStager, 'add_stream', add_stream)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('part/a.md', 'hello')
+    archive.seek(0)
+
+    response = server.app.test_client().post(
+        '/api/upload-file',
+        data={'folderPath': book, 'file': (archive, 'book.zip')},
+        content_type='multipart/form-data',
+    )
+    assert response.status_code == 200, response.get_json()
+
+    staging_dir, listing = staged[0]
+    assert not staging_dir.startswith(book + os.sep)
+    assert listing == ['README.md']
+    with open(disk_paths(server, session_id)['part/a.md'], encoding='utf-8') as f:
+        assert f.read() == 'hello'
+    assert not [name for name in os.listdir(book) if name.startswith('.')]
+    assert os.listdir(server.UPLOAD_STAGING_FOLDER) == []
+
+
+def test_upload_updates_cached_tree_in_place(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'part/README.md': ''})
+    folder_tree(server, session_id)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('part/a.md', 'merged into existing folder')
+        zf.writestr('new/deep/b.md', 'nested')
+        zf.writestr('new/c.md', 'c')
+    archive.seek(0)
+
+    response = server.app.test_client().post(
+        '/api/upload-file',
+        data={'folderPath': book, 'file': [(archive, 'book.zip'), (io.BytesIO(b'top'), 'top.md')]},
+        content_type='multipart/form-data',
+    )
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()['created'] == 6
+
+    assert_tree_cache_matches_db(server, session_id)
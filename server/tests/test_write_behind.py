@@ -0,0 +1,161 @@
+import os
+import threading
+
+import pytest
+
+from conftest import disk_paths
+
+WRITE_BEHIND = {'WRITE_BEHIND_ENABLED': '1', 'WRITE_BEHIND_IDLE': '3600', 'WRITE_BEHIND_INTERVAL': '3600'}
+
+
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture
+def server(load_server):
+    return load_server(**WRITE_BEHIND)
+
+
+def save(client, path, content):
+    response = client.post('/api/save-file', json={'filePath': path, 'content': content})
+    assert response.status_code == 200, response.get_json()
+
+
+def test_buffered_save_follows_folder_rename(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'ch/README.md': '', 'ch/a.md': 'old'})
+    client = server.app.test_client()
+    save(client, paths['ch/a.md'], 'new')
+
+    response = client.post('/api/rename-item', json={'filePath': paths['ch'], 'newName': 'part', 'isFolder': True})
+    assert response.status_code == 200, response.get_json()
+    server.write_behind.flush()
+
+    new_path = disk_paths(server, session_id)['part/a.md']
+    assert read(new_path) == 'new'
+    assert not os.path.exists(paths['ch'])
+    assert not os.path.exists(os.path.join(server.DATA_FOLDER, 'save-lost'))
+
+
+def test_save_during_rename_is_rekeyed_after_commit(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'ch/README.md': '', 'ch/a.md': 'old'})
+    old_folder = paths['ch']
+    new_folder = os.path.join(book, 'part')
+    old_file = paths['ch/a.md']
+
+    with server.app.app_context():
+        with server.transaction():
+            server.write_behind.relocate(old_folder, new_folder)
+            # 改名事务提交前到达的保存仍使用旧路径，此时刷新不能写入旧路径
+            with server.file_write_lock(old_file):
+                server.write_behind.put(old_file, b'during rename', server.file_validators.compute(b'during rename'))
+            server.write_behind.flush()
+            assert read(old_file) == 'old'
+            os.rename(old_folder, new_folder)
+
+    assert server.write_behind.get(old_file) is None
+    new_file = os.path.join(new_folder, os.path.basename(old_file))
+    assert server.write_behind.get(new_file).content == b'during rename'
+    server.write_behind.flush()
+    assert read(new_file) == 'during rename'
+    assert not os.path.exists(old_folder)
+
+
+def test_rolled_back_rename_keeps_original_path(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'ch/README.md': '', 'ch/a.md': 'old'})
+    old_file = paths['ch/a.md']
+    with server.file_write_lock(old_file):
+        server.write_behind.put(old_file, b'kept', server.file_validators.compute(b'kept'))
+
+    with server.app.app_context():
+        with pytest.raises(RuntimeError):
+            with server.transaction():
+                server.write_behind.relocate(paths['ch'], os.path.join(book, 'part'))
+                raise RuntimeError('rename failed')
+
+    server.write_behind.flush()
+    assert read(old_file) == 'kept'
+
+
+def test_buffered_save_follows_file_move(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': 'old', 'ch/README.md': ''})
+    client = server.app.test_client()
+    save(client, paths['a.md'], 'moved content')
+
+    response = client.post('/api/move-item', json={'filePath': paths['a.md'], 'targetFolderPath': paths['ch']})
+    assert response.status_code == 200, response.get_json()
+    server.write_behind.flush()
+
+    assert read(disk_paths(server, session_id)['ch/a.md']) == 'moved content'
+    assert not os.path.exists(paths['a.md'])
+
+
+def test_buffered_save_follows_session_rename(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': 'old'})
+    client = server.app.test_client()
+    save(client, paths['a.md'], 'new')
+
+    response = client.post('/api/edit-session', json={'sessionId': session_id, 'newName': 'renamed'})
+    assert response.status_code == 200, response.get_json()
+    server.write_behind.flush()
+
+    assert read(disk_paths(server, session_id)['a.md']) == 'new'
+
+
+def test_save_to_vanished_folder_is_not_discarded(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'ch/README.md': '', 'ch/a.md': 'old'})
+    client = server.app.test_client()
+    save(client, paths['ch/a.md'], 'acknowledged')
+
+    # 文件夹在服务之外被删除
+    os.rename(paths['ch'], os.path.join(server.DATA_FOLDER, 'elsewhere'))
+    server.write_behind.flush()
+
+    lost_folder = os.path.join(server.DATA_FOLDER, 'save-lost')
+    assert [read(os.path.join(lost_folder, name)) for name in os.listdir(lost_folder)] == ['acknowledged']
+
+
+def test_revision_and_search_are_updated_on_flush(server, make_book):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': 'first'})
+    client = server.app.test_client()
+    for i in range(5):
+        save(client, paths['a.md'], f'draft {i} keyword{i}')
+
+    with server.app.app_context():
+        assert server.get_db().execute("SELECT COUNT(*) FROM revisions").fetchone()[0] == 0
+
+    server.write_behind.flush()
+    with server.app.app_context():
+        revisions = server.get_db().execute("SELECT COUNT(*) FROM revisions").fetchone()[0]
+    # 保存前的内容和合并后的最新内容
+    assert revisions == 2
+    results = client.get('/api/search', query_string={'sessionId': session_id, 'q': 'keyword4'}).get_json()['results']
+    assert len(results) == 1
+
+
+def test_import_does_not_run_startup_work(server):
+    # 恢复日志、后台刷新线程和冷启动索引只在server进程的startup()中执行
+    assert not any(thread.name == 'write-behind' for thread in threading.enumerate())
+    with server.app.app_context():
+        assert server.get_db().execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
+
+
+def test_failed_rename_on_session_delete_keeps_original_path(server, make_book, monkeypatch):
+    session_id, book, paths = make_book(server, {'README.md': '', 'a.md': 'old'})
+    client = server.app.test_client()
+    save(client, paths['a.md'], 'acknowledged')
+    # 导入时md文件改为生成的真实名称，删除会话时改回显示名称
+    assert paths['a.md'] != os.path.join(book, 'a.md')
+
+    def failing_rename(src, dst):
+        raise OSError('rename failed')
+
+    monkeypatch.setattr(server.os, 'rename', failing_rename)
+    response = client.post('/api/delete-session', json={'sessionId': session_id})
+    monkeypatch.undo()
+    assert response.status_code == 200, response.get_json()
+
+    assert read(paths['a.md']) == 'acknowledged'
+    assert not os.path.exists(os.path.join(book, 'a.md'))
+    assert server.write_behind.get(paths['a.md']) is None
@@ -0,0 +1,19 @@
+// 轮询后台任务直到结束：成功时返回任务信息，失败或被取消时抛出错误
+export const waitForJob = async (jobId, interval = 1000) => {
+  while (true) {
+    const response = await fetch(`/api/jobs/${jobId}`)
+    if (!response.ok) {
+      throw new Error('查询任务状态失败')
+    }
+
+    const job = await response.json()
+    if (job.status === 'succeeded') {
+      return job
+    }
+    if (job.status === 'failed' || job.status === 'cancelled') {
+      throw new Error(job.error || '任务执行失败')
+    }
+
+    await new Promise(resolve => setTimeout(resolve, interval))
+  }
+}